@@ -26,6 +26,8 @@
 """
 Main code for azure_energy_labeler_cli.
 
+Only what parsing the arguments needs is imported up front, the rest is imported once the arguments are valid.
+
 .. _Google Python Style Guide:
    https://google.github.io/styleguide/pyguide.html
 
@@ -33,13 +35,22 @@ Main code for azure_energy_labeler_cli.
 
 import logging
 import json
-from art import text2art
-from terminaltables import AsciiTable
-from azureenergylabelerlib import DataExporter
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 from azureenergylabelercli import (get_arguments,
                                    setup_logging,
                                    get_tenant_reporting_data,
-                                   get_subscription_reporting_data)
+                                   get_subscription_reporting_data,
+                                   get_subscriptions_reporting_data)
+from azureenergylabelercli.cache import FindingsCache
+from azureenergylabelercli.incremental import IncrementalState
+from azureenergylabelercli.jobs import SharedFindings, run_jobs
+from azureenergylabelercli.multitenant import get_tenant_path, label_tenants
+from azureenergylabelercli.profiling import PhaseProfiler, get_profile_directory, profile_phase
+from azureenergylabelercli.service import LabelService, get_report_json_data
+from azureenergylabelercli.watch import LabelWatcher
 
 __author__ = '''Sayantan Khanra <skhanra@schubergphilis.com>'''
 __docformat__ = '''google'''
@@ -57,12 +68,55 @@ LOGGER = logging.getLogger(LOGGER_BASENAME)
 LOGGER.addHandler(logging.NullHandler())
 
 
-def _get_reporting_arguments(args):
+def _get_findings_cache(args):
+    if not args.findings_cache_dir:
+        return None
+    return FindingsCache(args.findings_cache_dir, int(args.findings_cache_ttl), int(args.findings_cache_max_size))
+
+
+def _get_findings_snapshot(args):
+    if not args.findings_file:
+        return None
+    from azureenergylabelercli.snapshot import FindingsSnapshot  # pylint: disable=import-outside-toplevel
+    return FindingsSnapshot(args.findings_file)
+
+
+def _get_incremental_state(args):
+    if not args.incremental_state_file:
+        return None
+    return IncrementalState(args.incremental_state_file, int(args.incremental_max_age), int(args.incremental_max_size))
+
+
+def _get_credentials(args):
+    if not args.token_cache_file:
+        return None
+    # pylint: disable=import-outside-toplevel
+    from azure.identity import DefaultAzureCredential
+    from azureenergylabelercli.tokencache import CachedTokenCredential, EncryptedTokenCache
+    return CachedTokenCredential(DefaultAzureCredential(),
+                                 EncryptedTokenCache(args.token_cache_file, args.token_cache_key),
+                                 args.tenant_id)
+
+
+def _get_blob_service_clients(args):
+    from azureenergylabelercli.entities import BlobServiceClients  # pylint: disable=import-outside-toplevel
+    return BlobServiceClients(block_size=int(args.export_upload_block_size) * 1024 * 1024,
+                              max_connections=int(args.export_upload_concurrency) * int(args.export_workers))
+
+
+def _get_reporting_arguments(args, credentials=None, shared_findings=None):
     method_arguments = {'export_all_data_flag': args.export_all,
                         'tenant_id': args.tenant_id,
                         'frameworks': args.frameworks,
                         'log_level': args.log_level,
-                        'disable_spinner': args.disable_spinner}
+                        'disable_spinner': args.disable_spinner,
+                        'findings_cache': _get_findings_cache(args),
+                        'findings_snapshot': _get_findings_snapshot(args),
+                        'max_workers': args.max_workers,
+                        'retrieval_engine': args.retrieval_engine,
+                        'incremental_state': _get_incremental_state(args),
+                        'credentials': credentials or _get_credentials(args),
+                        'shared_findings': shared_findings}
     if args.single_subscription_id:
         get_reporting_data = get_subscription_reporting_data
         method_arguments.update({'subscription_id': args.single_subscription_id})
@@ -70,16 +124,43 @@ def _get_reporting_arguments(args):
         get_reporting_data = get_tenant_reporting_data
         method_arguments.update({'allowed_subscription_ids': args.allowed_subscription_ids,
                                  'denied_subscription_ids': args.denied_subscription_ids,
-                                 'denied_resource_group_names': args.denied_resource_group_names})
+                                 'denied_resource_group_names': args.denied_resource_group_names,
+                                 'stream': args.stream})
     return get_reporting_data(**method_arguments)
 
 
+def _get_reports(args, credentials=None, shared_findings=None):
+    """Gets the export path, report data and exporter arguments of every report requested."""
+    from azureenergylabelercli.entities import get_export_sub_path  # pylint: disable=import-outside-toplevel
+    if not any([args.subscription_ids, args.all_subscriptions_individually]):
+        report_data, exporter_arguments = _get_reporting_arguments(args, credentials, shared_findings)
+        return [(args.export_path, report_data, exporter_arguments)]
+    reporting_data = get_subscriptions_reporting_data(tenant_id=args.tenant_id,
+                                                      subscription_ids=args.subscription_ids,
+                                                      export_all_data_flag=args.export_all,
+                                                      frameworks=args.frameworks,
+                                                      log_level=args.log_level,
+                                                      disable_spinner=args.disable_spinner,
+                                                      findings_cache=_get_findings_cache(args),
+                                                      findings_snapshot=_get_findings_snapshot(args),
+                                                      max_workers=args.max_workers,
+                                                      retrieval_engine=args.retrieval_engine,
+                                                      incremental_state=_get_incremental_state(args),
+                                                      credentials=credentials or _get_credentials(args),
+                                                      shared_findings=shared_findings)
+    return [(get_export_sub_path(args.export_path, subscription_id) if args.export_path else None,
+             report_data,
+             exporter_arguments)
+            for subscription_id, report_data, exporter_arguments in reporting_data]
+
+
+@profile_phase('report')
 def report(report_data, to_json=False):
     """Report to table or json."""
     if to_json:
-        data = {key.replace(':', '').replace(' ', '_').lower(): value for key, value in dict(report_data).items()}
-        print(json.dumps(data, indent=2))
+        print(json.dumps(get_report_json_data(report_data), indent=2))
         return None
+    from terminaltables import AsciiTable  # pylint: disable=import-outside-toplevel
     table_data = [['Energy label report']]
     table_data.extend(report_data)
     table = AsciiTable(table_data)
@@ -87,20 +168,255 @@ def report(report_data, to_json=False):
     return None
 
 
+def report_many(reports_data, to_json=False):
+    """Report multiple reports to tables or a json list."""
+    if len(reports_data) == 1:
+        return report(reports_data[0], to_json)
+    if to_json:
+        print(json.dumps([get_report_json_data(report_data) for report_data in reports_data], indent=2))
+        return None
+    for report_data in reports_data:
+        report(report_data)
+    return None
+
+
+def _get_energy_label(data):
+    return data.get('Energy Label', data.get('tenant_security_score')) if data else None
+
+
+@profile_phase('report')
+def report_changes(changes, to_json=False):
+    """Report the entities whose label or finding counts changed to a table or json list."""
+    if to_json:
+        print(json.dumps(changes, indent=2, default=str))
+        return None
+    from terminaltables import AsciiTable  # pylint: disable=import-outside-toplevel
+    table_data = [['Entity', 'Name', 'Previous Energy Label', 'Energy Label', 'Changes']]
+    for change in changes:
+        previous, current = change['previous'] or {}, change['current'] or {}
+        table_data.append([change['entity'],
+                           change['name'],
+                           _get_energy_label(previous),
+                           _get_energy_label(current),
+                           '\n'.join(f'{key}: {previous.get(key)} -> {current.get(key)}'
+                                     for key in sorted(previous.keys() & current.keys())
+                                     if previous[key] != current[key] and key not in ('Energy Label',
+                                                                                      'tenant_security_score'))])
+    print(AsciiTable(table_data, title='Energy label changes').table)
+    return None
+
+
+def _export(args, reports):
+    """Exports the data of every report with an export path over a single pool of blob connections."""
+    from azureenergylabelercli.entities import DataExporter  # pylint: disable=import-outside-toplevel
+    blob_service_clients = _get_blob_service_clients(args)
+    try:
+        for export_path, _, exporter_arguments in reports:
+            if export_path:
+                LOGGER.info(f'Trying to export data to the requested path: {export_path}')
+                exporter = DataExporter(max_workers=int(args.export_workers),
+                                        findings_format=args.findings_export_format,
+                                        compression=args.export_compression,
+                                        export_format=args.export_format,
+                                        compression_level=int(args.export_compression_level or 0) or None,
+                                        upload_concurrency=int(args.export_upload_concurrency),
+                                        blob_service_clients=blob_service_clients,
+                                        skip_unchanged=args.export_skip_unchanged,
+                                        **exporter_arguments)
+                exporter.export(export_path)
+    finally:
+        blob_service_clients.close()
+
+
+def _serve(args):
+    """Labels on a schedule with a single warm credential and serves the latest labels until interrupted."""
+    from azure.identity import DefaultAzureCredential  # pylint: disable=import-outside-toplevel
+    credentials = _get_credentials(args) or DefaultAzureCredential()
+    args.disable_spinner = True
+    service = LabelService(lambda: _get_reports(args, credentials), int(args.serve_interval))
+    service.start(args.serve_host, int(args.serve_port))
+    try:
+        service.wait()
+    except KeyboardInterrupt:
+        LOGGER.info('Stopping the service.')
+    finally:
+        service.stop()
+
+
+def _label(args, reports, print_reports):
+    """Records the reports in the history, exports them and prints them, while exporting if requested."""
+    from azureenergylabelercli.streaming import closing_streamed_findings  # pylint: disable=import-outside-toplevel
+    with closing_streamed_findings(reports):
+        if args.history_db:
+            from azureenergylabelercli.history import HistoryStore  # pylint: disable=import-outside-toplevel
+            HistoryStore(args.history_db).record(args.tenant_id,
+                                                 [exporter_arguments for _, _, exporter_arguments in reports])
+        if not args.background_export:
+            _export(args, reports)
+            print_reports()
+            return
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='export') as executor:
+            export = executor.submit(_export, args, reports)
+            print_reports()
+            export.result()
+
+
+def _watch(args):
+    """Labels every interval with a single warm credential, reporting and exporting only when labels changed."""
+    from azure.identity import DefaultAzureCredential  # pylint: disable=import-outside-toplevel
+    credentials = _get_credentials(args) or DefaultAzureCredential()
+    watcher = LabelWatcher(lambda: _get_reports(args, credentials), args.tenant_id, int(args.watch))
+
+    def on_run(reports, changes):
+        if changes is None:
+            _label(args, reports, partial(report_many, [report_data for _, report_data, _ in reports], args.to_json))
+        elif changes:
+            _label(args, reports, partial(report_changes, changes, args.to_json))
+        else:
+            LOGGER.info('No labels or finding counts changed.')
+
+    try:
+        watcher.run(on_run)
+    except KeyboardInterrupt:
+        LOGGER.info('Stopping watching.')
+
+
+def _label_tenant(args, tenant_id):
+    """Labels, records and exports a tenant of many in a worker process, returning the data of its reports."""
+    from azureenergylabelercli.entities import get_export_sub_path  # pylint: disable=import-outside-toplevel
+    tenant_args = Namespace(**vars(args))
+    tenant_args.tenant_id = tenant_id
+    tenant_args.tenant_ids = None
+    tenant_args.disable_spinner = True
+    if args.export_path:
+        tenant_args.export_path = get_export_sub_path(args.export_path, tenant_id)
+    if args.incremental_state_file:
+        tenant_args.incremental_state_file = get_tenant_path(args.incremental_state_file, tenant_id)
+    reports = _get_reports(tenant_args)
+    _label(tenant_args, reports, lambda: None)
+    return [report_data for _, report_data, _ in reports]
+
+
+@profile_phase('report')
+def report_tenants(tenant_runs, to_json=False):
+    """Report the reports of every tenant labeled followed by a summary of all tenants to tables or a json list."""
+    if to_json:
+        print(json.dumps([{'tenant_id': tenant_run.tenant_id,
+                           'succeeded': tenant_run.succeeded,
+                           'error': tenant_run.error,
+                           'duration': round(tenant_run.duration, 3),
+                           'reports': [get_report_json_data(report_data) for report_data in tenant_run.reports]}
+                          for tenant_run in tenant_runs], indent=2))
+        return None
+    from terminaltables import AsciiTable  # pylint: disable=import-outside-toplevel
+    table_data = [['Tenant ID', 'Status', 'Tenant Security Score', 'Seconds', 'Error']]
+    for tenant_run in tenant_runs:
+        for report_data in tenant_run.reports:
+            report(report_data)
+        security_score = dict(tenant_run.reports[0]).get('Tenant Security Score:') if tenant_run.reports else None
+        table_data.append([tenant_run.tenant_id,
+                           'labeled' if tenant_run.succeeded else 'failed',
+                           security_score or '',
+                           f'{tenant_run.duration:.1f}' if tenant_run.succeeded else '',
+                           tenant_run.error or ''])
+    print(AsciiTable(table_data, title='Tenants summary').table)
+    return None
+
+
+def _label_tenants(args):
+    """Labels every tenant in its own process and reports them all, returning whether every tenant was labeled."""
+    tenant_runs = label_tenants(args.tenant_ids, partial(_label_tenant, args), args.tenant_workers,
+                                initializer=setup_logging, initargs=(args.log_level, args.logger_config))
+    report_tenants(tenant_runs, args.to_json)
+    return all(tenant_run.succeeded for tenant_run in tenant_runs)
+
+
+def _run_job(args, tenant_credentials, shared_findings, job):
+    """Labels, records and exports a job of a jobs file with the credential of its tenant, returning its reports."""
+    job_args = Namespace(**vars(args))
+    job_args.jobs = None
+    job_args.disable_spinner = True
+    for destination, value in job.items():
+        if destination != 'name':
+            setattr(job_args, destination, value)
+    if args.incremental_state_file:
+        job_args.incremental_state_file = get_tenant_path(args.incremental_state_file, job['name'])
+    reports = _get_reports(job_args, tenant_credentials[job['tenant_id']], shared_findings)
+    _label(job_args, reports, lambda: None)
+    return [report_data for _, report_data, _ in reports]
+
+
+@profile_phase('report')
+def report_jobs(job_runs, to_json=False):
+    """Report the reports of every job run followed by a summary of all jobs to tables or a json list."""
+    if to_json:
+        print(json.dumps([{'name': job_run.name,
+                           'tenant_id': job_run.tenant_id,
+                           'succeeded': job_run.succeeded,
+                           'error': job_run.error,
+                           'duration': round(job_run.duration, 3),
+                           'reports': [get_report_json_data(report_data) for report_data in job_run.reports]}
+                          for job_run in job_runs], indent=2))
+        return None
+    from terminaltables import AsciiTable  # pylint: disable=import-outside-toplevel
+    table_data = [['Job', 'Tenant ID', 'Status', 'Tenant Security Score', 'Seconds', 'Error']]
+    for job_run in job_runs:
+        for report_data in job_run.reports:
+            report(report_data)
+        security_score = dict(job_run.reports[0]).get('Tenant Security Score:') if job_run.reports else None
+        table_data.append([job_run.name,
+                           job_run.tenant_id,
+                           'succeeded' if job_run.succeeded else 'failed',
+                           security_score or '',
+                           f'{job_run.duration:.1f}' if job_run.succeeded else '',
+                           job_run.error or ''])
+    print(AsciiTable(table_data, title='Jobs summary').table)
+    return None
+
+
+def _run_jobs(args):
+    """Runs the jobs concurrently with a warm credential per tenant and shared findings, returning whether all ran."""
+    from azure.identity import DefaultAzureCredential  # pylint: disable=import-outside-toplevel
+    tenant_credentials = {tenant_id: _get_credentials(Namespace(**{**vars(args), 'tenant_id': tenant_id}))
+                          or DefaultAzureCredential()
+                          for tenant_id in dict.fromkeys(job['tenant_id'] for job in args.jobs)}
+    shared_findings = SharedFindings()
+    job_runs = run_jobs(args.jobs, partial(_run_job, args, tenant_credentials, shared_findings),
+                        int(args.job_workers))
+    LOGGER.info(f'Retrieved the findings {shared_findings.retrievals} times for {len(args.jobs)} jobs.')
+    report_jobs(job_runs, args.to_json)
+    return all(job_run.succeeded for job_run in job_runs)
+
+
 def main():
-    """Main method."""
-    args = get_arguments()
+    """Main method, profiling its phases if requested."""
+    profile_directory = get_profile_directory()
+    with PhaseProfiler(profile_directory) if profile_directory else nullcontext():
+        _main()
+
+
+def _main():
+    with profile_phase('arguments'):
+        args = get_arguments()
     setup_logging(args.log_level, args.logger_config)
     logging.getLogger('botocore').setLevel(logging.ERROR)
     try:
         if not args.disable_banner:
+            from art import text2art  # pylint: disable=import-outside-toplevel
             print(text2art("Azure Energy Labeler"))
-        report_data, exporter_arguments = _get_reporting_arguments(args)
-        if args.export_path:
-            LOGGER.info(f'Trying to export data to the requested path: {args.export_path}')
-            exporter = DataExporter(**exporter_arguments)
-            exporter.export(args.export_path)
-        report(report_data, args.to_json)
+        if args.mode == 'serve':
+            _serve(args)
+        elif args.watch:
+            _watch(args)
+        elif args.tenant_ids:
+            if not _label_tenants(args):
+                raise SystemExit(1)
+        elif args.jobs:
+            if not _run_jobs(args):
+                raise SystemExit(1)
+        else:
+            reports = _get_reports(args)
+            _label(args, reports, partial(report_many, [report_data for _, report_data, _ in reports], args.to_json))
     except Exception as msg:
         LOGGER.error(msg)
         raise SystemExit(1) from None
@@ -31,11 +31,11 @@ Import all parts from azureenergylabelercli here
 .. _Google Python Style Guide:
    https://google.github.io/styleguide/pyguide.html
 """
-from ._version import __version__
 from .azureenergylabelercli import (get_arguments,
                                     setup_logging,
                                     get_tenant_reporting_data,
-                                    get_subscription_reporting_data)
+                                    get_subscription_reporting_data,
+                                    get_subscriptions_reporting_data)
 
 __author__ = '''Sayantan Khanra <skhanra@schubergphilis.com>'''
 __docformat__ = '''google'''
@@ -47,9 +47,16 @@ __email__ = '''<skhanra@schubergphilis.com>'''
 __status__ = '''Development'''  # "Prototype", "Development", "Production".
 
 # This is to 'use' the module(s), so lint doesn't complain
-assert __version__
-
 assert get_arguments
 assert setup_logging
 assert get_tenant_reporting_data
 assert get_subscription_reporting_data
+assert get_subscriptions_reporting_data
+
+
+def __getattr__(name):
+    """Reads the version of the package on first access instead of on import."""
+    if name == '__version__':
+        from . import _version  # pylint: disable=import-outside-toplevel
+        return _version.__version__
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
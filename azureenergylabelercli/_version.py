@@ -57,9 +57,20 @@ LOCAL_VERSION_FILE_PATH = os.path.abspath(
     )
 )
 
-try:
-    with open(VERSION_FILE_PATH, encoding='utf-8') as f:
-        __version__ = f.read()
-except IOError:
-    with open(LOCAL_VERSION_FILE_PATH, encoding='utf-8') as f:
-        __version__ = f.read()
+
+def get_version():
+    """Reads the version of the package from the version file of the repository or of the installed package."""
+    try:
+        with open(VERSION_FILE_PATH, encoding='utf-8') as f:
+            return f.read()
+    except IOError:
+        with open(LOCAL_VERSION_FILE_PATH, encoding='utf-8') as f:
+            return f.read()
+
+
+def __getattr__(name):
+    """Reads the version on first access instead of on import."""
+    if name == '__version__':
+        globals()['__version__'] = get_version()
+        return globals()['__version__']
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
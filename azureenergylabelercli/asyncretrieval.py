@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: asyncretrieval.py
+#
+# Copyright 2022 Sayantan Khanra
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Asyncio engine retrieving defender for cloud findings for azureenergylabelercli.
+
+The engine keeps up to a bounded number of resource graph queries in flight on a single event loop, one query per
+subscription and framework, and requests the next page of a query before parsing the current one. It needs the
+asynchronous transport of the Azure SDK, so aiohttp has to be installed.
+
+.. _Google Python Style Guide:
+   https://google.github.io/styleguide/pyguide.html
+
+"""
+
+import asyncio
+import logging
+
+from azure.mgmt.resourcegraph.aio import ResourceGraphClient
+from azure.mgmt.resourcegraph.models import QueryRequest, QueryRequestOptions
+from azureenergylabelerlib.configuration import FINDINGS_QUERY_STRING
+
+from .azureenergylabelercliexceptions import AsyncRetrievalUnavailable
+from .records import CompactFinding
+
+__author__ = '''Sayantan Khanra <skhanra@schubergphilis.com>'''
+__docformat__ = '''google'''
+__date__ = '''04-05-2022'''
+__copyright__ = '''Copyright 2022, Sayantan Khanra'''
+__credits__ = ["Sayantan Khanra"]
+__license__ = '''MIT'''
+__maintainer__ = '''Sayantan Khanra'''
+__email__ = '''<skhanra@schubergphilis.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''asyncretrieval'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class AsyncCredential:
+    """Exposes a synchronous Azure credential to the asynchronous clients.
+
+    Tokens are cached by the wrapped credential, so only the first request of a scope waits for a token in a thread.
+
+    """
+
+    def __init__(self, credential):
+        self._credential = credential
+
+    async def get_token(self, *scopes, **kwargs):
+        """Gets an access token for the scopes from the wrapped credential."""
+        return await asyncio.to_thread(self._credential.get_token, *scopes, **kwargs)
+
+    async def close(self):
+        """The wrapped credential is owned by the caller, so there is nothing to close."""
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+class AsyncFindingsRetriever:
+    """Retrieves the findings of many subscriptions on one event loop with bounded concurrency."""
+
+    def __init__(self, credential, subscription_ids, frameworks, max_concurrency=1):
+        """Initializes the retriever.
+
+        Args:
+            credential: The synchronous Azure credential to authenticate with.
+            subscription_ids: The subscription ids to retrieve the findings of.
+            frameworks: The frameworks to retrieve the findings of.
+            max_concurrency: The maximum number of queries in flight at any time.
+
+        """
+        self._logger = logging.getLogger(f'{LOGGER_BASENAME}.{self.__class__.__name__}')
+        self._credential = credential
+        self.subscription_ids = subscription_ids
+        self.frameworks = frameworks
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+
+    async def _query(self, client, subscription_id, framework, skip_token=None):
+        options = QueryRequestOptions(result_format='objectArray', skip_token=skip_token)
+        query = QueryRequest(subscriptions=[subscription_id],
+                             query=FINDINGS_QUERY_STRING.format(framework=framework),
+                             options=options)
+        async with self._semaphore:
+            return await client.resources(query)
+
+    async def _get_query_findings(self, client, subscription_id, framework):
+        """Retrieves all pages of a query, requesting the next page while the current one is parsed."""
+        findings = []
+        response = await self._query(client, subscription_id, framework)
+        while response is not None:
+            next_page = None
+            if response.skip_token:
+                next_page = asyncio.create_task(self._query(client, subscription_id, framework, response.skip_token))
+                await asyncio.sleep(0)
+            findings.extend(CompactFinding(finding_details) for finding_details in response.data)
+            response = await next_page if next_page else None
+        self._logger.debug(f'Retrieved {len(findings)} findings of {framework} for subscription {subscription_id}.')
+        return findings
+
+    async def get_findings(self, client=None):
+        """Retrieves the findings of all subscriptions and frameworks.
+
+        Args:
+            client: An asynchronous resource graph client to use, by default one is created for the credential.
+
+        Returns:
+            findings (set(Findings)): The findings retrieved.
+
+        """
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if client is None:
+            try:
+                client = ResourceGraphClient(AsyncCredential(self._credential))
+            except ImportError:
+                raise AsyncRetrievalUnavailable('The asyncio retrieval engine requires aiohttp, '
+                                                'install it with "pip install aiohttp".') from None
+        async with client:
+            results = await asyncio.gather(*[self._get_query_findings(client, subscription_id, framework)
+                                             for subscription_id in self.subscription_ids
+                                             for framework in self.frameworks])
+        return set().union(*results)
+
+    def retrieve(self, client=None):
+        """Runs the retrieval of the findings of all subscriptions and frameworks to completion."""
+        return asyncio.run(self.get_findings(client))
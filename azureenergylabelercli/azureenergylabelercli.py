@@ -26,6 +26,9 @@
 """
 Main code for azureenergylabelercli.
 
+The library, the Azure SDKs and the terminal helpers are imported when first needed, so parsing the arguments, and
+with it --help and argument errors, does not pay for importing them.
+
 .. _Google Python Style Guide:
    https://google.github.io/styleguide/pyguide.html
 
@@ -36,20 +39,19 @@ import logging.config
 import json
 import argparse
 import os
-import coloredlogs
-
-from yaspin import yaspin
-from azureenergylabelerlib import (AzureEnergyLabeler,
-                                   ALL_TENANT_EXPORT_TYPES,
-                                   ALL_SUBSCRIPTION_EXPORT_DATA,
-                                   SUBSCRIPTION_METRIC_EXPORT_TYPES,
-                                   TENANT_THRESHOLDS,
-                                   SUBSCRIPTION_THRESHOLDS,
-                                   RESOURCE_GROUP_THRESHOLDS,
-                                   TENANT_METRIC_EXPORT_TYPES)
-
+from operator import attrgetter
+
+from .azureenergylabelercliexceptions import InvalidJobsFile, YamlJobsFileUnavailable
+from .cache import DEFAULT_CACHE_MAX_SIZE, DEFAULT_CACHE_TTL
+from .incremental import DEFAULT_INCREMENTAL_MAX_AGE, DEFAULT_INCREMENTAL_MAX_SIZE
+from .jobs import DEFAULT_JOB_WORKERS, load_jobs
+from .multitenant import read_tenants_file
+from .profiling import profile_phase
+from .records import IndexedFindings
+from .service import DEFAULT_SERVE_HOST, DEFAULT_SERVE_INTERVAL, DEFAULT_SERVE_PORT
 from .validators import (ValidatePath,
                          azure_subscription_id,
+                         positive_integer,
                          get_mutually_exclusive_args)
 
 
@@ -96,12 +98,60 @@ def get_arguments():
                                  'warning',
                                  'error',
                                  'critical'])
+    parser.add_argument('mode',
+                        nargs='?',
+                        choices=['report', 'serve'],
+                        default='report',
+                        help='Either report to label once, the default, or serve to keep labeling on a schedule '
+                             'and serve the latest labels over a local HTTP API.')
+    _add_scope_arguments(parser)
+    _add_export_arguments(parser)
+    _add_retrieval_arguments(parser)
+    _add_output_arguments(parser)
+    parser.set_defaults(export_all=True)
+    return _validate_arguments(parser, parser.parse_args())
+
+
+def _add_scope_arguments(parser):
+    """Adds the arguments selecting the tenants, subscriptions and resource groups to label."""
     parser.add_argument('--tenant-id',
                         '-tid',
                         dest='tenant_id',
                         type=str,
                         default=os.environ.get('AZURE_LABELER_TENANT_ID'),
                         help='The ID of the Tenant to labeled')
+    parser.add_argument('--tenant-ids',
+                        dest='tenant_ids',
+                        type=comma_delimited_list,
+                        default=os.environ.get('AZURE_LABELER_TENANT_IDS'),
+                        help='The comma delimited list of the IDs of the Tenants to label, each in its own process, '
+                             'with its own report and export sub directory and a summary of all tenants at the end.')
+    parser.add_argument('--tenants-file',
+                        dest='tenants_file',
+                        action='store',
+                        default=os.environ.get('AZURE_LABELER_TENANTS_FILE'),
+                        help='A file with the IDs of the Tenants to label, one per line, lines starting with # are '
+                             'skipped. Labels them like --tenant-ids.')
+    parser.add_argument('--tenant-workers',
+                        dest='tenant_workers',
+                        type=positive_integer,
+                        default=os.environ.get('AZURE_LABELER_TENANT_WORKERS'),
+                        help='The number of tenants of --tenant-ids or --tenants-file to label at the same time, '
+                             'default=the number of tenants up to the number of cpus')
+    parser.add_argument('--jobs',
+                        dest='jobs',
+                        action='store',
+                        default=os.environ.get('AZURE_LABELER_JOBS'),
+                        help='A yaml or json file listing labeling jobs, each with its tenant-id and optionally its '
+                             'allowed-subscription-ids, denied-subscription-ids, denied-resource-group-names, '
+                             'frameworks, export-path, export-metrics, export-format, findings-export-format and '
+                             'export-compression. The jobs run concurrently in this process, jobs of the same tenant '
+                             'and frameworks retrieve the findings once, and all other arguments apply to every job.')
+    parser.add_argument('--job-workers',
+                        dest='job_workers',
+                        type=positive_integer,
+                        default=os.environ.get('AZURE_LABELER_JOB_WORKERS', DEFAULT_JOB_WORKERS),
+                        help=f'The number of jobs of --jobs to run at the same time, default={DEFAULT_JOB_WORKERS}')
     single_subscription_action = parser.add_argument('--single-subscription-id',
                                                      '-s',
                                                      required=False,
@@ -142,6 +192,27 @@ def get_arguments():
                                          '--allowed-subscription-ids and --single-subscription-id arguments.\n'
                                          'example='
                                          '"00000000-0000-0000-0000-000000000000,00000000-0000-0000-0000-000000000001"'))
+    subscription_list.add_argument('--subscription-ids',
+                                   '-S',
+                                   required=False,
+                                   dest='subscription_ids',
+                                   default=os.environ.get('AZURE_LABELER_SUBSCRIPTION_IDS'),
+                                   type=comma_delimited_list,
+                                   help=('A comma delimited list of Azure Subscription IDs that will each be '
+                                         'labeled individually, retrieving the findings only once. '
+                                         'Mutually exclusive with '
+                                         '--allowed-subscription-ids, --denied-subscription-ids and '
+                                         '--single-subscription-id arguments.\n'
+                                         'example='
+                                         '"00000000-0000-0000-0000-000000000000,00000000-0000-0000-0000-000000000001"'))
+    subscription_list.add_argument('--all-subscriptions-individually',
+                                   '-A',
+                                   required=False,
+                                   dest='all_subscriptions_individually',
+                                   action='store_true',
+                                   default=os.environ.get('AZURE_LABELER_ALL_SUBSCRIPTIONS_INDIVIDUALLY', False),
+                                   help=('If set every subscription of the tenant will be labeled individually, '
+                                         'retrieving the findings only once.'))
     subscription_list.add_argument('--denied-resource-group-names',
                                    '-e',
                                    required=False,
@@ -151,13 +222,19 @@ def get_arguments():
                                          'be excluded from producing the energy label.\n'
                                          'example='
                                          '"SBPP-WEU-AARC-01-RSG, SBPA-WEU-AARC-01-RSG"'))
+
+
+def _add_export_arguments(parser):
+    """Adds the arguments of exporting the labels and findings."""
     parser.add_argument('--export-path',
                         '-p',
                         action=ValidatePath,
                         required=False,
                         default=os.environ.get('AZURE_LABELER_EXPORT_PATH'),
                         help='Exports a snapshot of chosen data in '
-                             'JSON formatted files to the specified directory or Storage Account Container location.')
+                             'JSON formatted files to the specified directory or Storage Account Container location. '
+                             'When subscriptions are labeled individually each one is exported under a directory '
+                             'named after its subscription id.')
     export_options = parser.add_mutually_exclusive_group()
     export_options.add_argument('--export-metrics',
                                 '-em',
@@ -177,6 +254,197 @@ def get_arguments():
                                 help='Exports metrics/statistics without sensitive findings data in '
                                      'JSON formatted files to the specified directory or '
                                      'Storage Account Container location.')
+    parser.add_argument('--findings-export-format',
+                        dest='findings_export_format',
+                        default=os.environ.get('AZURE_LABELER_FINDINGS_EXPORT_FORMAT', 'json'),
+                        choices=['json', 'ndjson'],
+                        help='The format of the findings export, written one finding at a time either way. json '
+                             'writes the document of the library, ndjson one finding per line to '
+                             'defender-for-cloud-findings.ndjson. default=json')
+    parser.add_argument('--export-format',
+                        dest='export_format',
+                        default=os.environ.get('AZURE_LABELER_EXPORT_FORMAT', 'json'),
+                        choices=['json', 'parquet'],
+                        help='The format of the findings and labeled subscriptions exports. parquet writes them with '
+                             'a typed schema and dictionary encoded string columns, compressed within the file, and '
+                             'requires pyarrow to be installed. The other exports are always json. default=json')
+    parser.add_argument('--export-compression',
+                        dest='export_compression',
+                        default=os.environ.get('AZURE_LABELER_EXPORT_COMPRESSION', 'none'),
+                        choices=['none', 'gzip', 'zstd'],
+                        help='Compresses the exported files as they are written, suffixing them with .gz or .zst. '
+                             'Parquet exports are compressed within the file instead. zstd requires zstandard to be '
+                             'installed for json exports. default=none')
+    parser.add_argument('--export-compression-level',
+                        dest='export_compression_level',
+                        type=positive_integer,
+                        default=os.environ.get('AZURE_LABELER_EXPORT_COMPRESSION_LEVEL'),
+                        help='The level of the export compression, 1 to 9 for gzip and 1 to 22 for zstd, '
+                             'default=6 for gzip and 3 for zstd')
+    parser.add_argument('--export-upload-block-size',
+                        dest='export_upload_block_size',
+                        type=positive_integer,
+                        default=os.environ.get('AZURE_LABELER_EXPORT_UPLOAD_BLOCK_SIZE', 4),
+                        help='The size in megabytes of the blocks exports larger than it are uploaded to a Storage '
+                             'Account Container in, default=4')
+    parser.add_argument('--export-upload-concurrency',
+                        dest='export_upload_concurrency',
+                        type=positive_integer,
+                        default=os.environ.get('AZURE_LABELER_EXPORT_UPLOAD_CONCURRENCY', 4),
+                        help='The number of blocks of an export uploaded to a Storage Account Container at a time, '
+                             'all uploads reuse the connections of a single pool, default=4')
+    parser.add_argument('--background-export',
+                        dest='background_export',
+                        action='store_true',
+                        default=os.environ.get('AZURE_LABELER_BACKGROUND_EXPORT', False),
+                        help='If set the report is printed as soon as the labels are calculated while the data is '
+                             'exported in the background. The process waits for the export to finish and exits '
+                             'with an error if it failed.')
+    parser.add_argument('--export-skip-unchanged',
+                        dest='export_skip_unchanged',
+                        action='store_true',
+                        default=os.environ.get('AZURE_LABELER_EXPORT_SKIP_UNCHANGED', False),
+                        help='If set export files whose content hash did not change since the last export are not '
+                             'written or uploaded again. The hashes are kept in a manifest in the export directory '
+                             'or in the metadata of the blobs.')
+    parser.add_argument('--export-workers',
+                        dest='export_workers',
+                        type=positive_integer,
+                        default=os.environ.get('AZURE_LABELER_EXPORT_WORKERS', 1),
+                        help='The number of export files to serialize and write concurrently, the files are identical '
+                             'to the ones of a sequential export, default=1 exports them one after another.')
+
+
+def _add_retrieval_arguments(parser):
+    """Adds the arguments of retrieving the findings and keeping them between runs."""
+    parser.add_argument('--findings-cache-dir',
+                        dest='findings_cache_dir',
+                        action='store',
+                        required=False,
+                        default=os.environ.get('AZURE_LABELER_FINDINGS_CACHE_DIR'),
+                        help='A local directory to cache the retrieved findings in, shared between runs on the '
+                             'same host. Runs with the same tenant, frameworks and filters reuse the cached findings.')
+    parser.add_argument('--findings-cache-ttl',
+                        dest='findings_cache_ttl',
+                        type=int,
+                        default=os.environ.get('AZURE_LABELER_FINDINGS_CACHE_TTL', DEFAULT_CACHE_TTL),
+                        help=f'The number of seconds cached findings are valid for, default={DEFAULT_CACHE_TTL}')
+    parser.add_argument('--findings-cache-max-size',
+                        dest='findings_cache_max_size',
+                        type=int,
+                        default=os.environ.get('AZURE_LABELER_FINDINGS_CACHE_MAX_SIZE', DEFAULT_CACHE_MAX_SIZE),
+                        help='The maximum size of the findings cache in megabytes, the least recently used '
+                             f'entries are evicted beyond it, default={DEFAULT_CACHE_MAX_SIZE}')
+    parser.add_argument('--max-workers',
+                        dest='max_workers',
+                        type=positive_integer,
+                        default=os.environ.get('AZURE_LABELER_MAX_WORKERS', 1),
+                        help='The number of subscriptions to retrieve the findings of concurrently, '
+                             'default=1 retrieves the findings of all subscriptions at once.')
+    parser.add_argument('--retrieval-engine',
+                        dest='retrieval_engine',
+                        default=os.environ.get('AZURE_LABELER_RETRIEVAL_ENGINE', 'threads'),
+                        choices=['threads', 'asyncio'],
+                        help='The engine retrieving the findings of the subscriptions concurrently. '
+                             'asyncio keeps up to --max-workers queries in flight on a single event loop, '
+                             'prefetching the next page of every query, and requires aiohttp to be installed. '
+                             'default=threads')
+    parser.add_argument('--stream',
+                        dest='stream',
+                        action='store_true',
+                        default=os.environ.get('AZURE_LABELER_STREAM', False),
+                        help='If set the findings of the tenant are streamed page by page, aggregated per '
+                             'subscription and resource group and spooled to a temporary file instead of kept in '
+                             'memory, so memory use does not grow with the number of findings. The findings are '
+                             'retrieved serially and not cached. Only applies to labeling the tenant.')
+    parser.add_argument('--incremental-state-file',
+                        dest='incremental_state_file',
+                        action='store',
+                        required=False,
+                        default=os.environ.get('AZURE_LABELER_INCREMENTAL_STATE_FILE'),
+                        help='A local file keeping the findings of the last run, so the next run with the same '
+                             'tenant, frameworks and filters only retrieves the findings whose status changed '
+                             'since and recomputes the labels from the merged findings. Use a file per set of '
+                             'arguments, a run with other arguments retrieves all findings and replaces the state.')
+    parser.add_argument('--incremental-max-age',
+                        dest='incremental_max_age',
+                        type=positive_integer,
+                        default=os.environ.get('AZURE_LABELER_INCREMENTAL_MAX_AGE', DEFAULT_INCREMENTAL_MAX_AGE),
+                        help='The number of seconds after which all findings are retrieved again instead of only '
+                             f'the changed ones, default={DEFAULT_INCREMENTAL_MAX_AGE}')
+    parser.add_argument('--incremental-max-size',
+                        dest='incremental_max_size',
+                        type=positive_integer,
+                        default=os.environ.get('AZURE_LABELER_INCREMENTAL_MAX_SIZE', DEFAULT_INCREMENTAL_MAX_SIZE),
+                        help='The maximum size in megabytes of the compressed incremental state file, a larger state '
+                             f'is not kept and all findings are retrieved again, default={DEFAULT_INCREMENTAL_MAX_SIZE}')
+    parser.add_argument('--history-db',
+                        dest='history_db',
+                        action='store',
+                        required=False,
+                        default=os.environ.get('AZURE_LABELER_HISTORY_DB'),
+                        help='A local SQLite database every run appends the labels and finding counts of the tenant, '
+                             'subscriptions and resource groups to, in indexed tables, so trends can be queried '
+                             'without parsing past exports.')
+    parser.add_argument('--token-cache-file',
+                        dest='token_cache_file',
+                        action='store',
+                        required=False,
+                        default=os.environ.get('AZURE_LABELER_TOKEN_CACHE_FILE'),
+                        help='A local file access tokens are cached in encrypted, per tenant and identity, so '
+                             'subsequent runs reuse them until shortly before they expire instead of acquiring new '
+                             'ones.')
+    parser.add_argument('--token-cache-key',
+                        dest='token_cache_key',
+                        action='store',
+                        required=False,
+                        default=os.environ.get('AZURE_LABELER_TOKEN_CACHE_KEY'),
+                        help='The passphrase the token cache is encrypted with, if not set a random key is kept in a '
+                             'file next to the token cache only readable by the user.')
+    parser.add_argument('--findings-file',
+                        dest='findings_file',
+                        action='store',
+                        required=False,
+                        default=os.environ.get('AZURE_LABELER_FINDINGS_FILE'),
+                        help='Calculates the energy labels offline from a saved findings snapshot instead of '
+                             'retrieving the findings from Azure. Accepts the findings json or ndjson exported with '
+                             '--export-all, compressed or not, or parquet. Any other exported files next to it are '
+                             'used to restore the subscriptions, their resource groups and exempted policies.')
+
+
+def _add_output_arguments(parser):
+    """Adds the arguments of watching, serving, profiling and printing the report."""
+    parser.add_argument('--watch',
+                        dest='watch',
+                        type=positive_integer,
+                        default=os.environ.get('AZURE_LABELER_WATCH'),
+                        help='Labels again every provided number of seconds, keeping the labels of the last run in '
+                             'memory. After the first run only the tenant, subscriptions and resource groups whose '
+                             'label or finding counts changed are printed, and the data is only exported when '
+                             'something changed.')
+    parser.add_argument('--serve-host',
+                        dest='serve_host',
+                        action='store',
+                        default=os.environ.get('AZURE_LABELER_SERVE_HOST', DEFAULT_SERVE_HOST),
+                        help=f'The address the serve mode listens on, default={DEFAULT_SERVE_HOST}')
+    parser.add_argument('--serve-port',
+                        dest='serve_port',
+                        type=positive_integer,
+                        default=os.environ.get('AZURE_LABELER_SERVE_PORT', DEFAULT_SERVE_PORT),
+                        help=f'The port the serve mode listens on, default={DEFAULT_SERVE_PORT}')
+    parser.add_argument('--serve-interval',
+                        dest='serve_interval',
+                        type=positive_integer,
+                        default=os.environ.get('AZURE_LABELER_SERVE_INTERVAL', DEFAULT_SERVE_INTERVAL),
+                        help='The number of seconds between labeling runs of the serve mode, '
+                             f'default={DEFAULT_SERVE_INTERVAL}')
+    parser.add_argument('--profile',
+                        dest='profile',
+                        action='store',
+                        default=os.environ.get('AZURE_LABELER_PROFILE'),
+                        help='Profiles parsing the arguments, retrieving the findings, calculating the labels, '
+                             'exporting and reporting, writing a pstats file per phase and a collapsed stacks file '
+                             'of all threads for flame graphs to the provided directory.')
     parser.add_argument('--to-json',
                         '-j',
                         dest='to_json',
@@ -194,17 +462,88 @@ def get_arguments():
                         action='store_true',
                         default=os.environ.get('AZURE_LABELER_DISABLE_BANNER', False),
                         help='If set banner will be disabled on the CLI.')
-    parser.set_defaults(export_all=True)
-    args = parser.parse_args()
+
+
+def _validate_arguments(parser, args):
+    """Validates the combinations of the parsed arguments.
+
+    Args:
+        parser: The parser the arguments were parsed with, to report invalid files through.
+        args: The parsed arguments.
+
+    Returns:
+        The arguments after validation.
+
+    """
     args.allowed_subscription_ids, args.denied_subscription_ids = get_mutually_exclusive_args(
         args.allowed_subscription_ids,
         args.denied_subscription_ids,
         msg="conflicting arguments: --denied-subscription-ids, --allowed-subscription-ids")
+    args.subscription_ids, args.single_subscription_id = get_mutually_exclusive_args(
+        args.subscription_ids,
+        args.single_subscription_id,
+        msg="conflicting arguments: --subscription-ids, --single-subscription-id")
+    args.stream, _ = get_mutually_exclusive_args(
+        args.stream,
+        any([args.single_subscription_id, args.subscription_ids, args.all_subscriptions_individually,
+             args.findings_file]),
+        msg="conflicting arguments: --stream only applies to labeling the tenant from Azure")
+    get_mutually_exclusive_args(
+        args.export_format == 'parquet',
+        args.findings_export_format == 'ndjson',
+        msg="conflicting arguments: --export-format parquet, --findings-export-format ndjson")
+    args.incremental_state_file, _ = get_mutually_exclusive_args(
+        args.incremental_state_file,
+        any([args.stream, args.findings_file, args.findings_cache_dir]),
+        msg="conflicting arguments: --incremental-state-file, --stream, --findings-file, --findings-cache-dir")
+    args.watch, _ = get_mutually_exclusive_args(
+        args.watch,
+        args.mode == 'serve',
+        msg="conflicting arguments: --watch, serve")
+    return _validate_multi_run_arguments(parser, args)
+
+
+def _validate_multi_run_arguments(parser, args):
+    """Validates the arguments labeling many tenants or jobs and loads the tenants and jobs files.
+
+    Args:
+        parser: The parser the arguments were parsed with, to report invalid files through.
+        args: The parsed arguments.
+
+    Returns:
+        The arguments after validation.
+
+    """
+    if args.tenants_file:
+        try:
+            args.tenant_ids = (args.tenant_ids or []) + read_tenants_file(args.tenants_file)
+        except OSError as error:
+            parser.error(f'could not read --tenants-file: {error}')
+    args.tenant_ids, _ = get_mutually_exclusive_args(
+        args.tenant_ids,
+        any([args.single_subscription_id, args.subscription_ids, args.findings_file, args.watch, args.mode == 'serve']),
+        msg="conflicting arguments: --tenant-ids, --tenants-file, --single-subscription-id, --subscription-ids, "
+            "--findings-file, --watch, serve")
+    args.tenant_id, args.tenant_ids = get_mutually_exclusive_args(
+        args.tenant_id,
+        args.tenant_ids,
+        msg="conflicting arguments: --tenant-id, --tenant-ids, --tenants-file")
+    args.jobs, _ = get_mutually_exclusive_args(
+        args.jobs,
+        any([args.tenant_id, args.tenant_ids, args.single_subscription_id, args.subscription_ids, args.findings_file,
+             args.watch, args.mode == 'serve']),
+        msg="conflicting arguments: --jobs, --tenant-id, --tenant-ids, --tenants-file, --single-subscription-id, "
+            "--subscription-ids, --findings-file, --watch, serve")
     args.tenant_id, _ = get_mutually_exclusive_args(
         args.tenant_id,
-        None,
+        args.tenant_ids or args.jobs,
         required=True,
-        msg="the following arguments are required: --tenant-id/-tid")
+        msg="the following arguments are required: --tenant-id/-tid or --tenant-ids or --tenants-file or --jobs")
+    if args.jobs:
+        try:
+            args.jobs = load_jobs(args.jobs)
+        except (InvalidJobsFile, YamlJobsFileUnavailable) as error:
+            parser.error(f'could not load --jobs: {error}')
     return args
 
 
@@ -239,9 +578,11 @@ def setup_logging(level, config_file=None):
             print(f'File "{config_file}" is not valid json, cannot continue.')
             raise SystemExit(1) from None
     else:
+        import coloredlogs  # pylint: disable=import-outside-toplevel
         coloredlogs.install(level=level.upper())
 
 
+@profile_phase('findings')
 def wait_for_findings(method_name, method_argument, log_level, disable_spinner=False):
     """If log level is not debug shows a spinner while the callable provided gets security hub findings.
 
@@ -257,6 +598,7 @@ def wait_for_findings(method_name, method_argument, log_level, disable_spinner=F
     """
     try:
         if all([log_level != 'debug', not disable_spinner]):
+            from yaspin import yaspin  # pylint: disable=import-outside-toplevel
             with yaspin(text="Please wait while retrieving Defender For Cloud findings...", color="yellow") as spinner:
                 findings = method_name(method_argument)
             spinner.ok("✅")
@@ -268,14 +610,86 @@ def wait_for_findings(method_name, method_argument, log_level, disable_spinner=F
     return findings
 
 
-def get_tenant_reporting_data(tenant_id,  # pylint: disable=too-many-arguments
+def get_labeler(tenant_id,  # pylint: disable=too-many-arguments,too-many-locals
+                frameworks,
+                allowed_subscription_ids=None,
+                denied_subscription_ids=None,
+                denied_resource_group_names=None,
+                scoped=False,
+                findings_cache=None,
+                findings_snapshot=None,
+                max_workers=1,
+                retrieval_engine='threads',
+                stream=False,
+                incremental_state=None,
+                credentials=None,
+                shared_findings=None):
+    """Gets the labeler retrieving the findings as requested.
+
+    Args:
+        tenant_id: Tenant Id of the tenant
+        frameworks: The frameworks to include in scoring.
+        allowed_subscription_ids: The allowed subscription ids for tenant inclusion if any.
+        denied_subscription_ids: The denied subscription ids for tenant zone exclusion if any.
+        denied_resource_group_names: List of resource groups to exclude if any.
+        scoped: If set the findings are only retrieved for the subscriptions to be labeled.
+        findings_cache: A findings cache to retrieve the findings through, if any.
+        findings_snapshot: A findings snapshot to label offline instead of retrieving the findings, if any.
+        max_workers: The number of subscriptions to retrieve the findings of concurrently.
+        retrieval_engine: Either threads or asyncio, the engine retrieving the findings concurrently.
+        stream: If set the findings are streamed and aggregated instead of kept in memory.
+        incremental_state: An incremental state to only retrieve the findings changed since the last run, if any.
+        credentials: The Azure credential to authenticate with, defaults to the default Azure credential.
+        shared_findings: Findings shared with the labelers of concurrent jobs, if any.
+
+    Returns:
+        labeler: The labeler to calculate the energy labels with.
+
+    """
+    # pylint: disable=import-outside-toplevel
+    from azureenergylabelerlib import RESOURCE_GROUP_THRESHOLDS, SUBSCRIPTION_THRESHOLDS, TENANT_THRESHOLDS
+    from .entities import (AzureEnergyLabeler,
+                           OfflineAzureEnergyLabeler,
+                           ScopedAzureEnergyLabeler,
+                           StreamingAzureEnergyLabeler)
+    arguments = {'tenant_id': tenant_id,
+                 'tenant_thresholds': TENANT_THRESHOLDS,
+                 'resource_group_thresholds': RESOURCE_GROUP_THRESHOLDS,
+                 'subscription_thresholds': SUBSCRIPTION_THRESHOLDS,
+                 'frameworks': frameworks,
+                 'allowed_subscription_ids': allowed_subscription_ids,
+                 'denied_subscription_ids': denied_subscription_ids,
+                 'denied_resource_group_names': denied_resource_group_names}
+    if findings_snapshot:
+        return OfflineAzureEnergyLabeler(findings_snapshot=findings_snapshot, **arguments)
+    if stream:
+        return StreamingAzureEnergyLabeler(credentials=credentials, **arguments)
+    labeler_class = ScopedAzureEnergyLabeler if scoped else AzureEnergyLabeler
+    return labeler_class(findings_cache=findings_cache,
+                         max_workers=max_workers,
+                         retrieval_engine=retrieval_engine,
+                         incremental_state=incremental_state,
+                         credentials=credentials,
+                         shared_findings=shared_findings,
+                         **arguments)
+
+
+def get_tenant_reporting_data(tenant_id,  # pylint: disable=too-many-arguments,too-many-locals
                               allowed_subscription_ids,
                               denied_subscription_ids,
                               denied_resource_group_names,
                               export_all_data_flag,
                               frameworks,
                               log_level,
-                              disable_spinner):
+                              disable_spinner,
+                              findings_cache=None,
+                              findings_snapshot=None,
+                              max_workers=1,
+                              retrieval_engine='threads',
+                              stream=False,
+                              incremental_state=None,
+                              credentials=None,
+                              shared_findings=None):
     """Gets the reporting data for a landing zone.
 
     Args:
@@ -287,37 +701,53 @@ def get_tenant_reporting_data(tenant_id,  # pylint: disable=too-many-arguments
         frameworks: The frameworks to include in scoring.
         log_level: The log level set.
         disable_spinner: The spinner will be disabled while retrieving the findings.
+        findings_cache: A findings cache to retrieve the findings through, if any.
+        findings_snapshot: A findings snapshot to label offline instead of retrieving the findings, if any.
+        max_workers: The number of subscriptions to retrieve the findings of concurrently.
+        retrieval_engine: Either threads or asyncio, the engine retrieving the findings concurrently.
+        stream: If set the findings are streamed and aggregated instead of kept in memory.
+        incremental_state: An incremental state to only retrieve the findings changed since the last run, if any.
+        credentials: The Azure credential to authenticate with, defaults to the default Azure credential.
+        shared_findings: Findings shared with the labelers of concurrent jobs, if any.
 
 
     Returns:
         report_data, exporter_arguments
 
     """
-    labeler = AzureEnergyLabeler(tenant_id=tenant_id,
-                                 tenant_thresholds=TENANT_THRESHOLDS,
-                                 resource_group_thresholds=RESOURCE_GROUP_THRESHOLDS,
-                                 subscription_thresholds=SUBSCRIPTION_THRESHOLDS,
-                                 frameworks=frameworks,
-                                 allowed_subscription_ids=allowed_subscription_ids,
-                                 denied_subscription_ids=denied_subscription_ids,
-                                 denied_resource_group_names=denied_resource_group_names)
-    wait_for_findings(AzureEnergyLabeler.filtered_defender_for_cloud_findings.fget,
+    labeler = get_labeler(tenant_id,
+                          frameworks,
+                          allowed_subscription_ids=allowed_subscription_ids,
+                          denied_subscription_ids=denied_subscription_ids,
+                          denied_resource_group_names=denied_resource_group_names,
+                          findings_cache=findings_cache,
+                          findings_snapshot=findings_snapshot,
+                          max_workers=max_workers,
+                          retrieval_engine=retrieval_engine,
+                          stream=stream,
+                          incremental_state=incremental_state,
+                          credentials=credentials,
+                          shared_findings=shared_findings)
+    wait_for_findings(attrgetter('filtered_defender_for_cloud_findings'),
                       labeler, log_level, disable_spinner=disable_spinner)
-    report_data = [['Tenant ID:', tenant_id],
-                   ['Tenant Security Score:', labeler.tenant_energy_label.label],
-                   ['Tenant Percentage Coverage:', labeler.tenant_energy_label.coverage],
-                   ['Labeled Subscriptions Measured:',
-                    labeler.labeled_subscriptions_energy_label.subscriptions_measured]]
-    if labeler.tenant_energy_label.best_label != labeler.tenant_energy_label.worst_label:
-        report_data.extend([['Best Subscription Security Score:', labeler.tenant_energy_label.best_label],
-                            ['Worst Subscription Security Score:', labeler.tenant_energy_label.worst_label]])
-    export_types = ALL_TENANT_EXPORT_TYPES if export_all_data_flag else TENANT_METRIC_EXPORT_TYPES
-    exporter_arguments = {'export_types': export_types,
-                          'id': tenant_id,
-                          'energy_label': labeler.tenant_energy_label.label,
-                          'defender_for_cloud_findings': labeler.filtered_defender_for_cloud_findings,
-                          'labeled_subscriptions': labeler.tenant_labeled_subscriptions,
-                          'credentials': labeler.tenant_credentials}
+    with profile_phase('labels'):
+        report_data = [['Tenant ID:', tenant_id],
+                       ['Tenant Security Score:', labeler.tenant_energy_label.label],
+                       ['Tenant Percentage Coverage:', labeler.tenant_energy_label.coverage],
+                       ['Labeled Subscriptions Measured:',
+                        labeler.labeled_subscriptions_energy_label.subscriptions_measured]]
+        if labeler.tenant_energy_label.best_label != labeler.tenant_energy_label.worst_label:
+            report_data.extend([['Best Subscription Security Score:', labeler.tenant_energy_label.best_label],
+                                ['Worst Subscription Security Score:', labeler.tenant_energy_label.worst_label]])
+        from azureenergylabelerlib import (ALL_TENANT_EXPORT_TYPES,  # pylint: disable=import-outside-toplevel
+                                           TENANT_METRIC_EXPORT_TYPES)
+        export_types = ALL_TENANT_EXPORT_TYPES if export_all_data_flag else TENANT_METRIC_EXPORT_TYPES
+        exporter_arguments = {'export_types': export_types,
+                              'id': tenant_id,
+                              'energy_label': labeler.tenant_energy_label.label,
+                              'defender_for_cloud_findings': labeler.filtered_defender_for_cloud_findings,
+                              'labeled_subscriptions': labeler.tenant_labeled_subscriptions,
+                              'credentials': labeler.tenant_credentials}
     return report_data, exporter_arguments
 
 
@@ -327,7 +757,14 @@ def get_subscription_reporting_data(  # pylint: disable=too-many-arguments,too-m
         export_all_data_flag,
         frameworks,
         log_level,
-        disable_spinner):
+        disable_spinner,
+        findings_cache=None,
+        findings_snapshot=None,
+        max_workers=1,
+        retrieval_engine='threads',
+        incremental_state=None,
+        credentials=None,
+        shared_findings=None):
     """Gets the reporting data for a single account.
 
     Args:
@@ -337,30 +774,116 @@ def get_subscription_reporting_data(  # pylint: disable=too-many-arguments,too-m
         frameworks: The frameworks to include in scoring.
         log_level: The log level set.
         disable_spinner: The spinner will be disabled while retrieving the findings.
+        findings_cache: A findings cache to retrieve the findings through, if any.
+        findings_snapshot: A findings snapshot to label offline instead of retrieving the findings, if any.
+        max_workers: The number of subscriptions to retrieve the findings of concurrently.
+        retrieval_engine: Either threads or asyncio, the engine retrieving the findings concurrently.
+        incremental_state: An incremental state to only retrieve the findings changed since the last run, if any.
+        credentials: The Azure credential to authenticate with, defaults to the default Azure credential.
+        shared_findings: Findings shared with the labelers of concurrent jobs, if any.
 
 
     Returns:
         report_data, exporter_arguments
 
     """
-    _allowed_subscription_ids = []
-    _allowed_subscription_ids.append(subscription_id)
-    labeler = AzureEnergyLabeler(tenant_id=tenant_id,
-                                 tenant_thresholds=TENANT_THRESHOLDS,
-                                 resource_group_thresholds=RESOURCE_GROUP_THRESHOLDS,
-                                 subscription_thresholds=SUBSCRIPTION_THRESHOLDS,
-                                 frameworks=frameworks,
-                                 allowed_subscription_ids=_allowed_subscription_ids)
-    tenant = labeler.tenant
-    defender_for_cloud_findings = wait_for_findings(AzureEnergyLabeler.filtered_defender_for_cloud_findings.fget,
+    labeler = get_labeler(tenant_id,
+                          frameworks,
+                          allowed_subscription_ids=[subscription_id],
+                          scoped=True,
+                          findings_cache=findings_cache,
+                          findings_snapshot=findings_snapshot,
+                          max_workers=max_workers,
+                          retrieval_engine=retrieval_engine,
+                          incremental_state=incremental_state,
+                          credentials=credentials,
+                          shared_findings=shared_findings)
+    defender_for_cloud_findings = wait_for_findings(attrgetter('filtered_defender_for_cloud_findings'),
+                                                    labeler,
+                                                    log_level,
+                                                    disable_spinner=disable_spinner)
+    with profile_phase('labels'):
+        filtered_findings = IndexedFindings(defender_for_cloud_findings.get_subscription_findings(subscription_id))
+        subscription = labeler.tenant.get_subscription(subscription_id)
+        energy_label = subscription.get_energy_label(filtered_findings)
+        return _get_labeled_subscription_reporting_data(subscription,
+                                                        energy_label,
+                                                        filtered_findings,
+                                                        export_all_data_flag,
+                                                        labeler.tenant_credentials)
+
+
+def get_subscriptions_reporting_data(  # pylint: disable=too-many-arguments,too-many-locals
+        tenant_id,
+        subscription_ids,
+        export_all_data_flag,
+        frameworks,
+        log_level,
+        disable_spinner,
+        findings_cache=None,
+        findings_snapshot=None,
+        max_workers=1,
+        retrieval_engine='threads',
+        incremental_state=None,
+        credentials=None,
+        shared_findings=None):
+    """Gets the reporting data for multiple subscriptions individually, retrieving the findings only once.
+
+    Args:
+        tenant_id: Tenant Id of the tenant
+        subscription_ids: The IDs of the subscriptions to get reporting on, if empty all tenant subscriptions.
+        export_all_data_flag: If set all data is going to be exported, else only basic reporting.
+        frameworks: The frameworks to include in scoring.
+        log_level: The log level set.
+        disable_spinner: The spinner will be disabled while retrieving the findings.
+        findings_cache: A findings cache to retrieve the findings through, if any.
+        findings_snapshot: A findings snapshot to label offline instead of retrieving the findings, if any.
+        max_workers: The number of subscriptions to retrieve the findings of concurrently.
+        retrieval_engine: Either threads or asyncio, the engine retrieving the findings concurrently.
+        incremental_state: An incremental state to only retrieve the findings changed since the last run, if any.
+        credentials: The Azure credential to authenticate with, defaults to the default Azure credential.
+        shared_findings: Findings shared with the labelers of concurrent jobs, if any.
+
+
+    Returns:
+        A list of subscription_id, report_data, exporter_arguments tuples, one per subscription.
+
+    """
+    labeler = get_labeler(tenant_id,
+                          frameworks,
+                          allowed_subscription_ids=subscription_ids,
+                          scoped=True,
+                          findings_cache=findings_cache,
+                          findings_snapshot=findings_snapshot,
+                          max_workers=max_workers,
+                          retrieval_engine=retrieval_engine,
+                          incremental_state=incremental_state,
+                          credentials=credentials,
+                          shared_findings=shared_findings)
+    defender_for_cloud_findings = wait_for_findings(attrgetter('filtered_defender_for_cloud_findings'),
                                                     labeler,
                                                     log_level,
                                                     disable_spinner=disable_spinner)
-    filtered_findings = [finding for finding in defender_for_cloud_findings
-                         if finding.subscription_id == subscription_id]
-    subscription = next(
-        subscription for subscription in tenant.subscriptions if subscription.subscription_id == subscription_id)
-    energy_label = subscription.get_energy_label(defender_for_cloud_findings)
+    with profile_phase('labels'):
+        reporting_data = []
+        for subscription in labeler.tenant.subscriptions_to_be_labeled:
+            filtered_findings = IndexedFindings(
+                defender_for_cloud_findings.get_subscription_findings(subscription.subscription_id))
+            energy_label = subscription.get_energy_label(filtered_findings)
+            report_data, exporter_arguments = _get_labeled_subscription_reporting_data(subscription,
+                                                                                       energy_label,
+                                                                                       filtered_findings,
+                                                                                       export_all_data_flag,
+                                                                                       labeler.tenant_credentials)
+            reporting_data.append((subscription.subscription_id, report_data, exporter_arguments))
+    return reporting_data
+
+
+def _get_labeled_subscription_reporting_data(subscription,
+                                             energy_label,
+                                             defender_for_cloud_findings,
+                                             export_all_data_flag,
+                                             credentials):
     report_data = [['Subscription ID:', subscription.subscription_id],
                    ['Subscription Security Score:', energy_label.label],
                    ['Number Of High Findings:', energy_label.number_of_high_findings],
@@ -369,11 +892,13 @@ def get_subscription_reporting_data(  # pylint: disable=too-many-arguments,too-m
                    ['Max Days Open:', energy_label.max_days_open]]
     if subscription.display_name:
         report_data.insert(0, ['Subscription Display Name:', subscription.display_name])
+    from azureenergylabelerlib import (ALL_SUBSCRIPTION_EXPORT_DATA,  # pylint: disable=import-outside-toplevel
+                                       SUBSCRIPTION_METRIC_EXPORT_TYPES)
     export_types = ALL_SUBSCRIPTION_EXPORT_DATA if export_all_data_flag else SUBSCRIPTION_METRIC_EXPORT_TYPES
     exporter_arguments = {'export_types': export_types,
                           'id': subscription.subscription_id,
                           'energy_label': energy_label.label,
-                          'defender_for_cloud_findings': filtered_findings,
+                          'defender_for_cloud_findings': defender_for_cloud_findings,
                           'labeled_subscriptions': [subscription],
-                          'credentials': labeler.tenant_credentials}
+                          'credentials': credentials}
     return report_data, exporter_arguments
@@ -48,3 +48,35 @@ class MutuallyExclusiveArguments(Exception):
 
 class MissingRequiredArguments(Exception):
     """Missing a required argument."""
+
+
+class InvalidFindingsSnapshot(Exception):
+    """The findings snapshot provided can not be loaded."""
+
+
+class AsyncRetrievalUnavailable(Exception):
+    """The dependencies of the asyncio retrieval engine are not installed."""
+
+
+class CompressionUnavailable(Exception):
+    """The dependencies of the requested compression are not installed."""
+
+
+class ParquetExportUnavailable(Exception):
+    """The dependencies of the parquet export are not installed."""
+
+
+class InvalidJobsFile(Exception):
+    """The jobs file provided can not be loaded."""
+
+
+class YamlJobsFileUnavailable(Exception):
+    """The dependencies of reading yaml jobs files are not installed."""
+
+
+class TokenCacheUnavailable(Exception):
+    """The dependencies of the encrypted token cache are not installed."""
+
+
+class ExportFailed(Exception):
+    """Exporting the data failed."""
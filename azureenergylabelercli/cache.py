@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: cache.py
+#
+# Copyright 2022 Sayantan Khanra
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Persistent findings cache for azureenergylabelercli.
+
+.. _Google Python Style Guide:
+   https://google.github.io/styleguide/pyguide.html
+
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+    import msvcrt
+else:
+    msvcrt = None  # pylint: disable=invalid-name
+
+__author__ = '''Sayantan Khanra <skhanra@schubergphilis.com>'''
+__docformat__ = '''google'''
+__date__ = '''04-05-2022'''
+__copyright__ = '''Copyright 2022, Sayantan Khanra'''
+__credits__ = ["Sayantan Khanra"]
+__license__ = '''MIT'''
+__maintainer__ = '''Sayantan Khanra'''
+__email__ = '''<skhanra@schubergphilis.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''cache'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+DEFAULT_CACHE_TTL = 3600
+DEFAULT_CACHE_MAX_SIZE = 512
+
+
+@contextmanager
+def file_lock(path):
+    """Holds an exclusive lock on the provided file, blocking until it can be acquired.
+
+    Args:
+        path: The path of the lock file, created if missing.
+
+    """
+    with open(path, 'a+b') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        else:  # pragma: no cover
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            else:  # pragma: no cover
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class FindingsCache:
+    """Caches raw defender for cloud findings on disk, shared between invocations on the same host.
+
+    Entries expire after the ttl and the least recently used entries are evicted once the size of the cache
+    exceeds its maximum size. All access goes through a lock file so parallel invocations can share the directory.
+
+    """
+
+    def __init__(self, directory, ttl=DEFAULT_CACHE_TTL, max_size=DEFAULT_CACHE_MAX_SIZE):
+        """Initializes the cache.
+
+        Args:
+            directory: The directory to keep the cache in, created if missing.
+            ttl: The number of seconds an entry is valid for.
+            max_size: The maximum size of the cache in megabytes.
+
+        """
+        self._logger = logging.getLogger(f'{LOGGER_BASENAME}.{self.__class__.__name__}')
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_size = max_size * 1024 * 1024
+        self._lock_path = self.directory.joinpath('.lock')
+
+    @staticmethod
+    def get_key(**arguments):
+        """Calculates a stable key out of the provided arguments, ignoring the order of any lists."""
+        normalized = {name: sorted(value) if isinstance(value, (list, tuple, set)) else value
+                      for name, value in arguments.items()}
+        return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _get_path(self, key):
+        return self.directory.joinpath(f'{key}.json')
+
+    def get(self, key):
+        """Retrieves the findings data of a key.
+
+        Args:
+            key: The key of the entry as calculated by get_key.
+
+        Returns:
+            The list of findings data if there is a valid entry, None otherwise.
+
+        """
+        path = self._get_path(key)
+        with file_lock(self._lock_path):
+            try:
+                with open(path, encoding='utf-8') as cache_file:
+                    entry = json.load(cache_file)
+            except (OSError, ValueError):
+                self._logger.debug(f'No valid cache entry for key {key}.')
+                return None
+            if time.time() - entry.get('created', 0) > self.ttl:
+                self._logger.debug(f'Cache entry for key {key} has expired.')
+                path.unlink(missing_ok=True)
+                return None
+            os.utime(path)
+        self._logger.info(f'Using cached findings for key {key}.')
+        return entry.get('findings')
+
+    def set(self, key, findings):
+        """Stores the findings data of a key evicting the least recently used entries if needed.
+
+        Args:
+            key: The key of the entry as calculated by get_key.
+            findings: A list of json serializable findings data.
+
+        """
+        data = json.dumps({'created': time.time(), 'findings': findings}, default=str).encode('utf-8')
+        if len(data) > self.max_size:
+            self._logger.warning(f'Findings of size {len(data)} bytes exceed the cache size, not caching them.')
+            return
+        with file_lock(self._lock_path):
+            with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False) as temporary_file:
+                temporary_file.write(data)
+            os.replace(temporary_file.name, self._get_path(key))
+            self._evict()
+        self._logger.debug(f'Cached findings for key {key}.')
+
+    def _evict(self):
+        entries = sorted((entry.stat().st_mtime, entry.stat().st_size, entry)
+                         for entry in self.directory.glob('*.json'))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total_size <= self.max_size:
+                break
+            self._logger.debug(f'Evicting least recently used cache entry {entry.name}.')
+            entry.unlink(missing_ok=True)
+            total_size -= size
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: columnar.py
+#
+# Copyright 2022 Sayantan Khanra
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+
+"""
+Columnar parquet exports for azureenergylabelercli.
+
+The findings and labeled subscriptions are written with a typed schema, repetitive string columns dictionary
+encoded, in row groups so the findings are never all converted at once. Requires pyarrow, installed with
+"pip install azureenergylabelercli[parquet]".
+
+.. _Google Python Style Guide:
+   https://google.github.io/styleguide/pyguide.html
+
+"""
+
+import logging
+from itertools import islice
+from pathlib import Path
+
+from .azureenergylabelercliexceptions import ParquetExportUnavailable
+from .snapshot import EXPORTED_FINDING_KEYS, get_export_filename
+from .streaming import get_exported_finding
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+__author__ = '''Sayantan Khanra <skhanra@schubergphilis.com>'''
+__docformat__ = '''google'''
+__date__ = '''04-05-2022'''
+__copyright__ = '''Copyright 2022, Sayantan Khanra'''
+__credits__ = ["Sayantan Khanra"]
+__license__ = '''MIT'''
+__maintainer__ = '''Sayantan Khanra'''
+__email__ = '''<skhanra@schubergphilis.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''columnar'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+COLUMNAR_EXPORT_TYPES = ('findings', 'labeled_subscriptions', 'subscription_energy_label')
+
+PARQUET_ROW_GROUP_SIZE = 10000
+
+UNIQUE_FINDING_COLUMNS = frozenset({'Resource Name', 'Resource ID', 'Recommendation ID'})
+
+LABELED_SUBSCRIPTION_COLUMNS = {'Subscription ID': 'string',
+                                'Subscription Display Name': 'string',
+                                'Number of high findings': 'int64',
+                                'Number of medium findings': 'int64',
+                                'Number of low findings': 'int64',
+                                'Number of exempted findings': 'int64',
+                                'Number of maximum days open': 'int64',
+                                'Energy Label': 'dictionary'}
+
+
+def _get_pyarrow():
+    if pyarrow is None:
+        raise ParquetExportUnavailable('The parquet export requires pyarrow, install it with "pip install pyarrow".')
+    return pyarrow
+
+
+def _get_type(column_type):
+    if column_type == 'dictionary':
+        return pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    return getattr(pyarrow, column_type)()
+
+
+def get_findings_schema():
+    """The schema of the findings export, every column but the unique ones dictionary encoded."""
+    columns = {key: 'string' if key in UNIQUE_FINDING_COLUMNS else 'dictionary' for key in EXPORTED_FINDING_KEYS}
+    columns['Days Open'] = 'int64'
+    _get_pyarrow()
+    return pyarrow.schema([(name, _get_type(column_type)) for name, column_type in columns.items()])
+
+
+def get_labeled_subscriptions_schema():
+    """The schema of the labeled subscriptions export."""
+    _get_pyarrow()
+    return pyarrow.schema([(name, _get_type(column_type))
+                           for name, column_type in LABELED_SUBSCRIPTION_COLUMNS.items()])
+
+
+def get_parquet_filename(export_type):
+    """Gets the filename of the parquet export of an export type, the one of the DataExporter suffixed .parquet."""
+    return str(Path(get_export_filename(export_type)).with_suffix('.parquet'))
+
+
+def _to_column_value(value, column_type):
+    if value is None or pyarrow.types.is_integer(column_type):
+        return value
+    return value if isinstance(value, str) else str(value)
+
+
+def write_parquet(rows, schema, binary_file, compression='none', level=None):
+    """Writes rows to a parquet file one row group at a time.
+
+    Args:
+        rows: An iterable of dictionaries with the columns of the schema.
+        schema: The schema of the file.
+        binary_file: The binary file to write to.
+        compression: One of none, gzip or zstd, applied to the columns of the file.
+        level: The compression level, the default level of the compression if not provided.
+
+    """
+    _get_pyarrow()
+    rows = iter(rows)
+    with pyarrow.parquet.ParquetWriter(binary_file,
+                                       schema,
+                                       compression=compression,
+                                       compression_level=level if compression != 'none' else None) as writer:
+        while True:
+            row_group = list(islice(rows, PARQUET_ROW_GROUP_SIZE))
+            if not row_group:
+                break
+            columns = [pyarrow.array([_to_column_value(row.get(field.name), field.type) for row in row_group],
+                                     type=field.type)
+                       for field in schema]
+            writer.write_table(pyarrow.Table.from_arrays(columns, schema=schema))
+
+
+def write_findings_parquet(findings, binary_file, compression='none', level=None):
+    """Writes the findings export as parquet, skipped findings are not written like in the json export."""
+    write_parquet((get_exported_finding(finding) for finding in findings if not finding.is_skipped),
+                  get_findings_schema(),
+                  binary_file,
+                  compression,
+                  level)
+
+
+def write_labeled_subscriptions_parquet(labeled_subscriptions, binary_file, compression='none', level=None):
+    """Writes the data of the labeled subscriptions as exported in json as parquet."""
+    write_parquet(labeled_subscriptions, get_labeled_subscriptions_schema(), binary_file, compression, level)
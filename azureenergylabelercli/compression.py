@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: compression.py
+#
+# Copyright 2022 Sayantan Khanra
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+
+"""
+Compression of exported files for azureenergylabelercli.
+
+Files are compressed as they are written, so the payload is never held in memory as a whole. zstd requires the
+zstandard package, installed with "pip install azureenergylabelercli[zstd]".
+
+.. _Google Python Style Guide:
+   https://google.github.io/styleguide/pyguide.html
+
+"""
+
+import gzip
+import io
+import logging
+from contextlib import contextmanager
+from pathlib import Path
+
+from .azureenergylabelercliexceptions import CompressionUnavailable
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__author__ = '''Sayantan Khanra <skhanra@schubergphilis.com>'''
+__docformat__ = '''google'''
+__date__ = '''04-05-2022'''
+__copyright__ = '''Copyright 2022, Sayantan Khanra'''
+__credits__ = ["Sayantan Khanra"]
+__license__ = '''MIT'''
+__maintainer__ = '''Sayantan Khanra'''
+__email__ = '''<skhanra@schubergphilis.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''compression'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+COMPRESSION_SUFFIXES = {'none': '',
+                        'gzip': '.gz',
+                        'zstd': '.zst'}
+
+DEFAULT_COMPRESSION_LEVELS = {'gzip': 6,
+                              'zstd': 3}
+
+
+def get_compressed_filename(filename, compression='none'):
+    """Gets the filename of a file compressed with a compression, suffixed like .json.gz or .json.zst."""
+    return f'{filename}{COMPRESSION_SUFFIXES[compression]}'
+
+
+def get_compression(path):
+    """Gets the compression of a file from its suffix, none if it is not compressed."""
+    return next((compression for compression, suffix in COMPRESSION_SUFFIXES.items()
+                 if suffix and Path(path).suffix == suffix), 'none')
+
+
+def _get_zstandard():
+    if zstandard is None:
+        raise CompressionUnavailable('zstd compression requires zstandard, '
+                                     'install it with "pip install zstandard".')
+    return zstandard
+
+
+@contextmanager
+def compressed_writer(binary_file, compression='none', level=None):
+    """Provides a text file writing compressed utf-8 to a binary file as it is written to.
+
+    The binary file is left open, gzip output does not contain a timestamp so the same data always compresses to
+    the same bytes.
+
+    Args:
+        binary_file: The binary file to write the compressed data to.
+        compression: One of none, gzip or zstd.
+        level: The compression level, the default level of the compression if not provided.
+
+    Returns:
+        A text file to write to.
+
+    """
+    level = level or DEFAULT_COMPRESSION_LEVELS.get(compression)
+    if compression == 'gzip':
+        stream = gzip.GzipFile(fileobj=binary_file, mode='wb', compresslevel=level, mtime=0)
+    elif compression == 'zstd':
+        stream = _get_zstandard().ZstdCompressor(level=level).stream_writer(binary_file, closefd=False)
+    else:
+        stream = binary_file
+    text_file = io.TextIOWrapper(stream, encoding='utf-8')
+    try:
+        yield text_file
+    finally:
+        text_file.flush()
+        text_file.detach()
+        if stream is not binary_file:
+            stream.close()
+
+
+def open_decompressed(path):
+    """Opens a file for reading as utf-8 text, decompressing it according to its suffix."""
+    compression = get_compression(path)
+    if compression == 'gzip':
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if compression == 'zstd':
+        return _get_zstandard().open(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8')  # pylint: disable=consider-using-with
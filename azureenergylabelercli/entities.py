@@ -0,0 +1,807 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: entities.py
+#
+# Copyright 2022 Sayantan Khanra
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Entities extending azureenergylabelerlib for the needs of the cli.
+
+.. _Google Python Style Guide:
+   https://google.github.io/styleguide/pyguide.html
+
+"""
+
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from operator import attrgetter
+from pathlib import Path
+from types import SimpleNamespace
+from urllib.parse import urlparse, urlunparse
+
+import requests
+from azure.core.exceptions import ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport  # pylint: disable=no-name-in-module
+from azure.mgmt.resourcegraph import ResourceGraphClient
+from azure.storage.blob import BlobServiceClient
+from azureenergylabelerlib import (AzureEnergyLabeler as BaseAzureEnergyLabeler,
+                                   DataExporter as BaseDataExporter,
+                                   DestinationPath as BaseDestinationPath,
+                                   TENANT_THRESHOLDS,
+                                   SUBSCRIPTION_THRESHOLDS,
+                                   RESOURCE_GROUP_THRESHOLDS)
+from azureenergylabelerlib.azureenergylabelerlibexceptions import InvalidPath
+from azureenergylabelerlib.configuration import DEFAULT_DEFENDER_FOR_CLOUD_FRAMEWORKS, FINDING_FILTERING_STATES
+from azureenergylabelerlib.datamodels import LabeledSubscriptionData
+from azureenergylabelerlib.entities import DataFileFactory, DefenderForCloud, ResourceGroup, Subscription, Tenant
+from azureenergylabelerlib.labels import ResourceGroupEnergyLabel, SubscriptionEnergyLabel
+from azureenergylabelerlib.schemas import (resource_group_thresholds_schema,
+                                           subscription_thresholds_schema,
+                                           tenant_thresholds_schema)
+from azureenergylabelerlib.validations import validate_resource_group_names
+
+from .asyncretrieval import AsyncFindingsRetriever
+from .azureenergylabelercliexceptions import ExportFailed
+from .cache import FindingsCache
+from .columnar import (COLUMNAR_EXPORT_TYPES,
+                       get_parquet_filename,
+                       write_findings_parquet,
+                       write_labeled_subscriptions_parquet)
+from .compression import compressed_writer, get_compressed_filename
+from .incremental import WATERMARK_MARGIN, iter_changed_recommendation_ids, merge_findings
+from .manifest import CONTENT_HASH_METADATA_KEY, ExportManifest, get_content_hash
+from .profiling import profile_phase
+from .records import CompactFinding, IndexedFindings
+from .streaming import (DEFAULT_STREAM_BUFFER_SIZE,
+                        FINDINGS_EXPORT_WRITERS,
+                        StreamedFindings,
+                        buffered,
+                        get_findings_export_filename,
+                        iter_findings_pages)
+from .validators import EMULATOR_HOSTNAMES
+
+__author__ = '''Sayantan Khanra <skhanra@schubergphilis.com>'''
+__docformat__ = '''google'''
+__date__ = '''04-05-2022'''
+__copyright__ = '''Copyright 2022, Sayantan Khanra'''
+__credits__ = ["Sayantan Khanra"]
+__license__ = '''MIT'''
+__maintainer__ = '''Sayantan Khanra'''
+__email__ = '''<skhanra@schubergphilis.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''entities'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+DEFAULT_UPLOAD_BLOCK_SIZE = 4 * 1024 * 1024
+DEFAULT_UPLOAD_CONCURRENCY = 4
+
+class DestinationPath(BaseDestinationPath):
+    """Models a destination path also accepting the path style urls of a local storage emulator like Azurite.
+
+    Emulator urls hold the account name in their path, like http://127.0.0.1:10000/devstoreaccount1/container/.
+
+    """
+
+    def __init__(self, location):
+        super().__init__(location)
+        self._blob_conditions[0] = self._blob_conditions[0] or self.is_emulator
+
+    @property
+    def is_emulator(self):
+        """The path is the path style url of a local storage emulator."""
+        return self._parsed_url.scheme in ('http', 'https') and self._parsed_url.hostname in EMULATOR_HOSTNAMES
+
+
+def parse_blob_url(blob_url):
+    """Parses a Storage Account Container url into its account url, container and prefix.
+
+    Args:
+        blob_url: The url of the container with an optional prefix and SAS token.
+
+    Returns:
+        The account url including any SAS token, the container name and the list of the parts of the prefix.
+
+    """
+    parsed_url = urlparse(blob_url)
+    parts = [part for part in parsed_url.path.split('/') if part]
+    account_path = f'/{parts.pop(0)}' if DestinationPath(blob_url).is_emulator else '/'
+    container, *prefix = parts
+    return urlunparse(parsed_url._replace(path=account_path, params='', fragment='')), container, prefix
+
+
+class BlobServiceClients:
+    """Blob service clients shared by exports, one per account, all uploads going over a single connection pool.
+
+    Files larger than the block size are uploaded in blocks of that size, up to the upload concurrency of an export
+    at a time, so the pool holds as many connections as the exports and their blocks uploaded at once.
+
+    """
+
+    def __init__(self, block_size=DEFAULT_UPLOAD_BLOCK_SIZE, max_connections=DEFAULT_UPLOAD_CONCURRENCY):
+        """Initializes the clients.
+
+        Args:
+            block_size: The size in bytes of the blocks large files are uploaded in.
+            max_connections: The maximum number of connections kept open in the pool.
+
+        """
+        self.block_size = block_size
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, account_url, credential=None):
+        """Gets the client of an account, created on first use.
+
+        Args:
+            account_url: The url of the account including any SAS token.
+            credential: The credential to authenticate with if there is no SAS token.
+
+        Returns:
+            The blob service client of the account.
+
+        """
+        key = (account_url, id(credential))
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = BlobServiceClient(account_url=account_url,
+                                                       credential=credential,
+                                                       max_block_size=self.block_size,
+                                                       max_single_put_size=self.block_size,
+                                                       transport=RequestsTransport(session=self._session,
+                                                                                   session_owner=False))
+            return self._clients[key]
+
+    def close(self):
+        """Closes the connections of the pool."""
+        self._session.close()
+
+
+def get_export_sub_path(path, name):
+    """Appends a directory to an export path, be it a local directory or a Storage Account Container url.
+
+    Args:
+        path: The local directory or Storage Account Container url to extend.
+        name: The name of the directory to append.
+
+    Returns:
+        The extended path. For Storage Account Container urls any SAS token is retained.
+
+    """
+    if DestinationPath(path).type == 'local':
+        return os.path.join(path, name)
+    parsed_url = urlparse(path)
+    return urlunparse(parsed_url._replace(path=f'{parsed_url.path.rstrip("/")}/{name}/'))
+
+
+class DataExporter(BaseDataExporter):  # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    """Export Azure security data supporting nested local directories, blob prefixes and streamed findings.
+
+    Every file is written as it is serialized, compressed on the fly if requested, locally or to a temporary file
+    uploaded to blob storage. The findings are written one at a time, either as the json document of the library or
+    as newline delimited json. With the parquet export format the findings and labeled subscriptions are written as
+    parquet files instead, compressed within the file. Blobs are uploaded in parallel blocks over the connection pool
+    of the blob service clients, which can be shared between exporters. With more than one worker the export types
+    are serialized and written concurrently, each to its own file, so the files are identical to the ones of a
+    sequential export. When skipping unchanged files, a file whose content hash is the one recorded for its
+    destination, in the manifest of the directory or the metadata of the blob, is neither replaced nor uploaded.
+
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 *args,
+                 max_workers=1,
+                 findings_format='json',
+                 compression='none',
+                 compression_level=None,
+                 export_format='json',
+                 upload_concurrency=DEFAULT_UPLOAD_CONCURRENCY,
+                 blob_service_clients=None,
+                 skip_unchanged=False,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.skip_unchanged = skip_unchanged
+        self.export_format = export_format
+        self.upload_concurrency = upload_concurrency
+        self._blob_service_clients = blob_service_clients or BlobServiceClients(
+            max_connections=upload_concurrency * max_workers)
+        self.max_workers = max_workers
+        self.findings_format = findings_format
+        self.compression = compression
+        self.compression_level = compression_level
+
+    @profile_phase('export')
+    def export(self, path):
+        """Exports the data to the provided path, writing the findings incrementally.
+
+        Args:
+            path: The local directory or Storage Account Container url to export to.
+
+        Raises:
+            ExportFailed: If any file could not be uploaded, after attempting all the others.
+
+        Returns:
+            A dictionary of the number of seconds it took to export each file by filename.
+
+        """
+        destination = DestinationPath(path)
+        if not destination.is_valid():
+            raise InvalidPath(path)
+        manifest = ExportManifest(path) if self.skip_unchanged and destination.type != 'blob' else None
+        export_type = partial(self._attempt_export_type, destination.type, path, manifest)
+        if self.max_workers > 1 and len(self.export_types) > 1:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                results = list(executor.map(export_type, self.export_types))
+        else:
+            results = list(map(export_type, self.export_types))
+        if manifest is not None:
+            manifest.save()
+        failures = [str(error) for _, error in results if error]
+        if failures:
+            raise ExportFailed('; '.join(failures))
+        return dict(result for result, _ in results)
+
+    def _attempt_export_type(self, destination_type, path, manifest, export_type):
+        """Exports the file of an export type, returning its filename and duration or the error of its upload."""
+        try:
+            return self._export_type(destination_type, path, manifest, export_type), None
+        except ExportFailed as error:
+            return None, error
+
+    def _export_type(self, destination_type, path, manifest, export_type):
+        """Exports the file of an export type, returning its filename and the number of seconds it took."""
+        start = time.perf_counter()
+        if self.export_format == 'parquet' and export_type in COLUMNAR_EXPORT_TYPES:
+            filename = get_parquet_filename(export_type)
+            write = partial(self._write_parquet, export_type)
+        elif export_type == 'findings':
+            filename = get_compressed_filename(get_findings_export_filename(self.findings_format), self.compression)
+            write = partial(self._write_compressed,
+                            partial(FINDINGS_EXPORT_WRITERS[self.findings_format], self.defender_for_cloud_findings))
+        else:
+            data_file = DataFileFactory(export_type,
+                                        self._id,
+                                        self.energy_label,
+                                        self.defender_for_cloud_findings,
+                                        self.labeled_subscriptions)
+            filename = get_compressed_filename(data_file.filename, self.compression)  # pylint: disable=no-member
+            write = partial(self._write_compressed, partial(self._write_data_file, data_file))
+        if destination_type == 'blob':
+            with tempfile.TemporaryFile() as temporary_file:
+                write(temporary_file)
+                temporary_file.seek(0)
+                content_hash = get_content_hash(temporary_file) if self.skip_unchanged else None
+                self._export_to_blob(path, filename, temporary_file, content_hash)
+        else:
+            self._export_to_fs(path, filename, manifest=manifest, write=write)
+        duration = time.perf_counter() - start
+        self._logger.info(f'Exported {filename} in {duration:.3f} seconds.')
+        return filename, duration
+
+    @staticmethod
+    def _write_data_file(data_file, output_file):
+        output_file.write(data_file.json)
+
+    @staticmethod
+    def _write_text(data, binary_file):
+        binary_file.write(data.encode('utf-8'))
+
+    def _write_compressed(self, write, binary_file):
+        """Writes text to a binary file compressed as requested."""
+        with compressed_writer(binary_file, self.compression, self.compression_level) as output_file:
+            write(output_file)
+
+    def _write_parquet(self, export_type, binary_file):
+        """Writes the findings or labeled subscriptions to a binary file as parquet, its columns compressed."""
+        if export_type == 'findings':
+            write_findings_parquet(self.defender_for_cloud_findings,
+                                   binary_file,
+                                   self.compression,
+                                   self.compression_level)
+            return
+        write_labeled_subscriptions_parquet([LabeledSubscriptionData(None,
+                                                                     subscription,
+                                                                     self.defender_for_cloud_findings).data
+                                             for subscription in self.labeled_subscriptions],
+                                            binary_file,
+                                            self.compression,
+                                            self.compression_level)
+
+    def _export_to_fs(self, directory, filename, data=None, manifest=None, write=None):
+        """Exports to local filesystem creating any missing parent directories.
+
+        Args:
+            directory: The directory to export to.
+            filename: The name of the file to write.
+            data: The json text to write, if no write callable is provided.
+            manifest: If provided the file is written next to its destination and only replaces it if its content
+                hash differs from the one in the manifest.
+            write: A callable writing the data to the binary file it is provided, instead of the json text.
+
+        """
+        if write is None:
+            write = partial(self._write_text, data)
+        path = Path(directory)
+        path.mkdir(parents=True, exist_ok=True)
+        if manifest is None:
+            with open(path.joinpath(filename), 'wb') as export_file:
+                write(export_file)
+            self._logger.info(f'File {filename} copied to {directory}')
+            return
+        with tempfile.NamedTemporaryFile(dir=path, suffix='.tmp', delete=False) as temporary_file:
+            write(temporary_file)
+            content_hash = get_content_hash(temporary_file)
+            size = temporary_file.seek(0, os.SEEK_END)
+        if manifest.is_unchanged(filename, content_hash):
+            os.remove(temporary_file.name)
+            self._logger.info(f'File {filename} in {directory} is unchanged, skipped')
+            return
+        os.replace(temporary_file.name, path.joinpath(filename))
+        manifest.update(filename, content_hash, size)
+        self._logger.info(f'File {filename} copied to {directory}')
+
+    @staticmethod
+    def _get_blob_content_hash(blob_client):
+        """The content hash in the metadata of a blob, None if the blob or its hash does not exist."""
+        try:
+            return blob_client.get_blob_properties().metadata.get(CONTENT_HASH_METADATA_KEY)
+        except ResourceNotFoundError:
+            return None
+
+    def _export_to_blob(self, blob_url, filename, data, content_hash=None):
+        """Exports as json to Blob container object storage under the prefix of the url path if any.
+
+        The data is either a string or a binary file to upload, files larger than the block size are uploaded in
+        blocks, up to the upload concurrency at a time. If a content hash is provided the upload is skipped when the
+        blob already has it, else it is stored in the metadata of the uploaded blob. A failed upload is logged and
+        raised as ExportFailed.
+
+        """
+        account_url, container, prefix = parse_blob_url(blob_url)
+        # If SAS Token is included in the URL, ommit credential parameter
+        credential = None if urlparse(blob_url).query else self._credentials
+        blob_service_client = self._blob_service_clients.get(account_url, credential)
+        blob_name = '/'.join(prefix + [filename])
+        blob_client = blob_service_client.get_blob_client(container=container, blob=blob_name)
+        message = f'Export {blob_name} to blob {blob_url}'
+        try:
+            if content_hash and self._get_blob_content_hash(blob_client) == content_hash:
+                self._logger.info(f'{message} skipped, the blob is unchanged')
+                return
+            blob_client.upload_blob(data.encode('utf-8') if isinstance(data, str) else data,
+                                    overwrite=True,
+                                    max_concurrency=self.upload_concurrency,
+                                    metadata={CONTENT_HASH_METADATA_KEY: content_hash} if content_hash else None)
+            self._logger.info(f'{message} success')
+        except Exception as error:  # pylint: disable=broad-except
+            self._logger.exception(f'{message} failure')
+            raise ExportFailed(f'{message} failed: {error}') from error
+
+
+class IndexedResourceGroup(ResourceGroup):
+    """Resource group labeling itself out of indexed or streamed findings without scanning all findings."""
+
+    def get_energy_label(self, findings, states=FINDING_FILTERING_STATES):
+        """Calculates the energy label for the resource group.
+
+        Args:
+            findings: Either a list of defender for cloud findings, indexed findings or streamed findings.
+            states: The states to filter findings out for.
+
+        Returns:
+            The energy label of the resource group based on the provided configuration.
+
+        """
+        if isinstance(findings, StreamedFindings):
+            return findings.get_resource_group_summary(self.name).get_energy_label(self._threshold,
+                                                                                   ResourceGroupEnergyLabel)
+        if isinstance(findings, IndexedFindings):
+            findings = findings.get_resource_group_findings(self.name)
+        return super().get_energy_label(findings, states)
+
+
+class IndexedSubscription(Subscription):
+    """Subscription labeling itself and its resource groups out of indexed or streamed findings."""
+
+    @property
+    def resource_groups(self):
+        """Resource groups of this subscription."""
+        return [IndexedResourceGroup(resource_group._data)  # pylint: disable=protected-access
+                for resource_group in super().resource_groups]
+
+    def get_energy_label(self, findings, states=FINDING_FILTERING_STATES):
+        """Calculates the energy label for the subscription.
+
+        Args:
+            findings: Either a list of defender for cloud findings, indexed findings or streamed findings.
+            states: The states to filter findings out for.
+
+        Returns:
+            The energy label of the subscription based on the provided configuration.
+
+        """
+        if isinstance(findings, StreamedFindings):
+            return findings.get_subscription_summary(self.subscription_id).get_energy_label(self._threshold,
+                                                                                            SubscriptionEnergyLabel)
+        if isinstance(findings, IndexedFindings):
+            findings = findings.get_subscription_findings(self.subscription_id)
+        return super().get_energy_label(findings, states)
+
+
+class IndexedTenant(Tenant):
+    """Tenant of already known subscriptions, indexed by their id."""
+
+    def __init__(self, subscriptions, *args, **kwargs):
+        self._subscriptions = subscriptions
+        self._subscriptions_by_id = {subscription.subscription_id: subscription for subscription in subscriptions}
+        super().__init__(None, *args, **kwargs)
+
+    @property
+    def subscriptions(self):
+        """Subscriptions of the Tenant."""
+        return self._subscriptions
+
+    def get_subscription(self, subscription_id):
+        """Gets a subscription of the tenant by its id, None if it is not part of the tenant."""
+        return self._subscriptions_by_id.get(subscription_id)
+
+
+class AzureEnergyLabeler(BaseAzureEnergyLabeler):  # pylint: disable=too-many-instance-attributes
+    """Labeler retrieving the defender for cloud findings once per instance.
+
+    The findings can be retrieved through a findings cache and concurrently per subscription, either on a thread
+    pool or on an asyncio event loop. Either way they are sorted by recommendation id so the result does not depend
+    on the order of retrieval. With an incremental state only the findings that changed since the previous run are
+    retrieved and merged into the findings of that run. They are indexed by subscription and resource group right
+    after retrieval, so labeling looks them up instead of scanning them for every subscription and resource group.
+    Labelers of concurrent jobs can share the findings they retrieve for the same subscriptions and frameworks.
+
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 *args,
+                 findings_cache=None,
+                 max_workers=1,
+                 retrieval_engine='threads',
+                 incremental_state=None,
+                 shared_findings=None,
+                 **kwargs):
+        self._findings_cache = findings_cache
+        self._shared_findings = shared_findings
+        self._incremental_state = incremental_state
+        self._max_workers = max_workers
+        self._retrieval_engine = retrieval_engine
+        self._defender_for_cloud_findings = None
+        self._filtered_defender_for_cloud_findings = None
+        super().__init__(*args, **kwargs)
+        # pylint: disable=protected-access
+        subscriptions = [IndexedSubscription(subscription._credential,
+                                             subscription._data,
+                                             subscription.denied_resource_group_names)
+                         for subscription in self._tenant.subscriptions]
+        self._tenant = IndexedTenant(subscriptions,
+                                     tenant_id=self._tenant_id,
+                                     thresholds=self.tenant_thresholds,
+                                     subscription_thresholds=self.subscription_thresholds,
+                                     resource_group_thresholds=self.resource_group_thresholds,
+                                     allowed_subscription_ids=self.allowed_subscription_ids,
+                                     denied_subscription_ids=self.denied_subscription_ids,
+                                     denied_resource_group_names=self.denied_resource_group_names)
+
+    @property
+    def defender_for_cloud_findings(self):
+        """Defender for cloud findings excluding the ones of denied resource groups."""
+        if self._defender_for_cloud_findings is None:
+            self._defender_for_cloud_findings = self._get_defender_for_cloud_findings()
+        return self._defender_for_cloud_findings
+
+    @property
+    def filtered_defender_for_cloud_findings(self):
+        """Defender for cloud findings counting towards a label, so not skipped and not in a filtered state."""
+        if self._filtered_defender_for_cloud_findings is None:
+            self._filtered_defender_for_cloud_findings = IndexedFindings(
+                finding for finding in self.defender_for_cloud_findings
+                if not finding.is_skipped and finding.state not in FINDING_FILTERING_STATES)
+        return self._filtered_defender_for_cloud_findings
+
+    @property
+    def findings_cache_key(self):
+        """The key of the findings of this labeler in a findings cache."""
+        return FindingsCache.get_key(tenant_id=self._tenant_id,
+                                     frameworks=self.matching_frameworks,
+                                     subscription_ids=self.defender_for_cloud.subscription_list,
+                                     allowed_subscription_ids=self.allowed_subscription_ids or [],
+                                     denied_subscription_ids=self.denied_subscription_ids or [],
+                                     denied_resource_group_names=self.denied_resource_group_names)
+
+    @property
+    def shared_findings_key(self):
+        """The key of the findings of this labeler before excluding any resource groups in shared findings."""
+        return FindingsCache.get_key(tenant_id=self._tenant_id,
+                                     frameworks=self.matching_frameworks,
+                                     subscription_ids=self.defender_for_cloud.subscription_list)
+
+    def _get_defender_for_cloud_findings(self):
+        if self._incremental_state:
+            return IndexedFindings(self._retrieve_findings_incrementally())
+        if not self._findings_cache:
+            return IndexedFindings(self._retrieve_defender_for_cloud_findings())
+        key = self.findings_cache_key
+        findings_data = self._findings_cache.get(key)
+        if findings_data is not None:
+            return IndexedFindings(CompactFinding(data) for data in findings_data)
+        findings = self._retrieve_defender_for_cloud_findings()
+        self._findings_cache.set(key, [finding.to_data() for finding in findings])
+        return IndexedFindings(findings)
+
+    def _retrieve_defender_for_cloud_findings(self):
+        """Retrieves the findings excluding the denied resource groups.
+
+        The denied resource group names are turned into lowercase since the resource graph query returns the
+        resource group in lowercase.
+
+        """
+        denied_resource_group_names = {name.lower() for name in self.denied_resource_group_names}
+        if self._shared_findings is None:
+            findings = self._retrieve_all_defender_for_cloud_findings()
+        else:
+            findings = self._shared_findings.get(self.shared_findings_key,
+                                                 self._retrieve_all_defender_for_cloud_findings)
+        return [finding for finding in findings if finding.resource_group not in denied_resource_group_names]
+
+    def _retrieve_all_defender_for_cloud_findings(self):
+        """Retrieves the findings of all subscriptions sorted by recommendation id."""
+        subscription_list = self.defender_for_cloud.subscription_list
+        if self._retrieval_engine == 'asyncio':
+            findings = AsyncFindingsRetriever(self.tenant_credentials,
+                                              subscription_list,
+                                              self.matching_frameworks,
+                                              self._max_workers).retrieve()
+        elif self._max_workers > 1 and len(subscription_list) > 1:
+            findings = self._retrieve_findings_concurrently(subscription_list)
+        else:
+            findings = self._get_findings(subscription_list)
+        return sorted(findings, key=attrgetter('recommendation_id'))
+
+    def _retrieve_findings_incrementally(self):
+        """Retrieves the findings changed since the watermark of the incremental state, all if there is none."""
+        key = self.findings_cache_key
+        watermark = datetime.now(timezone.utc).replace(tzinfo=None)
+        state = self._incremental_state.load(key)
+        if state is None:
+            findings = self._retrieve_defender_for_cloud_findings()
+            refreshed = time.time()
+        else:
+            findings = self._retrieve_changed_findings(state['watermark'],
+                                                       [CompactFinding(data) for data in state['findings']])
+            refreshed = state['refreshed']
+        self._incremental_state.save(key, watermark, refreshed, [finding.to_data() for finding in findings])
+        return findings
+
+    def _retrieve_changed_findings(self, watermark, findings):
+        """Merges the findings changed since the watermark into the findings of the previous run.
+
+        The watermark is moved back by a margin to allow for clock skew and the indexing delay of the resource
+        graph, findings changed within the margin are retrieved again and replace their previous version.
+
+        """
+        since = watermark - timedelta(seconds=WATERMARK_MARGIN)
+        denied_resource_group_names = {name.lower() for name in self.denied_resource_group_names}
+        subscription_list = self.defender_for_cloud.subscription_list
+        client = ResourceGraphClient(self.tenant_credentials)
+        changed_recommendation_ids = set(iter_changed_recommendation_ids(client, subscription_list, since))
+        changed_findings = [finding for finding in self._get_findings(subscription_list, since)
+                            if finding.resource_group not in denied_resource_group_names]
+        changed_subscription_ids = {finding.subscription_id for finding in changed_findings}
+        self._logger.info(f'{len(changed_recommendation_ids)} assessments changed since {since}, '
+                          f'{len(changed_findings)} findings of {len(changed_subscription_ids)} subscriptions '
+                          f'retrieved.')
+        return merge_findings(findings, changed_recommendation_ids, changed_findings)
+
+    def _get_findings(self, subscription_ids, since=None):
+        """Retrieves the findings of the subscriptions as compact findings, dropping duplicates like the library.
+
+        Args:
+            subscription_ids: The subscription ids to retrieve the findings of.
+            since: If provided only the findings whose status changed after this UTC datetime are retrieved.
+
+        Returns:
+            The set of compact findings retrieved.
+
+        """
+        client = ResourceGraphClient(self.tenant_credentials)
+        return {CompactFinding(finding_details)
+                for page in iter_findings_pages(client, subscription_ids, self.matching_frameworks, since)
+                for finding_details in page}
+
+    def _retrieve_findings_concurrently(self, subscription_list):
+        """Retrieves the findings of every subscription on its own, up to max workers subscriptions at a time."""
+        self._logger.debug(f'Retrieving findings of {len(subscription_list)} subscriptions '
+                           f'with {self._max_workers} workers.')
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            return set().union(*executor.map(self._get_findings,
+                                             [[subscription_id] for subscription_id in subscription_list]))
+
+
+class ScopedAzureEnergyLabeler(AzureEnergyLabeler):
+    """Labeler that only queries defender for cloud for the subscriptions to be labeled.
+
+    The library queries the findings of every subscription of the tenant even when an allow list is provided, which
+    for a single subscription on a large tenant means retrieving and scanning everything to keep a fraction.
+
+    """
+
+    def _initialize_defender_for_cloud(self, credential):
+        """Initialize defender for cloud scoped to the subscriptions to be labeled."""
+        subscription_list = [subscription.subscription_id for subscription in
+                             self.tenant.subscriptions_to_be_labeled]
+        return DefenderForCloud(credential, subscription_list)
+
+
+class OfflineSubscription(IndexedSubscription):
+    """Subscription restored from a snapshot that never reaches out to Azure."""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 subscription_id,
+                 display_name=None,
+                 resource_group_names=None,
+                 exempted_policies=None,
+                 denied_resource_group_names=None):
+        super().__init__(None,
+                         SimpleNamespace(id=f'/subscriptions/{subscription_id}',
+                                         subscription_id=subscription_id,
+                                         display_name=display_name,
+                                         tenant_id=None,
+                                         state=None),
+                         denied_resource_group_names or [])
+        self._resource_group_names = sorted(resource_group_names or [])
+        self._exempted_policies = exempted_policies or []
+
+    @property
+    def resource_groups(self):
+        """Resource groups of this subscription as found in the snapshot."""
+        return [IndexedResourceGroup(SimpleNamespace(name=name, location=None)) for name in self._resource_group_names
+                if name not in self.denied_resource_group_names]
+
+    @property
+    def exempted_policies(self):
+        """Policies exempted for this subscription as found in the snapshot."""
+        return self._exempted_policies
+
+
+class OfflineAzureEnergyLabeler(AzureEnergyLabeler):  # pylint: disable=too-many-instance-attributes
+    """Labeler computing the energy labels from a findings snapshot without any Azure calls.
+
+    Only the subscriptions found in the snapshot are known, so the tenant coverage is relative to those.
+
+    """
+
+    # pylint: disable=super-init-not-called,dangerous-default-value,too-many-arguments
+    def __init__(self,
+                 tenant_id,
+                 findings_snapshot,
+                 frameworks=DEFAULT_DEFENDER_FOR_CLOUD_FRAMEWORKS,
+                 tenant_thresholds=TENANT_THRESHOLDS,
+                 resource_group_thresholds=RESOURCE_GROUP_THRESHOLDS,
+                 subscription_thresholds=SUBSCRIPTION_THRESHOLDS,
+                 allowed_subscription_ids=None,
+                 denied_subscription_ids=None,
+                 denied_resource_group_names=None):
+        self._logger = logging.getLogger(f'{LOGGER_BASENAME}.{self.__class__.__name__}')
+        self._tenant_id = tenant_id
+        self._findings_snapshot = findings_snapshot
+        self._findings_cache = None
+        self._incremental_state = None
+        self._defender_for_cloud_findings = None
+        self._filtered_defender_for_cloud_findings = None
+        self.resource_group_thresholds = resource_group_thresholds_schema.validate(resource_group_thresholds)
+        self.tenant_thresholds = tenant_thresholds_schema.validate(tenant_thresholds)
+        self.subscription_thresholds = subscription_thresholds_schema.validate(subscription_thresholds)
+        self.tenant_credentials = None
+        self.allowed_subscription_ids = allowed_subscription_ids
+        self.denied_subscription_ids = denied_subscription_ids
+        self.denied_resource_group_names = validate_resource_group_names(denied_resource_group_names)
+        subscriptions = [OfflineSubscription(subscription_id,
+                                             denied_resource_group_names=self.denied_resource_group_names,
+                                             **subscription_data)
+                         for subscription_id, subscription_data in findings_snapshot.subscriptions_data.items()]
+        self._tenant = IndexedTenant(subscriptions,
+                                     tenant_id=self._tenant_id,
+                                     thresholds=self.tenant_thresholds,
+                                     subscription_thresholds=self.subscription_thresholds,
+                                     resource_group_thresholds=self.resource_group_thresholds,
+                                     allowed_subscription_ids=self.allowed_subscription_ids,
+                                     denied_subscription_ids=self.denied_subscription_ids,
+                                     denied_resource_group_names=self.denied_resource_group_names)
+        self._defender_for_cloud = None
+        self._frameworks = DefenderForCloud.validate_frameworks(frameworks)
+        self._tenant_energy_label = None
+        self._labeled_subscriptions_energy_label = None
+        self._tenant_labeled_subscriptions = None
+
+    def _get_defender_for_cloud_findings(self):
+        return IndexedFindings(self._retrieve_defender_for_cloud_findings())
+
+    def _retrieve_defender_for_cloud_findings(self):
+        """Loads the findings of the snapshot matching the frameworks and not in denied resource groups."""
+        denied_resource_group_names = {name.lower() for name in self.denied_resource_group_names}
+        frameworks = set(self.matching_frameworks)
+        return [CompactFinding(data) for data in self._findings_snapshot.findings_data
+                if data.get('complianceStandardId', '') in frameworks | {''}
+                and data.get('resourceGroup', '') not in denied_resource_group_names]
+
+
+class StreamingAzureEnergyLabeler(AzureEnergyLabeler):
+    """Labeler streaming the findings instead of keeping them all in memory.
+
+    Pages of findings are retrieved on a separate thread into a bounded buffer while the findings of earlier pages
+    are aggregated per subscription and resource group and spooled to a temporary file. Labels are calculated from
+    the aggregates and exports read the spooled findings back one at a time. Only the recommendation ids are kept in
+    memory, to drop duplicate findings. Findings are retrieved serially and never cached.
+
+    """
+
+    def __init__(self, *args, buffer_size=DEFAULT_STREAM_BUFFER_SIZE, **kwargs):
+        self._buffer_size = buffer_size
+        super().__init__(*args, **kwargs)
+
+    @property
+    def filtered_defender_for_cloud_findings(self):
+        """Streamed findings only hold the findings counting towards a label, so they are already filtered."""
+        return self.defender_for_cloud_findings
+
+    def _get_defender_for_cloud_findings(self):
+        return self._retrieve_defender_for_cloud_findings()
+
+    def _retrieve_defender_for_cloud_findings(self):
+        """Streams the findings excluding duplicates and the denied resource groups."""
+        denied_resource_group_names = {name.lower() for name in self.denied_resource_group_names}
+        pages = buffered(iter_findings_pages(ResourceGraphClient(self.tenant_credentials),
+                                             self.defender_for_cloud.subscription_list,
+                                             self.matching_frameworks),
+                         self._buffer_size)
+        recommendation_ids = set()
+        findings = StreamedFindings()
+        for finding in (CompactFinding(finding_details) for page in pages for finding_details in page):
+            if finding.recommendation_id in recommendation_ids:
+                continue
+            recommendation_ids.add(finding.recommendation_id)
+            if finding.resource_group not in denied_resource_group_names:
+                findings.add(finding)
+        self._logger.debug(f'Streamed {len(findings)} findings counting towards a label.')
+        return findings
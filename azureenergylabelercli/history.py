@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: history.py
+#
+# Copyright 2022 Sayantan Khanra
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Local history of energy labels for azureenergylabelercli.
+
+Every run appends the labels and finding counts of the tenant, its subscriptions and their resource groups to an
+indexed SQLite database, so trends can be queried without parsing the exports of past runs.
+
+.. _Google Python Style Guide:
+   https://google.github.io/styleguide/pyguide.html
+
+"""
+
+import logging
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timezone
+
+from azureenergylabelerlib.datamodels import LabeledResourceGroupData, LabeledSubscriptionData
+
+__author__ = '''Sayantan Khanra <skhanra@schubergphilis.com>'''
+__docformat__ = '''google'''
+__date__ = '''04-05-2022'''
+__copyright__ = '''Copyright 2022, Sayantan Khanra'''
+__credits__ = ["Sayantan Khanra"]
+__license__ = '''MIT'''
+__maintainer__ = '''Sayantan Khanra'''
+__email__ = '''<skhanra@schubergphilis.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''history'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+HISTORY_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+HISTORY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    tenant_id TEXT NOT NULL,
+    started_at TEXT NOT NULL,
+    energy_label TEXT,
+    number_of_findings INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_by_tenant ON runs (tenant_id, started_at);
+CREATE TABLE IF NOT EXISTS subscription_labels (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    subscription_id TEXT NOT NULL,
+    display_name TEXT,
+    energy_label TEXT NOT NULL,
+    number_of_high_findings INTEGER NOT NULL,
+    number_of_medium_findings INTEGER NOT NULL,
+    number_of_low_findings INTEGER NOT NULL,
+    number_of_exempted_findings INTEGER NOT NULL,
+    max_days_open INTEGER,
+    PRIMARY KEY (run_id, subscription_id)
+);
+CREATE INDEX IF NOT EXISTS subscription_labels_by_subscription ON subscription_labels (subscription_id, run_id);
+CREATE TABLE IF NOT EXISTS resource_group_labels (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    subscription_id TEXT NOT NULL,
+    resource_group_name TEXT NOT NULL,
+    energy_label TEXT NOT NULL,
+    number_of_high_findings INTEGER NOT NULL,
+    number_of_medium_findings INTEGER NOT NULL,
+    number_of_low_findings INTEGER NOT NULL,
+    max_days_open INTEGER,
+    PRIMARY KEY (run_id, subscription_id, resource_group_name)
+);
+CREATE INDEX IF NOT EXISTS resource_group_labels_by_resource_group
+    ON resource_group_labels (subscription_id, resource_group_name, run_id);
+'''
+
+DROPPED_SUBSCRIPTION_LABELS_QUERY = '''
+WITH period AS (
+    SELECT subscription_labels.subscription_id,
+           subscription_labels.display_name,
+           subscription_labels.energy_label,
+           ROW_NUMBER() OVER (PARTITION BY subscription_labels.subscription_id
+                              ORDER BY runs.started_at, runs.id) AS first_position,
+           ROW_NUMBER() OVER (PARTITION BY subscription_labels.subscription_id
+                              ORDER BY runs.started_at DESC, runs.id DESC) AS last_position
+    FROM runs JOIN subscription_labels ON subscription_labels.run_id = runs.id
+    WHERE runs.tenant_id = ? AND runs.started_at >= ?
+)
+SELECT first.subscription_id, last.display_name, first.energy_label, last.energy_label
+FROM period AS first JOIN period AS last ON last.subscription_id = first.subscription_id
+WHERE first.first_position = 1 AND last.last_position = 1 AND last.energy_label > first.energy_label
+ORDER BY first.subscription_id
+'''
+
+
+class HistoryStore:
+    """Appends the labels of every run to a local SQLite database and answers trend questions from it."""
+
+    def __init__(self, path):
+        self._logger = logging.getLogger(f'{LOGGER_BASENAME}.{self.__class__.__name__}')
+        self.path = path
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute('PRAGMA foreign_keys = ON')
+        connection.executescript(HISTORY_SCHEMA)
+        return connection
+
+    @staticmethod
+    def _get_subscription_rows(run_id, exporter_arguments):
+        for subscription in exporter_arguments['labeled_subscriptions']:
+            data = LabeledSubscriptionData(None,
+                                           subscription,
+                                           exporter_arguments['defender_for_cloud_findings']).data
+            yield (run_id,
+                   data['Subscription ID'],
+                   data['Subscription Display Name'],
+                   data['Energy Label'],
+                   data['Number of high findings'],
+                   data['Number of medium findings'],
+                   data['Number of low findings'],
+                   data['Number of exempted findings'],
+                   data['Number of maximum days open'])
+
+    @staticmethod
+    def _get_resource_group_rows(run_id, exporter_arguments):
+        for subscription in exporter_arguments['labeled_subscriptions']:
+            for resource_group in subscription.resource_groups:
+                data = LabeledResourceGroupData(None,
+                                                {'subscription_id': subscription.subscription_id,
+                                                 'labeled_resource_group': resource_group},
+                                                exporter_arguments['defender_for_cloud_findings']).data
+                yield (run_id,
+                       data['Subscription ID'],
+                       data['ResourceGroup Name'],
+                       data['Energy Label'],
+                       data['Number of high findings'],
+                       data['Number of medium findings'],
+                       data['Number of low findings'],
+                       data['Number of maximum days open'])
+
+    def record(self, tenant_id, reports, started_at=None):
+        """Appends the labels of a run in a single transaction.
+
+        Args:
+            tenant_id: The tenant the run labeled.
+            reports: The exporter arguments of every report of the run, the energy label of the tenant is recorded
+                from the report of the tenant if any.
+            started_at: The UTC datetime the run started, defaults to now.
+
+        Returns:
+            The id of the run recorded.
+
+        """
+        started_at = (started_at or datetime.now(timezone.utc)).strftime(HISTORY_TIMESTAMP_FORMAT)
+        energy_label = next((exporter_arguments['energy_label'] for exporter_arguments in reports
+                             if exporter_arguments['id'] == tenant_id), None)
+        number_of_findings = sum(len(exporter_arguments['defender_for_cloud_findings'])
+                                 for exporter_arguments in reports)
+        with closing(self._connect()) as connection:
+            with connection:
+                run_id = connection.execute('INSERT INTO runs (tenant_id, started_at, energy_label, number_of_findings) '
+                                            'VALUES (?, ?, ?, ?)',
+                                            (tenant_id, started_at, energy_label, number_of_findings)).lastrowid
+                for exporter_arguments in reports:
+                    connection.executemany('INSERT INTO subscription_labels VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                           self._get_subscription_rows(run_id, exporter_arguments))
+                    connection.executemany('INSERT INTO resource_group_labels VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                           self._get_resource_group_rows(run_id, exporter_arguments))
+        self._logger.info(f'Recorded run {run_id} of tenant {tenant_id} in {self.path}.')
+        return run_id
+
+    def get_dropped_subscription_labels(self, tenant_id, since):
+        """Gets the subscriptions whose latest label is worse than their first label since a point in time.
+
+        Args:
+            tenant_id: The tenant of the subscriptions.
+            since: The UTC datetime to compare the latest labels with the first labels from.
+
+        Returns:
+            A list of subscription id, display name, first label and latest label tuples.
+
+        """
+        with closing(self._connect()) as connection:
+            return connection.execute(DROPPED_SUBSCRIPTION_LABELS_QUERY,
+                                      (tenant_id, since.strftime(HISTORY_TIMESTAMP_FORMAT))).fetchall()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: incremental.py
+#
+# Copyright 2022 Sayantan Khanra
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+
+"""
+Incremental retrieval of defender for cloud findings for azureenergylabelercli.
+
+A gzip compressed state file keeps the findings of the previous run along with a watermark, the time that run
+retrieved them. The next run only retrieves the findings whose status changed since the watermark and merges them into
+the previous findings. Assessments that changed since then but are no longer returned, because they became healthy,
+are dropped.
+
+The state keeps the findings rather than per subscription aggregates, and all labels are recalculated from the merged
+findings. Labels depend on the number of days findings are open, which grows without any change of status, so the
+label of a subscription without changed findings can still change and can not be carried over from the previous run.
+The findings and resource group exports also need the findings themselves. Calculating the labels out of the indexed
+findings takes a fraction of the time of retrieving them, and a state larger than its maximum size is not kept.
+
+.. _Google Python Style Guide:
+   https://google.github.io/styleguide/pyguide.html
+
+"""
+
+import gzip
+import json
+import logging
+import os
+import tempfile
+import time
+from datetime import datetime
+from operator import attrgetter
+from pathlib import Path
+
+from .cache import file_lock
+
+__author__ = '''Sayantan Khanra <skhanra@schubergphilis.com>'''
+__docformat__ = '''google'''
+__date__ = '''04-05-2022'''
+__copyright__ = '''Copyright 2022, Sayantan Khanra'''
+__credits__ = ["Sayantan Khanra"]
+__license__ = '''MIT'''
+__maintainer__ = '''Sayantan Khanra'''
+__email__ = '''<skhanra@schubergphilis.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''incremental'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+DEFAULT_INCREMENTAL_MAX_AGE = 86400
+DEFAULT_INCREMENTAL_MAX_SIZE = 256
+WATERMARK_MARGIN = 900
+WATERMARK_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+CHANGED_ASSESSMENTS_QUERY_STRING = '''securityresources
+    | where type == "microsoft.security/assessments"
+    | where todatetime(properties.status.statusChangeDate) > datetime({since})
+    | project recommendationId = tolower(id)'''
+
+
+def iter_changed_recommendation_ids(client, subscription_ids, since):
+    """Retrieves the lowercase ids of the assessments whose status changed after a point in time, in any state.
+
+    Args:
+        client: The resource graph client to query.
+        subscription_ids: The subscription ids to retrieve the changed assessments of.
+        since: The UTC datetime after which the status changed.
+
+    Returns:
+        A generator of recommendation ids.
+
+    """
+    from .streaming import iter_query_pages  # pylint: disable=import-outside-toplevel
+    query = CHANGED_ASSESSMENTS_QUERY_STRING.format(since=since.strftime(WATERMARK_FORMAT))
+    for page in iter_query_pages(client, subscription_ids, query):
+        for assessment in page:
+            yield assessment.get('recommendationId', '').lower()
+
+
+def merge_findings(findings, changed_recommendation_ids, changed_findings):
+    """Merges the findings that changed into the findings of a previous run.
+
+    Args:
+        findings: The findings of the previous run.
+        changed_recommendation_ids: The lowercase ids of all recommendations that changed, including the ones that
+            are no longer returned.
+        changed_findings: The findings that changed and are still returned.
+
+    Returns:
+        The merged findings sorted by recommendation id.
+
+    """
+    changed_findings = {finding.recommendation_id: finding for finding in changed_findings}
+    merged = [finding for finding in findings
+              if finding.recommendation_id.lower() not in changed_recommendation_ids
+              and finding.recommendation_id not in changed_findings]
+    return sorted(merged + list(changed_findings.values()), key=attrgetter('recommendation_id'))
+
+
+class IncrementalState:
+    """Keeps the findings of the last run and its watermark in a file to retrieve only changes on the next run.
+
+    The state is only used by runs with the same key, so the same tenant, frameworks and filters, and at most for
+    max age seconds after the last full retrieval, after which the findings are retrieved in full again to correct
+    for any change the incremental retrievals could not see. A state compressing to more than the maximum size is
+    removed instead of saved, so the next run retrieves all findings.
+
+    """
+
+    def __init__(self, path, max_age=DEFAULT_INCREMENTAL_MAX_AGE, max_size=DEFAULT_INCREMENTAL_MAX_SIZE):
+        """Initializes the state.
+
+        Args:
+            path: The path of the state file, created on the first save.
+            max_age: The number of seconds after a full retrieval until the next one.
+            max_size: The maximum size of the compressed state file in megabytes.
+
+        """
+        self._logger = logging.getLogger(f'{LOGGER_BASENAME}.{self.__class__.__name__}')
+        self.path = Path(path)
+        self.max_age = max_age
+        self.max_size = max_size * 1024 * 1024
+        self._lock_path = self.path.with_name(f'{self.path.name}.lock')
+
+    def load(self, key):
+        """Loads the state of a key.
+
+        Args:
+            key: The key of the labeler as calculated by FindingsCache.get_key.
+
+        Returns:
+            A dictionary with the watermark as a UTC datetime, the time of the last full retrieval and the findings
+            data if there is a usable state, None otherwise.
+
+        """
+        if not self.path.is_file():
+            self._logger.info(f'No incremental state in {self.path} yet, retrieving all findings.')
+            return None
+        with file_lock(self._lock_path):
+            try:
+                with gzip.open(self.path, 'rt', encoding='utf-8') as state_file:
+                    state = json.load(state_file)
+                watermark = datetime.strptime(state['watermark'], WATERMARK_FORMAT)
+            except (OSError, ValueError, KeyError, TypeError):
+                self._logger.info(f'No usable incremental state in {self.path}, retrieving all findings.')
+                return None
+        if state.get('key') != key:
+            self._logger.info(f'The incremental state in {self.path} is of other arguments, retrieving all findings.')
+            return None
+        if time.time() - state.get('refreshed', 0) > self.max_age:
+            self._logger.info(f'The incremental state in {self.path} is older than {self.max_age} seconds, '
+                              f'retrieving all findings.')
+            return None
+        return {'watermark': watermark, 'refreshed': state['refreshed'], 'findings': state.get('findings', [])}
+
+    def save(self, key, watermark, refreshed, findings):
+        """Replaces the state with the findings of a run.
+
+        Args:
+            key: The key of the labeler as calculated by FindingsCache.get_key.
+            watermark: The UTC datetime the findings were retrieved at.
+            refreshed: The timestamp of the last full retrieval.
+            findings: A list of json serializable findings data.
+
+        """
+        data = gzip.compress(json.dumps({'key': key,
+                                         'watermark': watermark.strftime(WATERMARK_FORMAT),
+                                         'refreshed': refreshed,
+                                         'findings': findings}, default=str).encode('utf-8'))
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with file_lock(self._lock_path):
+            if len(data) > self.max_size:
+                self.path.unlink(missing_ok=True)
+                self._logger.warning(f'The incremental state of {len(findings)} findings is larger than '
+                                     f'{self.max_size // (1024 * 1024)} megabytes and is not kept.')
+                return
+            with tempfile.NamedTemporaryFile('wb', dir=self.path.parent, suffix='.tmp',
+                                             delete=False) as temporary_file:
+                temporary_file.write(data)
+            os.replace(temporary_file.name, self.path)
+        self._logger.debug(f'Saved the incremental state of {len(findings)} findings to {self.path}.')
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: jobs.py
+#
+# Copyright 2022 Sayantan Khanra
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Declarative labeling jobs for azureenergylabelercli.
+
+A jobs file lists many labeling jobs, each with the tenant, subscription and resource group filters, frameworks and
+export of a run, with the keys named after the corresponding cli arguments. Jobs run concurrently in one process
+and jobs retrieving the findings of the same subscriptions for the same frameworks retrieve them only once. Yaml jobs
+files require PyYAML, installed with "pip install azureenergylabelercli[jobs]", json jobs files do not.
+
+.. _Google Python Style Guide:
+   https://google.github.io/styleguide/pyguide.html
+
+"""
+
+import json
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .azureenergylabelercliexceptions import InvalidJobsFile, YamlJobsFileUnavailable
+from .multitenant import TimedRun, run_timed
+
+__author__ = '''Sayantan Khanra <skhanra@schubergphilis.com>'''
+__docformat__ = '''google'''
+__date__ = '''04-05-2022'''
+__copyright__ = '''Copyright 2022, Sayantan Khanra'''
+__credits__ = ["Sayantan Khanra"]
+__license__ = '''MIT'''
+__maintainer__ = '''Sayantan Khanra'''
+__email__ = '''<skhanra@schubergphilis.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''jobs'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+DEFAULT_JOB_WORKERS = 4
+
+LIST_JOB_KEYS = {'allowed-subscription-ids': 'allowed_subscription_ids',
+                 'denied-subscription-ids': 'denied_subscription_ids',
+                 'denied-resource-group-names': 'denied_resource_group_names',
+                 'frameworks': 'frameworks'}
+
+CHOICE_JOB_KEYS = {'export-format': ('export_format', ('json', 'parquet')),
+                   'findings-export-format': ('findings_export_format', ('json', 'ndjson')),
+                   'export-compression': ('export_compression', ('none', 'gzip', 'zstd'))}
+
+JOB_KEYS = {'name', 'tenant-id', 'export-path', 'export-metrics', *LIST_JOB_KEYS, *CHOICE_JOB_KEYS}
+
+
+def _load_yaml(jobs_file):
+    try:
+        import yaml  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        raise YamlJobsFileUnavailable('Yaml jobs files require PyYAML, install it with "pip install pyyaml" '
+                                      'or provide the jobs file as json.') from None
+    return yaml.safe_load(jobs_file)
+
+
+def _get_list(value, key, index):
+    if isinstance(value, str):
+        value = value.split(',')
+    if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+        raise InvalidJobsFile(f'{key} of job {index} is not a list of strings.')
+    return value
+
+
+def _get_bool(value, key, index):
+    if not isinstance(value, bool):
+        raise InvalidJobsFile(f'{key} of job {index} is not true or false.')
+    return value
+
+
+def _get_choice(value, key, index, choices):
+    if value not in choices:
+        raise InvalidJobsFile(f'{key} of job {index} is not one of {", ".join(choices)}.')
+    return value
+
+
+def parse_job(job, index):
+    """Validates a job of a jobs file and converts it to the cli arguments it overrides.
+
+    Args:
+        job: The dictionary of the job as read from the jobs file.
+        index: The position of the job in the jobs file, to name it if it has no name.
+
+    Raises:
+        InvalidJobsFile: If the job has no tenant id, unknown keys or invalid values.
+
+    Returns:
+        The dictionary of the cli argument destinations and values of the job, with its name.
+
+    """
+    if not isinstance(job, dict):
+        raise InvalidJobsFile(f'Job {index} is not a mapping.')
+    unknown_keys = sorted(set(job) - JOB_KEYS)
+    if unknown_keys:
+        raise InvalidJobsFile(f'Job {index} has unknown keys {", ".join(unknown_keys)}.')
+    if not job.get('tenant-id'):
+        raise InvalidJobsFile(f'Job {index} has no tenant-id.')
+    arguments = {'name': str(job.get('name', f'job-{index}')),
+                 'tenant_id': str(job['tenant-id'])}
+    if job.get('export-path'):
+        arguments['export_path'] = str(job['export-path'])
+    if 'export-metrics' in job:
+        arguments['export_all'] = not _get_bool(job['export-metrics'], 'export-metrics', index)
+    for key, destination in LIST_JOB_KEYS.items():
+        if job.get(key):
+            arguments[destination] = _get_list(job[key], key, index)
+    for key, (destination, choices) in CHOICE_JOB_KEYS.items():
+        if key in job:
+            arguments[destination] = _get_choice(job[key], key, index, choices)
+    if arguments.get('allowed_subscription_ids') and arguments.get('denied_subscription_ids'):
+        raise InvalidJobsFile(f'Job {index} has both allowed-subscription-ids and denied-subscription-ids.')
+    if arguments.get('export_format') == 'parquet' and arguments.get('findings_export_format') == 'ndjson':
+        raise InvalidJobsFile(f'Job {index} has both export-format parquet and findings-export-format ndjson.')
+    return arguments
+
+
+def load_jobs(path):
+    """Loads the jobs of a yaml or json jobs file.
+
+    The file either holds a list of jobs or a mapping with the list of jobs under the key jobs.
+
+    Args:
+        path: The path of the jobs file, read as json if its suffix is .json and as yaml otherwise.
+
+    Raises:
+        InvalidJobsFile: If the file can not be read or a job is invalid.
+        YamlJobsFileUnavailable: If the file is yaml and PyYAML is not installed.
+
+    Returns:
+        A list of the cli arguments each job overrides, with the name of the job.
+
+    """
+    try:
+        with open(path, encoding='utf-8') as jobs_file:
+            data = json.load(jobs_file) if Path(path).suffix == '.json' else _load_yaml(jobs_file)
+    except (OSError, ValueError) as error:
+        raise InvalidJobsFile(f'Could not load {path}: {error}') from None
+    jobs = data.get('jobs') if isinstance(data, dict) else data
+    if not isinstance(jobs, list) or not jobs:
+        raise InvalidJobsFile(f'{path} does not contain a list of jobs.')
+    jobs = [parse_job(job, index) for index, job in enumerate(jobs, 1)]
+    names = [job['name'] for job in jobs]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise InvalidJobsFile(f'{path} has more than one job named {", ".join(duplicates)}.')
+    return jobs
+
+
+class SharedFindings:  # pylint: disable=too-few-public-methods
+    """Keeps retrieved findings in memory for the labelers of concurrent jobs retrieving the same findings.
+
+    The first labeler asking for a key retrieves the findings, labelers asking for it in the meantime wait for that
+    retrieval instead of repeating it.
+
+    """
+
+    def __init__(self):
+        self._logger = logging.getLogger(f'{LOGGER_BASENAME}.{self.__class__.__name__}')
+        self._findings = {}
+        self._locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+        self.retrievals = 0
+
+    def get(self, key, retrieve):
+        """Gets the findings of a key, retrieving them with the provided callable only the first time."""
+        with self._lock:
+            key_lock = self._locks[key]
+        with key_lock:
+            if key not in self._findings:
+                self._findings[key] = retrieve()
+                self.retrievals += 1
+            else:
+                self._logger.debug(f'Sharing the retrieved findings of key {key}.')
+        return self._findings[key]
+
+
+class JobRun(TimedRun):  # pylint: disable=too-few-public-methods
+    """Models the outcome of a labeling job."""
+
+    def __init__(self, name, tenant_id, reports=None, error=None, duration=0.0):
+        super().__init__(reports, error, duration)
+        self.name = name
+        self.tenant_id = tenant_id
+
+
+def run_jobs(jobs, run_job, max_workers=DEFAULT_JOB_WORKERS):
+    """Runs the jobs on a thread pool, isolating the failures of each job.
+
+    Args:
+        jobs: The jobs to run as loaded from a jobs file.
+        run_job: A callable running the job it is provided, returning its report data.
+        max_workers: The number of jobs to run at the same time.
+
+    Returns:
+        A list of the job runs in the order of the jobs.
+
+    """
+    def timed_run_job(job):
+        reports, duration, error = run_timed(run_job, job)
+        if error:
+            LOGGER.error(f'Job {job["name"]} failed: {error}')
+        else:
+            LOGGER.info(f'Ran job {job["name"]} in {duration:.1f} seconds.')
+        return JobRun(job['name'], job['tenant_id'], reports, error, duration)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job') as executor:
+        return list(executor.map(timed_run_job, jobs))
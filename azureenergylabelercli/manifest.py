@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: manifest.py
+#
+# Copyright 2022 Sayantan Khanra
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Content hashes of exported files for azureenergylabelercli.
+
+Exports of unchanged data are skipped by comparing the hash of the newly written file with the hash recorded for
+the destination, in a manifest next to local exports or in the metadata of blobs.
+
+.. _Google Python Style Guide:
+   https://google.github.io/styleguide/pyguide.html
+
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+__author__ = '''Sayantan Khanra <skhanra@schubergphilis.com>'''
+__docformat__ = '''google'''
+__date__ = '''04-05-2022'''
+__copyright__ = '''Copyright 2022, Sayantan Khanra'''
+__credits__ = ["Sayantan Khanra"]
+__license__ = '''MIT'''
+__maintainer__ = '''Sayantan Khanra'''
+__email__ = '''<skhanra@schubergphilis.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''manifest'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+MANIFEST_FILENAME = '.export-manifest.json'
+CONTENT_HASH_METADATA_KEY = 'contentsha256'
+
+
+def get_content_hash(binary_file, chunk_size=1024 * 1024):
+    """Calculates the sha256 hex digest of a binary file from its start, leaving it positioned at its start."""
+    content_hash = hashlib.sha256()
+    binary_file.seek(0)
+    for chunk in iter(lambda: binary_file.read(chunk_size), b''):
+        content_hash.update(chunk)
+    binary_file.seek(0)
+    return content_hash.hexdigest()
+
+
+class ExportManifest:
+    """Records the content hash and size of the files exported to a local directory.
+
+    A file is unchanged if the hash of its new content is the recorded one and the file still has the recorded
+    size, so files removed or truncated since are exported again.
+
+    """
+
+    def __init__(self, directory):
+        self._logger = logging.getLogger(f'{LOGGER_BASENAME}.{self.__class__.__name__}')
+        self.directory = Path(directory)
+        self.path = self.directory.joinpath(MANIFEST_FILENAME)
+        try:
+            with open(self.path, encoding='utf-8') as manifest_file:
+                self._entries = json.load(manifest_file)
+        except (OSError, ValueError):
+            self._entries = {}
+        self._updated = False
+
+    def is_unchanged(self, filename, content_hash):
+        """The file was exported with the same content and is still in place."""
+        entry = self._entries.get(filename, {})
+        try:
+            size = self.directory.joinpath(filename).stat().st_size
+        except OSError:
+            return False
+        return entry.get('sha256') == content_hash and entry.get('size') == size
+
+    def update(self, filename, content_hash, size):
+        """Records the content hash and size of an exported file."""
+        self._entries[filename] = {'sha256': content_hash, 'size': size}
+        self._updated = True
+
+    def save(self):
+        """Writes the manifest if any file was exported, replacing the previous one at once."""
+        if not self._updated:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=self.directory, suffix='.tmp',
+                                         delete=False) as temporary_file:
+            json.dump(self._entries, temporary_file, indent=2, sort_keys=True)
+        os.replace(temporary_file.name, self.path)
+        self._logger.debug(f'Saved the export manifest of {len(self._entries)} files to {self.path}.')
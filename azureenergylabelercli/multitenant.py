@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: multitenant.py
+#
+# Copyright 2022 Sayantan Khanra
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Labeling of many tenants in parallel processes for azureenergylabelercli.
+
+.. _Google Python Style Guide:
+   https://google.github.io/styleguide/pyguide.html
+
+"""
+
+import logging
+import os
+import time
+from pathlib import Path
+
+__author__ = '''Sayantan Khanra <skhanra@schubergphilis.com>'''
+__docformat__ = '''google'''
+__date__ = '''04-05-2022'''
+__copyright__ = '''Copyright 2022, Sayantan Khanra'''
+__credits__ = ["Sayantan Khanra"]
+__license__ = '''MIT'''
+__maintainer__ = '''Sayantan Khanra'''
+__email__ = '''<skhanra@schubergphilis.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''multitenant'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+
+def get_default_tenant_workers(tenant_ids):
+    """Gets the number of tenants to label at the same time by default, one per tenant up to the number of cpus."""
+    return max(1, min(len(set(tenant_ids)), os.cpu_count() or 1))
+
+
+def read_tenants_file(path):
+    """Reads the tenant ids of a file, one per line, skipping empty lines and comments starting with #."""
+    with open(path, encoding='utf-8') as tenants_file:
+        lines = [line.split('#', 1)[0].strip() for line in tenants_file]
+    return [line for line in lines if line]
+
+
+def get_tenant_path(path, tenant_id):
+    """Gets the path of a local file of a tenant next to the provided one, suffixing its name with the tenant id."""
+    path = Path(path)
+    return str(path.with_name(f'{path.stem}-{tenant_id}{path.suffix}'))
+
+
+class TimedRun:  # pylint: disable=too-few-public-methods
+    """Models the outcome of a labeling run, its reports if it succeeded or its error if it failed, and its duration."""
+
+    def __init__(self, reports=None, error=None, duration=0.0):
+        self.reports = reports or []
+        self.error = error
+        self.duration = duration
+
+    @property
+    def succeeded(self):
+        """The run succeeded or not."""
+        return self.error is None
+
+
+class TenantRun(TimedRun):  # pylint: disable=too-few-public-methods
+    """Models the outcome of labeling a tenant."""
+
+    def __init__(self, tenant_id, reports=None, error=None, duration=0.0):
+        super().__init__(reports, error, duration)
+        self.tenant_id = tenant_id
+
+
+def get_error_message(error):
+    """Gets the message of the error a run failed with, of the error logged before exiting if the run exited."""
+    if isinstance(error, SystemExit) and error.__context__ is not None:
+        error = error.__context__
+    return f'{type(error).__name__}: {error}'
+
+
+def run_timed(run, *args):
+    """Runs a callable timing it and catching the error it fails with, even if it exits.
+
+    Args:
+        run: The callable to run.
+        *args: The arguments to call it with.
+
+    Returns:
+        A tuple of what the callable returned, the seconds it took and the message of its error, None if it succeeded.
+
+    """
+    start = time.perf_counter()
+    try:
+        reports = run(*args)
+    except (Exception, SystemExit) as error:  # pylint: disable=broad-except
+        return None, time.perf_counter() - start, get_error_message(error)
+    return reports, time.perf_counter() - start, None
+
+
+def _get_tenant_run(tenant_id, future):
+    try:
+        reports, duration, error = future.result()
+    except Exception as pool_error:  # pylint: disable=broad-except
+        reports, duration, error = None, 0.0, get_error_message(pool_error)
+    if error:
+        LOGGER.error(f'Labeling tenant {tenant_id} failed: {error}')
+    else:
+        LOGGER.info(f'Labeled tenant {tenant_id} in {duration:.1f} seconds.')
+    return TenantRun(tenant_id, reports, error, duration)
+
+
+def label_tenants(tenant_ids, label_tenant, max_workers=None, initializer=None, initargs=()):
+    """Labels every tenant in its own process, up to max workers at a time, isolating the failures of each tenant.
+
+    The processes are spawned instead of forked, so they do not inherit the locks and threads of this process.
+    A tenant provided more than once is labeled once.
+
+    Args:
+        tenant_ids: The ids of the tenants to label.
+        label_tenant: A picklable callable labeling the tenant id it is provided, returning its report data.
+        max_workers: The number of tenants to label at the same time, one per tenant up to the number of cpus if
+            not provided.
+        initializer: A picklable callable every process calls on start, like to set up its logging.
+        initargs: The arguments to call the initializer with.
+
+    Returns:
+        A list of the tenant runs in the order of the tenant ids.
+
+    """
+    # pylint: disable=import-outside-toplevel
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=max_workers or get_default_tenant_workers(tenant_ids),
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=initializer,
+                             initargs=initargs) as executor:
+        futures = [(tenant_id, executor.submit(run_timed, label_tenant, tenant_id))
+                   for tenant_id in dict.fromkeys(tenant_ids)]
+        runs = [_get_tenant_run(tenant_id, future) for tenant_id, future in futures]
+    return runs
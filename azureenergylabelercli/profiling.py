@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: profiling.py
+#
+# Copyright 2022 Sayantan Khanra
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Profiling of the phases of a run for azureenergylabelercli.
+
+Every phase is profiled with cProfile on the threads running it and written to a pstats file named after it, the time
+of nested phases only counting towards the innermost one. All threads are sampled meanwhile into a collapsed stacks
+file, each stack rooted at the phase it was sampled in, as read by flame graph tools.
+
+.. _Google Python Style Guide:
+   https://google.github.io/styleguide/pyguide.html
+
+"""
+
+import argparse
+import logging
+import os
+import sys
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+__author__ = '''Sayantan Khanra <skhanra@schubergphilis.com>'''
+__docformat__ = '''google'''
+__date__ = '''04-05-2022'''
+__copyright__ = '''Copyright 2022, Sayantan Khanra'''
+__credits__ = ["Sayantan Khanra"]
+__license__ = '''MIT'''
+__maintainer__ = '''Sayantan Khanra'''
+__email__ = '''<skhanra@schubergphilis.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''profiling'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+DEFAULT_SAMPLE_INTERVAL = 0.005
+COLLAPSED_STACKS_FILENAME = 'stacks.collapsed'
+
+_ACTIVE_PROFILER = None
+
+
+def get_profile_directory(arguments=None):
+    """Gets the directory of --profile ahead of parsing all arguments, so parsing them can be profiled as well."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--profile', default=os.environ.get('AZURE_LABELER_PROFILE'))
+    known_arguments, _ = parser.parse_known_args(arguments)
+    return known_arguments.profile
+
+
+def _forget_active_profiler():
+    """Forked processes neither run the sampler of the parent nor write its profiles, so they do not profile."""
+    global _ACTIVE_PROFILER  # pylint: disable=global-statement
+    _ACTIVE_PROFILER = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_active_profiler)
+
+
+@contextmanager
+def profile_phase(name):
+    """Profiles the enclosed code, or the decorated function, as a phase of the active profiler if there is one."""
+    if _ACTIVE_PROFILER is None:
+        yield
+        return
+    with _ACTIVE_PROFILER.phase(name):
+        yield
+
+
+def _get_frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})'.replace(';', ':')
+
+
+class PhaseProfiler:  # pylint: disable=too-many-instance-attributes
+    """Profiles the phases of a run and writes a pstats file per phase and a collapsed stacks file on stopping."""
+
+    def __init__(self, directory, sample_interval=DEFAULT_SAMPLE_INTERVAL):
+        """Initializes the profiler.
+
+        Args:
+            directory: The directory to write the profiles to, created if missing.
+            sample_interval: The number of seconds between samples of the stacks of all threads.
+
+        """
+        self._logger = logging.getLogger(f'{LOGGER_BASENAME}.{self.__class__.__name__}')
+        self.directory = Path(directory)
+        self.sample_interval = sample_interval
+        self._profiles = defaultdict(list)
+        self._phases = {}
+        self._stacks = Counter()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._sampler = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _get_profile(self, name):
+        import cProfile  # pylint: disable=import-outside-toplevel
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            self._logger.debug(f'Another profiler is active, phase {name} is only sampled on this thread.')
+            return None
+        with self._lock:
+            self._profiles[name].append(profile)
+        return profile
+
+    @contextmanager
+    def phase(self, name):
+        """Profiles the enclosed code as the phase of the provided name on the current thread."""
+        thread_id = threading.get_ident()
+        with self._lock:
+            phases = self._phases.setdefault(thread_id, [])
+        outer = phases[-1] if phases else None
+        if outer and outer[1]:
+            outer[1].disable()
+        profile = self._get_profile(name)
+        with self._lock:
+            phases.append((name, profile))
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+            with self._lock:
+                phases.pop()
+                if not phases:
+                    del self._phases[thread_id]
+            if outer and outer[1]:
+                outer[1].enable()
+
+    def _sample(self):
+        sampler_id = threading.get_ident()
+        while not self._stopped.wait(self.sample_interval):
+            with self._lock:
+                phases = {thread_id: names[-1][0] for thread_id, names in self._phases.items()}
+            if not phases:
+                continue
+            latest_phase = list(phases.values())[-1]
+            for thread_id, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                if thread_id == sampler_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_get_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(phases.get(thread_id, latest_phase))
+                self._stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        """Makes this the active profiler and starts sampling the stacks of all threads."""
+        global _ACTIVE_PROFILER  # pylint: disable=global-statement
+        _ACTIVE_PROFILER = self
+        self._stopped.clear()
+        self._sampler = threading.Thread(target=self._sample, name='profile-sampler', daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        """Stops profiling and writes the profiles.
+
+        Returns:
+            The list of the paths written.
+
+        """
+        global _ACTIVE_PROFILER  # pylint: disable=global-statement
+        _ACTIVE_PROFILER = None
+        self._stopped.set()
+        self._sampler.join()
+        return self.write()
+
+    def write(self):
+        """Writes a pstats file per phase, merging the profiles of all threads, and the collapsed stacks file.
+
+        Returns:
+            The list of the paths written.
+
+        """
+        import pstats  # pylint: disable=import-outside-toplevel
+        self.directory.mkdir(parents=True, exist_ok=True)
+        paths = []
+        with self._lock:
+            profiles = {name: list(phase_profiles) for name, phase_profiles in self._profiles.items()}
+            stacks = sorted(self._stacks.items())
+        for name, phase_profiles in profiles.items():
+            stats = None
+            for profile in phase_profiles:
+                try:
+                    stats = pstats.Stats(profile) if stats is None else stats.add(profile)
+                except TypeError:
+                    self._logger.debug(f'A profile of phase {name} recorded no calls.')
+            if stats is not None:
+                path = self.directory.joinpath(f'{name}.pstats')
+                stats.dump_stats(path)
+                paths.append(path)
+        path = self.directory.joinpath(COLLAPSED_STACKS_FILENAME)
+        with open(path, 'w', encoding='utf-8') as stacks_file:
+            stacks_file.writelines(f'{stack} {count}\n' for stack, count in stacks)
+        paths.append(path)
+        self._logger.info(f'Wrote the profiles of phases {", ".join(sorted(profiles))} to {self.directory}.')
+        return paths
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: records.py
+#
+# Copyright 2022 Sayantan Khanra
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Compact finding records and their indexes for azureenergylabelercli.
+
+.. _Google Python Style Guide:
+   https://google.github.io/styleguide/pyguide.html
+
+"""
+
+import logging
+import sys
+from collections import defaultdict
+from datetime import datetime
+from functools import lru_cache
+
+__author__ = '''Sayantan Khanra <skhanra@schubergphilis.com>'''
+__docformat__ = '''google'''
+__date__ = '''04-05-2022'''
+__copyright__ = '''Copyright 2022, Sayantan Khanra'''
+__credits__ = ["Sayantan Khanra"]
+__license__ = '''MIT'''
+__maintainer__ = '''Sayantan Khanra'''
+__email__ = '''<skhanra@schubergphilis.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''records'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+FINDING_ATTRIBUTES = {'complianceStandardId': 'compliance_standard_id',
+                      'complianceControlId': 'compliance_control_id',
+                      'complianceState': 'compliance_state',
+                      'subscriptionId': 'subscription_id',
+                      'resourceGroup': 'resource_group',
+                      'resourceType': 'resource_type',
+                      'resourceName': 'resource_name',
+                      'resourceId': 'resource_id',
+                      'severity': 'severity',
+                      'state': 'state',
+                      'recommendationId': 'recommendation_id',
+                      'recommendationName': 'recommendation_name',
+                      'recommendationDisplayName': 'recommendation_display_name',
+                      'description': 'description',
+                      'remediationSteps': 'remediation_steps',
+                      'azurePortalRecommendationLink': 'azure_portal_recommendation_link',
+                      'controlName': 'control_name'}
+
+INTERNED_FINDING_ATTRIBUTES = frozenset({'compliance_standard_id',
+                                         'compliance_control_id',
+                                         'compliance_state',
+                                         'subscription_id',
+                                         'resource_group',
+                                         'resource_type',
+                                         'severity',
+                                         'state',
+                                         'recommendation_name',
+                                         'recommendation_display_name',
+                                         'description',
+                                         'remediation_steps',
+                                         'azure_portal_recommendation_link',
+                                         'control_name'})
+
+
+@lru_cache(maxsize=4096)
+def parse_status_change_date(status_change_date):
+    """Parses a status change date the way the library does, None if it can not be parsed."""
+    try:
+        return datetime.strptime(status_change_date.split('.')[0], '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        return None
+
+
+class CompactFinding:  # pylint: disable=too-many-instance-attributes,no-member
+    """Models a finding in far less memory than the findings of the library while behaving the same.
+
+    Only the attributes used for labeling and exporting are kept, in slots instead of a dictionary of the raw data.
+    Values repeated across findings, like subscription ids, severities, frameworks and the descriptions and
+    remediation steps of recommendations, are interned so all findings share a single copy of them. The status
+    change date is parsed once.
+
+    """
+
+    __slots__ = tuple(FINDING_ATTRIBUTES.values()) + ('status_change_date',)
+
+    def __init__(self, data):
+        for key, attribute in FINDING_ATTRIBUTES.items():
+            value = data.get(key, '')
+            if attribute in INTERNED_FINDING_ATTRIBUTES and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, attribute, value)
+        self.status_change_date = parse_status_change_date(data.get('statusChangeDate') or '')
+
+    def __hash__(self):
+        return hash(self.recommendation_id)
+
+    def __eq__(self, other):
+        """Findings are equal when their recommendation ids are, like the findings of the library."""
+        if not isinstance(other, CompactFinding):
+            return NotImplemented
+        return self.recommendation_id == other.recommendation_id
+
+    @property
+    def days_open(self):
+        """Days open, -1 if the status change date is unknown."""
+        if self.status_change_date is None:
+            LOGGER.debug(f'Could not calculate number of days open of {self.recommendation_id}, '
+                         f'the status change date is missing.')
+            return -1
+        return (datetime.now() - self.status_change_date).days
+
+    @property
+    def is_skipped(self):
+        """The finding is skipped or not."""
+        return self.compliance_state.lower() == 'skipped'
+
+    def to_data(self):
+        """The raw data of the finding as retrieved from defender for cloud."""
+        data = {key: getattr(self, attribute) for key, attribute in FINDING_ATTRIBUTES.items()}
+        if self.status_change_date is not None:
+            data['statusChangeDate'] = self.status_change_date.strftime('%Y-%m-%dT%H:%M:%S')
+        return data
+
+
+class IndexedFindings(list):
+    """A list of findings indexed by subscription, by resource group name and by resource group of a subscription.
+
+    Labeling an entity looks up its findings instead of scanning all findings, turning the work of labeling every
+    subscription and resource group from the product of their number with the number of findings into a single
+    pass over the findings. Ids and names are matched case insensitively like the library does.
+
+    """
+
+    def __init__(self, findings=()):
+        super().__init__(findings)
+        self._subscriptions = defaultdict(list)
+        self._resource_groups = defaultdict(list)
+        self._resource_group_names = defaultdict(list)
+        for finding in self:
+            subscription_id = finding.subscription_id.lower()
+            resource_group = finding.resource_group.lower()
+            self._subscriptions[subscription_id].append(finding)
+            self._resource_groups[(subscription_id, resource_group)].append(finding)
+            self._resource_group_names[resource_group].append(finding)
+
+    def get_subscription_findings(self, subscription_id):
+        """The findings of a subscription."""
+        return self._subscriptions.get(subscription_id.lower(), [])
+
+    def get_resource_group_findings(self, name, subscription_id=None):
+        """The findings of a resource group.
+
+        Args:
+            name: The name of the resource group.
+            subscription_id: The subscription of the resource group, if not provided the findings of the resource
+                groups with that name in all subscriptions are returned, like the library matches them.
+
+        Returns:
+            The list of findings of the resource group.
+
+        """
+        name = name.lower()
+        if subscription_id:
+            return self._resource_groups.get((subscription_id.lower(), name), [])
+        return self._resource_group_names.get(name, [])
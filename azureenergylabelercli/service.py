@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: service.py
+#
+# Copyright 2022 Sayantan Khanra
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Long running HTTP service of energy labels for azureenergylabelercli.
+
+The service labels once on start and then on a schedule in the same process, reusing the imported modules and the
+credential of the previous runs, and answers every request from the json of the latest labels kept in memory. Every
+run builds a new labeler and new Azure clients, since a labeler holds the subscriptions and findings it retrieved
+once and serving those again would serve stale labels; the warm credential keeps its tokens across runs.
+
+.. _Google Python Style Guide:
+   https://google.github.io/styleguide/pyguide.html
+
+"""
+
+import json
+import logging
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+__author__ = '''Sayantan Khanra <skhanra@schubergphilis.com>'''
+__docformat__ = '''google'''
+__date__ = '''04-05-2022'''
+__copyright__ = '''Copyright 2022, Sayantan Khanra'''
+__credits__ = ["Sayantan Khanra"]
+__license__ = '''MIT'''
+__maintainer__ = '''Sayantan Khanra'''
+__email__ = '''<skhanra@schubergphilis.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''service'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+DEFAULT_SERVE_HOST = '127.0.0.1'
+DEFAULT_SERVE_PORT = 8080
+DEFAULT_SERVE_INTERVAL = 3600
+
+
+def get_report_json_data(report_data):
+    """Converts the rows of a report to the dictionary its json output holds."""
+    return {key.replace(':', '').replace(' ', '_').lower(): value for key, value in dict(report_data).items()}
+
+
+def _to_json(data):
+    return json.dumps(data, indent=2, default=str).encode('utf-8')
+
+
+class LabelsRequestHandler(BaseHTTPRequestHandler):
+    """Serves the latest labels of the label service of its server."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        LOGGER.debug(f'{self.address_string()} {format % args}')
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Answers with the json of the requested labels."""
+        status, body = self.server.service.get(urlparse(self.path).path)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class LabelService:  # pylint: disable=too-many-instance-attributes
+    """Keeps the labels of the latest run in memory and serves them over a local HTTP API.
+
+    The API answers GET requests on:
+        /health: The status of the service, the time of the latest labels and the error of the last run if any.
+        /labels: The reports of the latest run, like the json output of the cli.
+        /subscriptions: The labels and finding counts of all labeled subscriptions.
+        /subscriptions/<subscription id>: The label and finding counts of a subscription.
+
+    Until the first run completes every path but /health answers 503. A failing run is logged and the labels of the
+    previous run are served until the next one succeeds.
+
+    """
+
+    def __init__(self, get_reports, interval=DEFAULT_SERVE_INTERVAL):
+        """Initializes the service.
+
+        Args:
+            get_reports: A callable labeling anew, returning the export path, report data and exporter arguments of
+                every report.
+            interval: The number of seconds between the start of a run and the next one.
+
+        """
+        self._logger = logging.getLogger(f'{LOGGER_BASENAME}.{self.__class__.__name__}')
+        self._get_reports = get_reports
+        self.interval = interval
+        self._responses = None
+        self._subscriptions = {}
+        self.refreshed_at = None
+        self.last_error = None
+        self._stopped = threading.Event()
+        self._server = None
+        self._threads = []
+
+    @staticmethod
+    def _get_subscriptions_data(reports):
+        from azureenergylabelerlib.datamodels import LabeledSubscriptionData  # pylint: disable=import-outside-toplevel
+        return [LabeledSubscriptionData(None, subscription, exporter_arguments['defender_for_cloud_findings']).data
+                for _, _, exporter_arguments in reports
+                for subscription in exporter_arguments['labeled_subscriptions']]
+
+    def refresh(self):
+        """Labels anew and replaces the served labels, keeping the previous ones if labeling fails.
+
+        Returns:
+            True if the labels were replaced, False otherwise.
+
+        """
+        from .streaming import closing_streamed_findings  # pylint: disable=import-outside-toplevel
+        started_at = datetime.now(timezone.utc)
+        try:
+            reports = self._get_reports()
+            with closing_streamed_findings(reports):
+                subscriptions = self._get_subscriptions_data(reports)
+        except (Exception, SystemExit) as error:  # pylint: disable=broad-except
+            self.last_error = f'{type(error).__name__}: {error}'
+            self._logger.exception('Labeling failed, serving the previous labels.')
+            return False
+        refreshed_at = started_at.isoformat()
+        responses = {'/labels': _to_json({'refreshed_at': refreshed_at,
+                                          'reports': [get_report_json_data(report_data)
+                                                      for _, report_data, _ in reports]}),
+                     '/subscriptions': _to_json({'refreshed_at': refreshed_at,
+                                                 'subscriptions': subscriptions})}
+        self._subscriptions = {subscription['Subscription ID'].lower(): _to_json(dict(subscription,
+                                                                                      refreshed_at=refreshed_at))
+                               for subscription in subscriptions}
+        self._responses = responses
+        self.refreshed_at = refreshed_at
+        self.last_error = None
+        self._logger.info(f'Labeled {len(subscriptions)} subscriptions in '
+                          f'{(datetime.now(timezone.utc) - started_at).total_seconds():.1f} seconds.')
+        return True
+
+    def get(self, path):
+        """Gets the status code and json body answering a request for a path."""
+        path = path.rstrip('/') or '/'
+        responses = self._responses
+        if path == '/health':
+            status = 'ok' if responses else ('error' if self.last_error else 'starting')
+            return (200 if responses else 503), _to_json({'status': status,
+                                                          'refreshed_at': self.refreshed_at,
+                                                          'last_error': self.last_error})
+        if responses is None:
+            return 503, _to_json({'error': 'The labels are being calculated, retry later.'})
+        if path in responses:
+            return 200, responses[path]
+        if path.startswith('/subscriptions/'):
+            subscription = self._subscriptions.get(path.split('/', 2)[2].lower())
+            if subscription:
+                return 200, subscription
+        return 404, _to_json({'error': f'{path} not found.'})
+
+    def _refresh_periodically(self):
+        self.refresh()
+        while not self._stopped.wait(self.interval):
+            self.refresh()
+
+    def start(self, host=DEFAULT_SERVE_HOST, port=DEFAULT_SERVE_PORT):
+        """Starts labeling on the schedule and serving the labels in the background.
+
+        Returns:
+            The host and port the service listens on.
+
+        """
+        self._server = ThreadingHTTPServer((host, port), LabelsRequestHandler)
+        self._server.daemon_threads = True
+        self._server.service = self
+        self._threads = [threading.Thread(target=self._refresh_periodically, name='labels-refresh', daemon=True),
+                         threading.Thread(target=self._server.serve_forever, name='labels-server', daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        self._logger.info(f'Serving the labels on http://{host}:{self._server.server_address[1]}/ '
+                          f'refreshing them every {self.interval} seconds.')
+        return self._server.server_address
+
+    def wait(self):
+        """Blocks until the service is stopped."""
+        self._stopped.wait()
+
+    def stop(self):
+        """Stops serving and labeling, waiting for a running labeling to finish."""
+        self._stopped.set()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+        for thread in self._threads:
+            thread.join()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: snapshot.py
+#
+# Copyright 2022 Sayantan Khanra
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Loading of saved findings snapshots for azureenergylabelercli.
+
+.. _Google Python Style Guide:
+   https://google.github.io/styleguide/pyguide.html
+
+"""
+
+import json
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+from types import SimpleNamespace
+
+from azureenergylabelerlib.configuration import FILE_EXPORT_TYPES
+
+from .azureenergylabelercliexceptions import InvalidFindingsSnapshot
+from .compression import get_compressed_filename, get_compression, open_decompressed
+
+try:
+    from pyarrow import parquet
+except ImportError:
+    parquet = None
+
+__author__ = '''Sayantan Khanra <skhanra@schubergphilis.com>'''
+__docformat__ = '''google'''
+__date__ = '''04-05-2022'''
+__copyright__ = '''Copyright 2022, Sayantan Khanra'''
+__credits__ = ["Sayantan Khanra"]
+__license__ = '''MIT'''
+__maintainer__ = '''Sayantan Khanra'''
+__email__ = '''<skhanra@schubergphilis.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''snapshot'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+EXPORTED_FINDING_KEYS = {'Compliance Standard ID': 'complianceStandardId',
+                         'Compliance Control ID': 'complianceControlId',
+                         'Compliance State': 'complianceState',
+                         'Subscription ID': 'subscriptionId',
+                         'Resource Group': 'resourceGroup',
+                         'Resource Type': 'resourceType',
+                         'Resource Name': 'resourceName',
+                         'Resource ID': 'resourceId',
+                         'Severity': 'severity',
+                         'State': 'state',
+                         'Recommendation ID': 'recommendationId',
+                         'Recommendation Name': 'recommendationName',
+                         'Recommendation Display Name': 'recommendationDisplayName',
+                         'Description': 'description',
+                         'Remediation Steps': 'remediationSteps',
+                         'Azure Portal Recommendation Link': 'azurePortalRecommendationLink',
+                         'Control Name': 'controlName'}
+
+
+def get_export_filename(export_type):
+    """Gets the filename the DataExporter uses for an export type."""
+    return next(datafile.get('filename') for datafile in FILE_EXPORT_TYPES if datafile.get('type') == export_type)
+
+
+def exported_finding_to_finding_data(exported_finding, now=None):
+    """Converts a finding as exported by the DataExporter back to the data retrieved from Azure.
+
+    The export only holds the number of days a finding was open, so the status change date is set to that many
+    days ago so labeling the finding again results in the same number of days open.
+
+    Args:
+        exported_finding: A dictionary of a finding as exported.
+        now: The point in time to calculate the status change date from, defaults to the current time.
+
+    Returns:
+        The dictionary of the finding as retrieved from defender for cloud.
+
+    """
+    finding_data = {key: exported_finding.get(exported_key, '')
+                    for exported_key, key in EXPORTED_FINDING_KEYS.items()}
+    days_open = exported_finding.get('Days Open')
+    if isinstance(days_open, int) and days_open >= 0:
+        status_change_date = (now or datetime.now()) - timedelta(days=days_open)
+        finding_data['statusChangeDate'] = status_change_date.strftime('%Y-%m-%dT%H:%M:%S')
+    return finding_data
+
+
+class FindingsSnapshot:
+    """Models a saved snapshot of findings along with the subscription data exported next to it.
+
+    The findings file can either be the findings export of the DataExporter, as json or newline delimited json, or a
+    list of findings as retrieved from defender for cloud, compressed or not, or the parquet findings export. If the
+    subscription, resource group or exempted policies exports are found in the same directory, compressed like the
+    findings file or as parquet next to parquet findings, they are used to restore the subscriptions, else the
+    subscriptions are derived from the findings.
+
+    """
+
+    def __init__(self, path):
+        self._logger = logging.getLogger(f'{LOGGER_BASENAME}.{self.__class__.__name__}')
+        self.path = Path(path)
+        self._findings_data = None
+        self._subscriptions_data = None
+
+    def _load(self, path):
+        if Path(path).suffix == '.parquet':
+            return self._load_parquet(path)
+        try:
+            with open_decompressed(path) as snapshot_file:
+                if '.ndjson' in Path(path).suffixes:
+                    return [json.loads(line) for line in snapshot_file if line.strip()]
+                return json.load(snapshot_file)
+        except (OSError, ValueError) as error:
+            raise InvalidFindingsSnapshot(f'Could not load {path}: {error}') from None
+
+    @staticmethod
+    def _load_parquet(path):
+        if parquet is None:
+            raise InvalidFindingsSnapshot(f'Could not load {path}, reading parquet requires pyarrow, '
+                                          f'install it with "pip install pyarrow".')
+        try:
+            return parquet.read_table(path).to_pylist()
+        except (OSError, ValueError) as error:
+            raise InvalidFindingsSnapshot(f'Could not load {path}: {error}') from None
+
+    def _load_sibling(self, export_type):
+        filename = get_export_filename(export_type)
+        if self.path.suffix == '.parquet' and self.path.parent.joinpath(filename).with_suffix('.parquet').is_file():
+            path = self.path.parent.joinpath(filename).with_suffix('.parquet')
+        else:
+            path = self.path.parent.joinpath(get_compressed_filename(filename, get_compression(self.path)))
+        if not path.is_file() or path == self.path:
+            return []
+        self._logger.debug(f'Loading {path} from the snapshot.')
+        return self._load(path)
+
+    @property
+    def findings_data(self):
+        """The findings of the snapshot as retrieved from defender for cloud."""
+        if self._findings_data is None:
+            findings = self._load(self.path)
+            if not isinstance(findings, list):
+                raise InvalidFindingsSnapshot(f'{self.path} does not contain a list of findings.')
+            now = datetime.now()
+            self._findings_data = [exported_finding_to_finding_data(finding, now) if 'Subscription ID' in finding
+                                   else finding for finding in findings]
+            self._logger.info(f'Loaded {len(self._findings_data)} findings from {self.path}.')
+        return self._findings_data
+
+    @property
+    def subscriptions_data(self):
+        """The subscriptions of the snapshot with their display name, resource group names and exempted policies."""
+        if self._subscriptions_data is None:
+            subscriptions = defaultdict(lambda: {'display_name': None,
+                                                 'resource_group_names': set(),
+                                                 'exempted_policies': []})
+            for finding in self.findings_data:
+                subscription = subscriptions[finding.get('subscriptionId')]
+                if finding.get('resourceGroup'):
+                    subscription['resource_group_names'].add(finding.get('resourceGroup'))
+            labeled_subscriptions = self._load_sibling('subscription_energy_label')
+            if not labeled_subscriptions:
+                tenant_data = self._load_sibling('tenant_energy_label')
+                labeled_subscriptions = tenant_data[0].get('Labeled subscriptions', []) if tenant_data else []
+            for labeled_subscription in labeled_subscriptions:
+                subscriptions[labeled_subscription.get('Subscription ID')]['display_name'] = labeled_subscription.get(
+                    'Subscription Display Name')
+            for resource_group in self._load_sibling('resource_group_energy_label'):
+                subscriptions[resource_group.get('Subscription ID')]['resource_group_names'].add(
+                    resource_group.get('ResourceGroup Name'))
+            for policy in self._load_sibling('exempted_policies'):
+                subscriptions[policy.get('Subscription ID')]['exempted_policies'].append(
+                    SimpleNamespace(system_data=SimpleNamespace(created_at=policy.get('Created At'),
+                                                                created_by=policy.get('Created By'),
+                                                                last_modified_by=policy.get('Last Modified By'),
+                                                                last_modified_at=policy.get('Last Modified At')),
+                                    description=policy.get('Description'),
+                                    display_name=policy.get('Display Name'),
+                                    exemption_category=policy.get('Exemption Category'),
+                                    name=policy.get('Name'),
+                                    expires_on=policy.get('Expires On')))
+            self._subscriptions_data = {subscription_id: data for subscription_id, data in
+                                        sorted(subscriptions.items()) if subscription_id}
+        return self._subscriptions_data
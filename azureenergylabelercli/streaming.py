@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: streaming.py
+#
+# Copyright 2022 Sayantan Khanra
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Streaming of defender for cloud findings for azureenergylabelercli.
+
+Findings flow page by page from the resource graph through a bounded buffer, are aggregated per subscription and
+resource group as they arrive and are spooled to a temporary file, so memory does not grow with the number of
+findings.
+
+.. _Google Python Style Guide:
+   https://google.github.io/styleguide/pyguide.html
+
+"""
+
+import json
+import logging
+import queue
+import tempfile
+import threading
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+
+from azure.mgmt.resourcegraph.models import QueryRequest, QueryRequestOptions
+from azureenergylabelerlib.configuration import FINDINGS_QUERY_STRING, FINDING_FILTERING_STATES
+
+from .records import CompactFinding, FINDING_ATTRIBUTES
+from .snapshot import EXPORTED_FINDING_KEYS, get_export_filename
+
+__author__ = '''Sayantan Khanra <skhanra@schubergphilis.com>'''
+__docformat__ = '''google'''
+__date__ = '''04-05-2022'''
+__copyright__ = '''Copyright 2022, Sayantan Khanra'''
+__credits__ = ["Sayantan Khanra"]
+__license__ = '''MIT'''
+__maintainer__ = '''Sayantan Khanra'''
+__email__ = '''<skhanra@schubergphilis.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''streaming'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+DEFAULT_STREAM_BUFFER_SIZE = 4
+
+_END_OF_STREAM = object()
+
+
+def get_findings_query(framework, since=None):
+    """Gets the resource graph query of the findings of a framework.
+
+    Args:
+        framework: The framework to retrieve the findings of.
+        since: If provided only the findings whose status changed after this UTC datetime are retrieved.
+
+    Returns:
+        The query string.
+
+    """
+    query = FINDINGS_QUERY_STRING.format(framework=framework)
+    if since is None:
+        return query
+    return f'{query}    | where todatetime(statusChangeDate) > datetime({since.strftime("%Y-%m-%dT%H:%M:%SZ")})'
+
+
+def iter_query_pages(client, subscription_ids, query):
+    """Retrieves the results of a resource graph query page by page.
+
+    Args:
+        client: The resource graph client to query.
+        subscription_ids: The subscription ids to run the query on.
+        query: The query string to run.
+
+    Returns:
+        A generator of the lists of results, one per page.
+
+    """
+    skip_token = None
+    while True:
+        response = client.resources(QueryRequest(subscriptions=subscription_ids,
+                                                 query=query,
+                                                 options=QueryRequestOptions(result_format='objectArray',
+                                                                             skip_token=skip_token)))
+        yield response.data
+        skip_token = response.skip_token
+        if not skip_token:
+            break
+
+
+def iter_findings_pages(client, subscription_ids, frameworks, since=None):
+    """Retrieves the raw findings of the subscriptions page by page.
+
+    Args:
+        client: The resource graph client to query.
+        subscription_ids: The subscription ids to retrieve the findings of.
+        frameworks: The frameworks to retrieve the findings of.
+        since: If provided only the findings whose status changed after this UTC datetime are retrieved.
+
+    Returns:
+        A generator of the lists of raw findings data, one per page.
+
+    """
+    for framework in frameworks:
+        yield from iter_query_pages(client, subscription_ids, get_findings_query(framework, since))
+
+
+def buffered(iterable, size=DEFAULT_STREAM_BUFFER_SIZE):
+    """Produces the items of an iterable on a separate thread holding at most size of them in between.
+
+    The producer blocks once the buffer is full, so a slow consumer bounds the number of items in memory. Errors of
+    the producer are raised to the consumer and closing the generator early stops the producer.
+
+    Args:
+        iterable: The iterable to produce the items of.
+        size: The maximum number of items produced but not yet consumed.
+
+    Returns:
+        A generator of the items of the iterable.
+
+    """
+    buffer = queue.Queue(maxsize=size)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception as error:  # pylint: disable=broad-except
+            put(error)
+            return
+        put(_END_OF_STREAM)
+
+    producer = threading.Thread(target=produce, name='findings-producer', daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _END_OF_STREAM:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+        producer.join()
+
+
+def get_exported_finding(finding):
+    """Gets the dictionary of a finding as exported by the DataExporter."""
+    exported_finding = {exported_key: getattr(finding, FINDING_ATTRIBUTES[key])
+                        for exported_key, key in EXPORTED_FINDING_KEYS.items()}
+    exported_finding['Days Open'] = finding.days_open
+    return exported_finding
+
+
+def write_findings_json(findings, output_file):
+    """Writes the findings export incrementally, identical to the one of the DataExporter for the same findings.
+
+    Args:
+        findings: An iterable of findings, skipped findings are not written.
+        output_file: A text file to write to.
+
+    """
+    separator = '[\n  '
+    for finding in findings:
+        if finding.is_skipped:
+            continue
+        output_file.write(separator)
+        output_file.write(json.dumps(get_exported_finding(finding), indent=2, default=str).replace('\n', '\n  '))
+        separator = ',\n  '
+    output_file.write('[]' if separator == '[\n  ' else '\n]')
+
+
+def write_findings_ndjson(findings, output_file):
+    """Writes the findings export as newline delimited json, one exported finding per line.
+
+    Args:
+        findings: An iterable of findings, skipped findings are not written.
+        output_file: A text file to write to.
+
+    """
+    for finding in findings:
+        if finding.is_skipped:
+            continue
+        output_file.write(json.dumps(get_exported_finding(finding), default=str))
+        output_file.write('\n')
+
+
+FINDINGS_EXPORT_WRITERS = {'json': write_findings_json,
+                           'ndjson': write_findings_ndjson}
+
+
+def get_findings_export_filename(findings_format='json'):
+    """Gets the filename of the findings export in a format, the one of the DataExporter with its suffix."""
+    return str(Path(get_export_filename('findings')).with_suffix(f'.{findings_format}'))
+
+
+class FindingsSummary:
+    """Counts the findings of a subscription or resource group to label it without keeping them."""
+
+    def __init__(self):
+        self.number_of_findings = 0
+        self.number_of_high_findings = 0
+        self.number_of_medium_findings = 0
+        self.number_of_low_findings = 0
+        self.max_days_open = None
+
+    def add(self, severity, days_open):
+        """Counts a finding of a severity open for a number of days."""
+        self.number_of_findings += 1
+        if severity == 'High':
+            self.number_of_high_findings += 1
+        elif severity == 'Medium':
+            self.number_of_medium_findings += 1
+        elif severity == 'Low':
+            self.number_of_low_findings += 1
+        self.max_days_open = days_open if self.max_days_open is None else max(self.max_days_open, days_open)
+
+    def get_energy_label(self, thresholds, energy_label_class):
+        """Calculates the energy label of the counted findings the same way the library labels a list of findings.
+
+        Args:
+            thresholds: The thresholds of the labeled entity.
+            energy_label_class: The class of the energy label to return.
+
+        Returns:
+            The energy label of the counted findings.
+
+        """
+        if not self.number_of_findings:
+            return energy_label_class('A', 0, 0, 0, 0)
+        label = next((threshold['label'] for threshold in thresholds
+                      if all([self.number_of_high_findings <= threshold['high'],
+                              self.number_of_medium_findings <= threshold['medium'],
+                              self.number_of_low_findings <= threshold['low'],
+                              self.max_days_open < threshold['days_open_less_than']])), 'F')
+        return energy_label_class(label,
+                                  self.number_of_high_findings,
+                                  self.number_of_medium_findings,
+                                  self.number_of_low_findings,
+                                  self.max_days_open)
+
+
+class StreamedFindings:
+    """Findings aggregated per subscription and resource group as they stream in, spooled to a temporary file.
+
+    Only findings that count towards a label, so not skipped and not in a filtered state, are kept. Iterating reads
+    them back from the spool one at a time.
+
+    """
+
+    def __init__(self):
+        self._logger = logging.getLogger(f'{LOGGER_BASENAME}.{self.__class__.__name__}')
+        self._spool = tempfile.TemporaryFile('w+', encoding='utf-8')  # pylint: disable=consider-using-with
+        self._subscriptions = defaultdict(FindingsSummary)
+        self._resource_groups = defaultdict(FindingsSummary)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        self._spool.flush()
+        self._spool.seek(0)
+        for line in self._spool:
+            yield CompactFinding(json.loads(line))
+
+    def add(self, finding):
+        """Aggregates and spools a finding if it counts towards a label."""
+        if finding.is_skipped or finding.state in FINDING_FILTERING_STATES:
+            return
+        self._count += 1
+        days_open = finding.days_open
+        self._subscriptions[finding.subscription_id.lower()].add(finding.severity, days_open)
+        self._resource_groups[finding.resource_group.lower()].add(finding.severity, days_open)
+        self._spool.seek(0, 2)
+        self._spool.write(json.dumps(finding.to_data(), default=str))
+        self._spool.write('\n')
+
+    def get_subscription_summary(self, subscription_id):
+        """The summary of the findings of a subscription."""
+        return self._subscriptions.get(subscription_id.lower(), FindingsSummary())
+
+    def get_resource_group_summary(self, name):
+        """The summary of the findings of a resource group name, matched across subscriptions like the library."""
+        return self._resource_groups.get(name.lower(), FindingsSummary())
+
+    def close(self):
+        """Removes the spooled findings."""
+        self._spool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+@contextmanager
+def closing_streamed_findings(reports):
+    """Removes the spooled findings of the streamed reports once done with them.
+
+    Args:
+        reports: The export path, report data and exporter arguments of every report.
+
+    Yields:
+        The reports.
+
+    """
+    with ExitStack() as stack:
+        for _, _, exporter_arguments in reports:
+            findings = exporter_arguments.get('defender_for_cloud_findings')
+            if isinstance(findings, StreamedFindings):
+                stack.enter_context(findings)
+        yield reports
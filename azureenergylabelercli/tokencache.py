@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: tokencache.py
+#
+# Copyright 2022 Sayantan Khanra
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Encrypted on-disk cache of access tokens for azureenergylabelercli.
+
+Short runs reuse the tokens acquired by earlier runs for the same tenant and identity until shortly before they
+expire, instead of acquiring new ones every time.
+
+.. _Google Python Style Guide:
+   https://google.github.io/styleguide/pyguide.html
+
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from azure.core.credentials import AccessToken
+
+from .azureenergylabelercliexceptions import TokenCacheUnavailable
+from .cache import file_lock
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = InvalidToken = None
+
+__author__ = '''Sayantan Khanra <skhanra@schubergphilis.com>'''
+__docformat__ = '''google'''
+__date__ = '''04-05-2022'''
+__copyright__ = '''Copyright 2022, Sayantan Khanra'''
+__credits__ = ["Sayantan Khanra"]
+__license__ = '''MIT'''
+__maintainer__ = '''Sayantan Khanra'''
+__email__ = '''<skhanra@schubergphilis.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''tokencache'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+DEFAULT_TOKEN_REFRESH_AHEAD = 300
+KEY_DERIVATION_SALT = b'azureenergylabelercli-token-cache'
+KEY_DERIVATION_ITERATIONS = 100000
+
+
+def get_default_identity():
+    """The identity tokens are acquired for, the client id of the service principal or managed identity if set."""
+    return os.environ.get('AZURE_CLIENT_ID') or 'default'
+
+
+class EncryptedTokenCache:
+    """Keeps access tokens encrypted in a local file, shared by concurrent runs through a file lock.
+
+    The tokens are encrypted with a key derived from the passphrase if provided, else with a random key kept in a key
+    file next to the cache only readable by the user. A cache that can not be decrypted is treated as empty.
+
+    """
+
+    def __init__(self, path, passphrase=None):
+        if Fernet is None:
+            raise TokenCacheUnavailable('The token cache requires cryptography, '
+                                        'install it with "pip install azureenergylabelercli[tokencache]".')
+        self._logger = logging.getLogger(f'{LOGGER_BASENAME}.{self.__class__.__name__}')
+        self.path = Path(path)
+        self._passphrase = passphrase
+        self._fernet = None
+
+    def _get_key(self):
+        if self._passphrase:
+            key = hashlib.pbkdf2_hmac('sha256', self._passphrase.encode('utf-8'), KEY_DERIVATION_SALT,
+                                      KEY_DERIVATION_ITERATIONS)
+            return base64.urlsafe_b64encode(key)
+        key_path = self.path.with_name(f'{self.path.name}.key')
+        try:
+            return key_path.read_bytes()
+        except FileNotFoundError:
+            pass
+        key = Fernet.generate_key()
+        descriptor = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(descriptor, 'wb') as key_file:
+            key_file.write(key)
+        self._logger.debug(f'Created the token cache key {key_path}.')
+        return key
+
+    @property
+    def _cipher(self):
+        if self._fernet is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with file_lock(self.path.with_name(f'{self.path.name}.lock')):
+                self._fernet = Fernet(self._get_key())
+        return self._fernet
+
+    def _read(self):
+        try:
+            return json.loads(self._cipher.decrypt(self.path.read_bytes()))
+        except FileNotFoundError:
+            return {}
+        except (InvalidToken, ValueError):
+            self._logger.warning(f'Could not decrypt the token cache {self.path}, ignoring it.')
+            return {}
+
+    def get(self, key):
+        """Gets the token and its expiry in seconds since the epoch cached under a key, None if there is none."""
+        entry = self._read().get(key)
+        return (entry['token'], entry['expires_on']) if entry else None
+
+    def set(self, key, token, expires_on):
+        """Caches a token under a key, dropping the expired tokens."""
+        cipher = self._cipher
+        with file_lock(self.path.with_name(f'{self.path.name}.lock')):
+            now = time.time()
+            entries = {cached_key: entry for cached_key, entry in self._read().items() if entry['expires_on'] > now}
+            entries[key] = {'token': token, 'expires_on': expires_on}
+            with tempfile.NamedTemporaryFile('wb', dir=self.path.parent, suffix='.tmp', delete=False) as cache_file:
+                cache_file.write(cipher.encrypt(json.dumps(entries).encode('utf-8')))
+            os.chmod(cache_file.name, 0o600)
+            os.replace(cache_file.name, self.path)
+
+
+class CachedTokenCredential:
+    """Wraps an Azure credential to reuse its access tokens across runs through an encrypted token cache.
+
+    Tokens are cached per tenant, identity and scopes. A cached token is used until less than the refresh ahead
+    number of seconds are left before it expires, then a new one is acquired, so requests never race its expiry.
+    Requests for tokens with claims, like continuous access evaluation challenges, always go to the credential.
+
+    """
+
+    def __init__(self, credential, token_cache, tenant_id, identity=None, refresh_ahead=DEFAULT_TOKEN_REFRESH_AHEAD):
+        """Initializes the credential.
+
+        Args:
+            credential: The Azure credential to acquire tokens with.
+            token_cache: The encrypted token cache to keep the tokens in.
+            tenant_id: The tenant the tokens are acquired for.
+            identity: The identity the tokens are acquired for, defaults to the client id in the environment.
+            refresh_ahead: The number of seconds before expiry a cached token is replaced.
+
+        """
+        self._logger = logging.getLogger(f'{LOGGER_BASENAME}.{self.__class__.__name__}')
+        self._credential = credential
+        self._token_cache = token_cache
+        self.tenant_id = tenant_id
+        self.identity = identity or get_default_identity()
+        self.refresh_ahead = refresh_ahead
+        self._lock = threading.Lock()
+
+    def _get_key(self, scopes, tenant_id, enable_cae):
+        return json.dumps([tenant_id or self.tenant_id, self.identity, sorted(scopes), bool(enable_cae)])
+
+    def get_token(self, *scopes, claims=None, tenant_id=None, enable_cae=False, **kwargs):
+        """Gets an access token for the scopes, from the cache unless it is about to expire."""
+        if claims:
+            return self._credential.get_token(*scopes, claims=claims, tenant_id=tenant_id, enable_cae=enable_cae,
+                                              **kwargs)
+        key = self._get_key(scopes, tenant_id, enable_cae)
+        with self._lock:
+            cached = self._token_cache.get(key)
+            if cached and cached[1] - time.time() > self.refresh_ahead:
+                self._logger.debug(f'Reusing the cached token for {" ".join(scopes)}.')
+                return AccessToken(*cached)
+            arguments = {'tenant_id': tenant_id} if tenant_id else {}
+            if enable_cae:
+                arguments['enable_cae'] = enable_cae
+            token = self._credential.get_token(*scopes, **arguments, **kwargs)
+            self._token_cache.set(key, token.token, token.expires_on)
+            self._logger.debug(f'Cached a new token for {" ".join(scopes)} expiring at {token.expires_on}.')
+            return token
+
+    def close(self):
+        """Closes the wrapped credential."""
+        close = getattr(self._credential, 'close', None)
+        if close:
+            close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
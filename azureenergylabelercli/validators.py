@@ -34,9 +34,7 @@ import argparse
 import logging
 
 from argparse import ArgumentTypeError
-
-from azureenergylabelerlib import (is_valid_subscription_id,
-                                   DestinationPath)
+from urllib.parse import urlparse
 
 from .azureenergylabelercliexceptions import (MissingRequiredArguments,
                                               MutuallyExclusiveArguments)
@@ -57,6 +55,23 @@ LOGGER_BASENAME = '''validators'''
 LOGGER = logging.getLogger(LOGGER_BASENAME)
 LOGGER.addHandler(logging.NullHandler())
 
+EMULATOR_HOSTNAMES = ('localhost', '127.0.0.1')
+
+
+def is_valid_export_path(path):
+    """Checks that a path is a local directory, a Storage Account Container url or the url of a local emulator.
+
+    Mirrors the checks of the destination path of the exports without importing them, so parsing the arguments does
+    not import the library and the Azure SDKs.
+
+    """
+    parsed_url = urlparse(path)
+    if not parsed_url.path:
+        return False
+    if parsed_url.scheme in ('http', 'https') and parsed_url.hostname in EMULATOR_HOSTNAMES:
+        return True
+    return 'blob.core.windows.net' in parsed_url.netloc or not (parsed_url.scheme or parsed_url.netloc)
+
 
 class ValidatePath(argparse.Action):
     """Validates a given path."""
@@ -67,22 +82,34 @@ class ValidatePath(argparse.Action):
         super().__init__(option_strings, dest, **kwargs)
 
     def __call__(self, parser, namespace, values, option_string=None):
-        destination = DestinationPath(values)
-        if not destination.is_valid():
+        if not is_valid_export_path(values):
             raise argparse.ArgumentTypeError(f'{values} is an invalid export location. '
                                              f'Example --export-path /a/directory or '
                                              f'--export-path https://<<my_storage_account>>.blob.core.windows.net/'  # noqa: E231
-                                             f'<<my_container>>/')
+                                             f'<<my_container>>/ or for a local emulator --export-path '
+                                             f'http://127.0.0.1:10000/<<my_storage_account>>/<<my_container>>/')
         setattr(namespace, self.dest, values)
 
 
 def azure_subscription_id(subscription_id):
     """Setting a type for an subscription id argument."""
+    from azureenergylabelerlib import is_valid_subscription_id  # pylint: disable=import-outside-toplevel
     if not is_valid_subscription_id(subscription_id):
         raise ArgumentTypeError(f'Subscription id {subscription_id} provided does not seem to be valid.')
     return subscription_id
 
 
+def positive_integer(value):
+    """Setting a type for an argument that has to be a positive integer."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise ArgumentTypeError(f'{value} is not an integer.') from None
+    if number < 1:
+        raise ArgumentTypeError(f'{value} is not a positive integer.')
+    return number
+
+
 def get_mutually_exclusive_args(arg1, arg2, required=False, msg=None):
     """Test if multiple mutually exclusive arguments are provided.
 
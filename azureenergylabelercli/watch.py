@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: watch.py
+#
+# Copyright 2022 Sayantan Khanra
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Watching of energy labels for changes for azureenergylabelercli.
+
+.. _Google Python Style Guide:
+   https://google.github.io/styleguide/pyguide.html
+
+"""
+
+import logging
+import threading
+import time
+
+from .service import get_report_json_data
+
+__author__ = '''Sayantan Khanra <skhanra@schubergphilis.com>'''
+__docformat__ = '''google'''
+__date__ = '''04-05-2022'''
+__copyright__ = '''Copyright 2022, Sayantan Khanra'''
+__credits__ = ["Sayantan Khanra"]
+__license__ = '''MIT'''
+__maintainer__ = '''Sayantan Khanra'''
+__email__ = '''<skhanra@schubergphilis.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''watch'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+
+def get_labeled_entities(tenant_id, reports):
+    """Gets the label and finding counts of the tenant, subscriptions and resource groups of the reports.
+
+    Args:
+        tenant_id: The tenant labeled, its report is the one with its id if any.
+        reports: The export path, report data and exporter arguments of every report.
+
+    Returns:
+        A dictionary of the exported data of every entity by entity type and name.
+
+    """
+    # pylint: disable=import-outside-toplevel
+    from azureenergylabelerlib.datamodels import LabeledResourceGroupData, LabeledSubscriptionData
+    entities = {}
+    for _, report_data, exporter_arguments in reports:
+        if exporter_arguments['id'] == tenant_id:
+            entities[('tenant', tenant_id)] = get_report_json_data(report_data)
+        findings = exporter_arguments['defender_for_cloud_findings']
+        for subscription in exporter_arguments['labeled_subscriptions']:
+            entities[('subscription', subscription.subscription_id)] = LabeledSubscriptionData(None,
+                                                                                             subscription,
+                                                                                             findings).data
+            for resource_group in subscription.resource_groups:
+                data = LabeledResourceGroupData(None,
+                                                {'subscription_id': subscription.subscription_id,
+                                                 'labeled_resource_group': resource_group},
+                                                findings).data
+                entities[('resource group', f'{subscription.subscription_id}/{resource_group.name}')] = data
+    return entities
+
+
+def get_label_changes(previous, current):
+    """Gets the entities added, removed or whose label or finding counts changed between two runs.
+
+    Args:
+        previous: The labeled entities of the previous run.
+        current: The labeled entities of the current run.
+
+    Returns:
+        A list of dictionaries of the entity type, name and previous and current data of every changed entity, the
+            previous data of added entities and the current data of removed ones being None.
+
+    """
+    changes = []
+    for entity, name in sorted(previous.keys() | current.keys()):
+        previous_data, current_data = previous.get((entity, name)), current.get((entity, name))
+        if previous_data != current_data:
+            changes.append({'entity': entity, 'name': name, 'previous': previous_data, 'current': current_data})
+    return changes
+
+
+class LabelWatcher:
+    """Labels on an interval keeping the labels of the last run in memory to report only what changed."""
+
+    def __init__(self, get_reports, tenant_id, interval):
+        """Initializes the watcher.
+
+        Args:
+            get_reports: A callable labeling anew, returning the export path, report data and exporter arguments of
+                every report.
+            tenant_id: The tenant labeled.
+            interval: The number of seconds between the start of a run and the next one.
+
+        """
+        self._logger = logging.getLogger(f'{LOGGER_BASENAME}.{self.__class__.__name__}')
+        self._get_reports = get_reports
+        self.tenant_id = tenant_id
+        self.interval = interval
+        self._entities = None
+        self._stopped = threading.Event()
+
+    def run_once(self):
+        """Labels anew.
+
+        Returns:
+            The reports of the run and the changes since the previous run, None on the first run.
+
+        """
+        reports = self._get_reports()
+        entities = get_labeled_entities(self.tenant_id, reports)
+        changes = None if self._entities is None else get_label_changes(self._entities, entities)
+        self._entities = entities
+        return reports, changes
+
+    def run(self, on_run):
+        """Labels every interval until stopped, keeping the labels of the last good run if a run fails.
+
+        Args:
+            on_run: A callable provided the reports and changes of every run.
+
+        """
+        while not self._stopped.is_set():
+            start = time.monotonic()
+            entities = self._entities
+            try:
+                on_run(*self.run_once())
+            except (Exception, SystemExit):  # pylint: disable=broad-except
+                self._entities = entities
+                self._logger.exception('Labeling failed, keeping the previous labels until the next run.')
+            self._stopped.wait(max(0, self.interval - (time.monotonic() - start)))
+
+    def stop(self):
+        """Stops after the current run."""
+        self._stopped.set()
@@ -38,6 +38,13 @@ setup(
                  '''azureenergylabelercli'''},
     include_package_data=True,
     install_requires=requirements,
+    extras_require={
+        'async': ['aiohttp>=3.8'],
+        'zstd': ['zstandard>=0.18'],
+        'parquet': ['pyarrow>=10'],
+        'jobs': ['PyYAML>=5.1'],
+        'tokencache': ['cryptography>=3.1'],
+    },
     license='MIT',
     zip_safe=False,
     keywords='''azureenergylabelercli ''',
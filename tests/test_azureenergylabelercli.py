@@ -33,13 +33,71 @@ Tests for `azureenergylabelercli` module.
 
 """
 
+import asyncio
+import base64
+import gzip
+import io
 import json
+import os
+import pickle
+import pstats
+import re
+import sqlite3
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, closing, contextmanager, redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from pathlib import Path
+from types import SimpleNamespace
 from unittest.mock import patch
+from urllib.error import HTTPError
+from urllib.parse import parse_qs, urlparse
+from urllib.request import urlopen
 
-from azureenergylabelercli.azureenergylabelercli import get_arguments
-from azureenergylabelercli.azureenergylabelercliexceptions import MissingRequiredArguments
+from azure.identity import ManagedIdentityCredential
+from azure.storage.blob import BlobServiceClient
+
+import azure_energy_labeler_cli
+import azureenergylabelercli
+from azureenergylabelercli.azureenergylabelercli import (get_arguments,
+                                                         get_labeler,
+                                                         get_subscription_reporting_data,
+                                                         get_subscriptions_reporting_data,
+                                                         get_tenant_reporting_data,
+                                                         wait_for_findings)
+from azureenergylabelercli.azureenergylabelercliexceptions import (CompressionUnavailable,
+                                                                   InvalidJobsFile,
+                                                                   MissingRequiredArguments,
+                                                                   MutuallyExclusiveArguments,
+                                                                   ParquetExportUnavailable,
+                                                                   TokenCacheUnavailable)
+from azureenergylabelercli.columnar import pyarrow, write_findings_parquet
+from azureenergylabelercli.compression import compressed_writer, open_decompressed, zstandard
+from azureenergylabelercli.cache import FindingsCache
+from azureenergylabelercli.entities import BlobServiceClients, DataExporter, get_export_sub_path
+from azureenergylabelercli.history import HistoryStore
+from azureenergylabelercli.incremental import IncrementalState
+from azureenergylabelercli.jobs import load_jobs
+from azureenergylabelercli.manifest import CONTENT_HASH_METADATA_KEY, MANIFEST_FILENAME
+from azureenergylabelercli.multitenant import get_default_tenant_workers, label_tenants
+from azureenergylabelercli.profiling import COLLAPSED_STACKS_FILENAME
+from azureenergylabelercli.records import CompactFinding, IndexedFindings
+from azureenergylabelercli.service import LabelService
+from azureenergylabelercli.snapshot import FindingsSnapshot
+from azureenergylabelercli.streaming import StreamedFindings, buffered, write_findings_json
+from azureenergylabelercli.tokencache import DEFAULT_TOKEN_REFRESH_AHEAD, CachedTokenCredential, EncryptedTokenCache
+from azureenergylabelercli.watch import LabelWatcher
+from azureenergylabelerlib.datamodels import DefenderForCloudFindingsData
+from azureenergylabelerlib.entities import Finding, Subscription
 
 __author__ = '''Sayantan Khanra <skhanra@schubergphilis.com>'''
 __docformat__ = '''google'''
@@ -51,6 +109,383 @@ __maintainer__ = '''Sayantan Khanra'''
 __email__ = '''<skhanra@schubergphilis.com>'''
 __status__ = '''Development'''  # "Prototype", "Development", "Production".
 
+TENANT_ID = '00000000-0000-0000-0000-000000000000'
+SUBSCRIPTION_IDS = ['00000000-0000-0000-0000-000000000001',
+                    '00000000-0000-0000-0000-000000000002',
+                    '00000000-0000-0000-0000-000000000003']
+
+
+def get_finding_data(subscription_id, index, severity='High', resource_group='rg'):
+    """Creates the raw data of a resource graph finding."""
+    return {'subscriptionId': subscription_id,
+            'resourceGroup': resource_group,
+            'severity': severity,
+            'state': 'unhealthy',
+            'complianceState': 'Failed',
+            'complianceStandardId': 'Microsoft cloud security benchmark',
+            'recommendationId': f'/subscriptions/{subscription_id}/assessments/{index}',
+            'statusChangeDate': (datetime.now() - timedelta(days=10)).strftime('%Y-%m-%dT%H:%M:%S.000')}
+
+
+def get_synthetic_finding_data(index):
+    """Creates the raw data of a finding of one of 200 recommendations on its own resource, like Azure returns."""
+    recommendation = index % 200
+    subscription_id = f'00000000-0000-0000-0000-{index % 50:012d}'
+    resource_group = f'rg-{index % 300}'
+    resource_id = (f'/subscriptions/{subscription_id}/resourcegroups/{resource_group}'
+                   f'/providers/microsoft.compute/virtualmachines/vm-{index}')
+    return {'complianceStandardId': 'Microsoft cloud security benchmark',
+            'complianceControlId': f'{recommendation % 40}',
+            'complianceState': ['Failed', 'Skipped'][index % 2],
+            'subscriptionId': subscription_id,
+            'resourceGroup': resource_group,
+            'resourceType': 'virtualmachines',
+            'resourceName': f'vm-{index}',
+            'resourceId': resource_id,
+            'severity': ['High', 'Medium', 'Low'][index % 3],
+            'state': 'Unhealthy',
+            'recommendationId': f'{resource_id}/providers/Microsoft.Security/assessments/{recommendation:036d}',
+            'recommendationName': f'{recommendation:036d}',
+            'recommendationDisplayName': f'Recommendation {recommendation} should be enabled',
+            'description': f'Description of recommendation {recommendation}. ' * 6,
+            'remediationSteps': f'Remediation of recommendation {recommendation}. ' * 8,
+            'azurePortalRecommendationLink': ('https://portal.azure.com/#blade/Microsoft_Azure_Security/'
+                                              f'RecommendationsBlade/assessmentKey/{recommendation}'),
+            'controlName': f'Control {recommendation % 40}',
+            'statusChangeDate': f'2024-{index % 12 + 1:02d}-{index % 28 + 1:02d}T10:00:00.000000Z'}
+
+
+class FakeResourceGraphClient:
+    """Fake resource graph client counting the calls, records returned and queries in flight, optionally with latency.
+
+    Queries filtering on a status change date only return the findings, or the ids of the assessments including the
+    resolved ones, that changed after it.
+
+    """
+
+    findings = {}
+    resolved = []
+    calls = 0
+    records = 0
+    in_flight = 0
+    max_in_flight = 0
+    latency = 0
+    page_size = None
+    lock = threading.Lock()
+
+    def __init__(self, credential):
+        self.credential = credential
+
+    def resources(self, query):
+        """Returns the findings of the subscriptions in the query, in pages if a page size is set."""
+        with FakeResourceGraphClient.lock:
+            FakeResourceGraphClient.in_flight += 1
+            FakeResourceGraphClient.max_in_flight = max(FakeResourceGraphClient.max_in_flight,
+                                                        FakeResourceGraphClient.in_flight)
+        time.sleep(FakeResourceGraphClient.latency)
+        with FakeResourceGraphClient.lock:
+            FakeResourceGraphClient.in_flight -= 1
+        data = [finding for subscription_id in query.subscriptions
+                for finding in FakeResourceGraphClient.findings.get(subscription_id, [])]
+        since = re.search(r'> datetime\((.+?)\)', query.query or '')
+        if since:
+            assessments = data + [finding for finding in FakeResourceGraphClient.resolved
+                                  if finding['subscriptionId'] in query.subscriptions]
+            since = datetime.strptime(since.group(1), '%Y-%m-%dT%H:%M:%SZ')
+            data = [finding for finding in assessments if finding in data or 'tolower(id)' in query.query
+                    if datetime.strptime(finding['statusChangeDate'].split('.')[0], '%Y-%m-%dT%H:%M:%S') > since]
+            if 'tolower(id)' in query.query:
+                data = [{'recommendationId': finding['recommendationId'].lower()} for finding in data]
+        skip_token = None
+        if FakeResourceGraphClient.page_size:
+            start = int(query.options.skip_token or 0)
+            end = start + FakeResourceGraphClient.page_size
+            data = data[start:end]
+            skip_token = str(end) if end < sum(len(FakeResourceGraphClient.findings.get(subscription_id, []))
+                                               for subscription_id in query.subscriptions) else None
+        with FakeResourceGraphClient.lock:
+            FakeResourceGraphClient.calls += 1
+            FakeResourceGraphClient.records += len(data)
+        return SimpleNamespace(data=data, skip_token=skip_token)
+
+
+class FakeAsyncResourceGraphClient:
+    """Fake asynchronous resource graph client serving pages of findings, tracking the queries in flight."""
+
+    page_size = 7
+    in_flight = 0
+    max_in_flight = 0
+
+    def __init__(self, credential):
+        self.credential = credential
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def resources(self, query):
+        """Returns a page of the findings of the subscriptions in the query."""
+        FakeAsyncResourceGraphClient.in_flight += 1
+        FakeAsyncResourceGraphClient.max_in_flight = max(FakeAsyncResourceGraphClient.max_in_flight,
+                                                         FakeAsyncResourceGraphClient.in_flight)
+        await asyncio.sleep(FakeResourceGraphClient.latency)
+        FakeAsyncResourceGraphClient.in_flight -= 1
+        data = [finding for subscription_id in query.subscriptions
+                for finding in FakeResourceGraphClient.findings.get(subscription_id, [])]
+        start = int(query.options.skip_token or 0)
+        end = start + FakeAsyncResourceGraphClient.page_size
+        FakeResourceGraphClient.calls += 1
+        return SimpleNamespace(data=data[start:end], skip_token=str(end) if end < len(data) else None)
+
+
+class FakeSubscriptionClient:
+    """Fake subscription client listing the subscriptions of the tenant."""
+
+    subscription_ids = []
+
+    def __init__(self, credential):
+        self.credential = credential
+        self.subscriptions = self
+
+    @staticmethod
+    def list():
+        """Lists the subscriptions of the tenant."""
+        return [SimpleNamespace(id=f'/subscriptions/{subscription_id}',
+                                subscription_id=subscription_id,
+                                display_name=f'subscription-{index}',
+                                tenant_id=TENANT_ID,
+                                state='Enabled')
+                for index, subscription_id in enumerate(FakeSubscriptionClient.subscription_ids)]
+
+
+class FakeResourceManagementClient:
+    """Fake resource management client listing the resource groups found in the findings."""
+
+    def __init__(self, credential, subscription_id):
+        self.credential = credential
+        self.resource_groups = self
+        self.subscription_id = subscription_id
+
+    def list(self):
+        """Lists the resource groups of the subscription."""
+        names = sorted({finding['resourceGroup'] for finding in
+                        FakeResourceGraphClient.findings.get(self.subscription_id, [])})
+        return [SimpleNamespace(name=name, location='westeurope') for name in names]
+
+
+class FakePolicyClient:  # pylint: disable=too-few-public-methods
+    """Fake policy client without any exemptions."""
+
+    def __init__(self, credential, subscription_id, api_version):
+        self.credential = credential
+        self.subscription_id = subscription_id
+        self.api_version = api_version
+        self.policy_exemptions = SimpleNamespace(list=list)
+
+
+@contextmanager
+def fake_azure(findings_per_subscription, latency=0, page_size=None):
+    """Replaces the Azure clients used by azureenergylabelerlib with fakes serving the provided findings."""
+    FakeSubscriptionClient.subscription_ids = list(findings_per_subscription)
+    FakeResourceGraphClient.findings = findings_per_subscription
+    FakeResourceGraphClient.resolved = []
+    FakeResourceGraphClient.calls = 0
+    FakeResourceGraphClient.records = 0
+    FakeResourceGraphClient.max_in_flight = 0
+    FakeResourceGraphClient.latency = latency
+    FakeResourceGraphClient.page_size = page_size
+    with ExitStack() as stack:
+        stack.enter_context(patch('azureenergylabelerlib.azureenergylabelerlib.DefaultAzureCredential'))
+        stack.enter_context(patch('azureenergylabelerlib.azureenergylabelerlib.SubscriptionClient',
+                                  FakeSubscriptionClient))
+        stack.enter_context(patch('azureenergylabelerlib.entities.SubscriptionClient', FakeSubscriptionClient))
+        stack.enter_context(patch('azureenergylabelerlib.entities.arg.ResourceGraphClient', FakeResourceGraphClient))
+        stack.enter_context(patch('azureenergylabelerlib.entities.ResourceManagementClient',
+                                  FakeResourceManagementClient))
+        stack.enter_context(patch('azureenergylabelerlib.entities.PolicyClient', FakePolicyClient))
+        stack.enter_context(patch('azureenergylabelercli.asyncretrieval.ResourceGraphClient',
+                                  FakeAsyncResourceGraphClient))
+        stack.enter_context(patch('azureenergylabelercli.entities.ResourceGraphClient', FakeResourceGraphClient))
+        yield FakeResourceGraphClient
+
+
+class FakeBlobStorageHandler(BaseHTTPRequestHandler):
+    """Serves the block blob uploads of a path style storage emulator like Azurite, tracking connections and blocks."""
+
+    protocol_version = 'HTTP/1.1'
+    blobs = {}
+    blocks = {}
+    metadata = {}
+    puts = 0
+    connections = set()
+    in_flight = 0
+    max_in_flight = 0
+    status = 201
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def _send_error(self, status, error_code):
+        self.send_response(status)
+        self.send_header('x-ms-error-code', error_code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_PUT(self):  # pylint: disable=invalid-name
+        """Stores a blob, a block of a blob or commits the block list of a blob."""
+        cls = FakeBlobStorageHandler
+        with cls.lock:
+            cls.connections.add(self.client_address)
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(0.01)
+        with cls.lock:
+            cls.in_flight -= 1
+            cls.puts += 1
+            if cls.status != 201:
+                self._send_error(cls.status, 'InternalError')
+                return
+            if query.get('comp') != ['block']:
+                cls.metadata[url.path] = {key: value for key, value in self.headers.items()
+                                          if key.lower().startswith('x-ms-meta-')}
+            if query.get('comp') == ['block']:
+                cls.blocks[(url.path, query['blockid'][0])] = body
+            elif query.get('comp') == ['blocklist']:
+                block_ids = re.findall(r'<Latest>(.*?)</Latest>', body.decode('utf-8'))
+                cls.blobs[url.path] = b''.join(cls.blocks[(url.path, block_id)] for block_id in block_ids)
+            else:
+                cls.blobs[url.path] = body
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.send_header('ETag', '"0x1"')
+        self.send_header('Content-MD5', base64.b64encode(b'0' * 16).decode('utf-8'))
+        self.end_headers()
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        """Serves the properties of a blob along with its metadata."""
+        cls = FakeBlobStorageHandler
+        path = urlparse(self.path).path
+        with cls.lock:
+            blob = cls.blobs.get(path)
+            metadata = cls.metadata.get(path, {})
+        if blob is None:
+            self._send_error(404, 'BlobNotFound')
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(blob)))
+        self.send_header('ETag', '"0x1"')
+        self.send_header('x-ms-blob-type', 'BlockBlob')
+        for key, value in metadata.items():
+            self.send_header(key, value)
+        self.end_headers()
+
+
+@contextmanager
+def fake_blob_storage():
+    """Runs a fake path style blob storage emulator, yielding its container url."""
+    FakeBlobStorageHandler.blobs = {}
+    FakeBlobStorageHandler.blocks = {}
+    FakeBlobStorageHandler.metadata = {}
+    FakeBlobStorageHandler.puts = 0
+    FakeBlobStorageHandler.connections = set()
+    FakeBlobStorageHandler.max_in_flight = 0
+    FakeBlobStorageHandler.status = 201
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeBlobStorageHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}/devstoreaccount1/container/'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class FakeTokenHandler(BaseHTTPRequestHandler):
+    """Serves access tokens like the managed identity endpoint of App Service, counting the tokens issued."""
+
+    protocol_version = 'HTTP/1.1'
+    issued = 0
+    lifetime = 3600
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Issues a new access token for the requested resource."""
+        cls = FakeTokenHandler
+        cls.issued += 1
+        resource = parse_qs(urlparse(self.path).query)['resource'][0]
+        body = json.dumps({'access_token': f'token-{cls.issued}',
+                           'expires_on': str(int(time.time()) + cls.lifetime),
+                           'resource': resource,
+                           'token_type': 'Bearer'}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@contextmanager
+def fake_token_endpoint(lifetime=3600):
+    """Runs a fake managed identity token endpoint the managed identity credentials of the environment use."""
+    FakeTokenHandler.issued = 0
+    FakeTokenHandler.lifetime = lifetime
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeTokenHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    environment = {'IDENTITY_ENDPOINT': f'http://127.0.0.1:{server.server_address[1]}/msi/token',
+                   'IDENTITY_HEADER': 'secret'}
+    try:
+        with patch.dict('os.environ', environment):
+            yield FakeTokenHandler
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@contextmanager
+def no_azure():
+    """Fails any attempt to reach out to Azure."""
+    with ExitStack() as stack:
+        for target in ['azureenergylabelerlib.azureenergylabelerlib.SubscriptionClient',
+                       'azureenergylabelerlib.entities.SubscriptionClient',
+                       'azureenergylabelerlib.entities.arg.ResourceGraphClient',
+                       'azureenergylabelerlib.entities.ResourceManagementClient',
+                       'azureenergylabelerlib.entities.PolicyClient']:
+            stack.enter_context(patch(target, side_effect=AssertionError(f'{target} called offline')))
+        yield
+
+
+def deny_access(tenant_id):
+    """Fails to retrieve the findings of a tenant."""
+    raise PermissionError(f'No access to tenant {tenant_id}')
+
+
+def label_tenant_slowly(tenant_id):
+    """Labels a fake tenant in a worker process, exiting like the cli does for the tenant named failing."""
+    started = time.time()
+    time.sleep(0.5)
+    if tenant_id == 'failing':
+        wait_for_findings(deny_access, tenant_id, 'debug')
+    return [[['Tenant ID:', tenant_id], ['Tenant Security Score:', 'A'], ['Labeled:', [started, time.time()]]]]
+
+
+class PicklingThreadPoolExecutor(ThreadPoolExecutor):
+    """Stands in for the process pool of the tenants, pickling every call like it has to be for a spawned process."""
+
+    def __init__(self, max_workers=None, mp_context=None, **kwargs):  # pylint: disable=unused-argument
+        super().__init__(max_workers, **kwargs)
+
+    def submit(self, fn, /, *args, **kwargs):  # pylint: disable=arguments-differ
+        return super().submit(*pickle.loads(pickle.dumps((fn, *args))), **kwargs)
+
 
 class TestGetArguments(unittest.TestCase):
 
@@ -77,4 +512,1295 @@ class TestGetArguments(unittest.TestCase):
                      '--frameworks', 'Microsoft cloud security benchmark,Azure CIS 1.1.0']
         with patch.object(sys, 'argv', test_args):
             args = get_arguments()
-        self.assertEqual(args.frameworks, ['Microsoft cloud security benchmark', 'Azure CIS 1.1.0'])
\ No newline at end of file
+        self.assertEqual(args.frameworks, ['Microsoft cloud security benchmark', 'Azure CIS 1.1.0'])
+
+    def test_subscription_ids_conflict_with_single_subscription_id(self):
+        """Test that --subscription-ids can not be combined with a single subscription from the environment."""
+        test_args = ['prog', '--tenant-id', TENANT_ID, '--subscription-ids', ','.join(SUBSCRIPTION_IDS)]
+        with patch.dict('os.environ', {'AZURE_LABELER_SINGLE_SUBSCRIPTION_ID': SUBSCRIPTION_IDS[0]}):
+            with patch.object(sys, 'argv', test_args):
+                with self.assertRaises(MutuallyExclusiveArguments):
+                    get_arguments()
+
+
+class TestSubscriptionsReportingData(unittest.TestCase):
+
+    def test_findings_are_retrieved_once_for_all_subscriptions(self):
+        """Test that labeling subscriptions individually queries the findings only once."""
+        findings = {subscription_id: [get_finding_data(subscription_id, index) for index in range(count)]
+                    for subscription_id, count in zip(SUBSCRIPTION_IDS, [0, 5, 30])}
+        with fake_azure(findings) as resource_graph:
+            reporting_data = get_subscriptions_reporting_data(TENANT_ID, None, True,
+                                                              ['Microsoft cloud security benchmark'],
+                                                              'debug', True)
+        self.assertEqual(resource_graph.calls, 1)
+        self.assertEqual([subscription_id for subscription_id, _, _ in reporting_data], SUBSCRIPTION_IDS)
+        labels = [dict(report_data)['Subscription Security Score:'] for _, report_data, _ in reporting_data]
+        self.assertEqual(labels, ['A', 'B', 'F'])
+        self.assertEqual([len(exporter_arguments['defender_for_cloud_findings'])
+                          for _, _, exporter_arguments in reporting_data], [0, 5, 30])
+
+    def test_only_requested_subscriptions_are_retrieved(self):
+        """Test that an explicit list of subscriptions scopes down the findings query."""
+        findings = {subscription_id: [get_finding_data(subscription_id, index) for index in range(count)]
+                    for subscription_id, count in zip(SUBSCRIPTION_IDS, [0, 5, 30])}
+        with fake_azure(findings) as resource_graph:
+            reporting_data = get_subscriptions_reporting_data(TENANT_ID, SUBSCRIPTION_IDS[:2], True,
+                                                              ['Microsoft cloud security benchmark'],
+                                                              'debug', True)
+        self.assertEqual(resource_graph.records, 5)
+        self.assertEqual(len(reporting_data), 2)
+
+    def test_export_sub_path(self):
+        """Test that subscription exports go in their own directory or blob prefix."""
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertEqual(get_export_sub_path(directory, SUBSCRIPTION_IDS[0]),
+                             str(Path(directory, SUBSCRIPTION_IDS[0])))
+        self.assertEqual(get_export_sub_path('https://sa.blob.core.windows.net/container/?sig=token', 'sub'),
+                         'https://sa.blob.core.windows.net/container/sub/?sig=token')
+
+
+class TestSubscriptionReportingData(unittest.TestCase):
+
+    def test_only_subscription_findings_are_retrieved_and_labeled(self):
+        """Test that a single subscription run retrieves and labels only the findings of that subscription."""
+        findings = {subscription_id: [get_finding_data(subscription_id, index) for index in range(count)]
+                    for subscription_id, count in zip(SUBSCRIPTION_IDS, [100, 5, 300])}
+        with fake_azure(findings) as resource_graph:
+            report_data, exporter_arguments = get_subscription_reporting_data(TENANT_ID, SUBSCRIPTION_IDS[1], True,
+                                                                              ['Microsoft cloud security benchmark'],
+                                                                              'debug', True)
+        self.assertEqual(resource_graph.records, 5)
+        self.assertEqual(dict(report_data)['Number Of High Findings:'], 5)
+        self.assertEqual(dict(report_data)['Subscription Security Score:'], 'B')
+        self.assertEqual(len(exporter_arguments['defender_for_cloud_findings']), 5)
+
+
+class TestFindingsCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.findings = {subscription_id: [get_finding_data(subscription_id, index) for index in range(10)]
+                         for subscription_id in SUBSCRIPTION_IDS}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _get_tenant_label(self, findings_cache, frameworks=('Microsoft cloud security benchmark',)):
+        report_data, _ = get_tenant_reporting_data(TENANT_ID, None, None, None, True, list(frameworks),
+                                                   'debug', True, findings_cache=findings_cache)
+        return dict(report_data)['Tenant Security Score:']
+
+    def test_cache_hit_skips_retrieval(self):
+        """Test that a second run with the same arguments uses the cached findings."""
+        findings_cache = FindingsCache(self.directory.name)
+        with fake_azure(self.findings) as resource_graph:
+            first_label = self._get_tenant_label(findings_cache)
+            second_label = self._get_tenant_label(findings_cache)
+            self.assertEqual(resource_graph.calls, 1)
+            self._get_tenant_label(findings_cache, frameworks=['Azure CIS 1.1.0'])
+            self.assertEqual(resource_graph.calls, 2)
+        self.assertEqual(first_label, second_label)
+
+    def test_expired_entries_are_not_used(self):
+        """Test that entries older than the ttl are treated as missing."""
+        findings_cache = FindingsCache(self.directory.name, ttl=60)
+        findings_cache.set('key', [{'recommendationId': 'id'}])
+        self.assertEqual(findings_cache.get('key'), [{'recommendationId': 'id'}])
+        with patch('azureenergylabelercli.cache.time.time', return_value=time.time() + 61):
+            self.assertIsNone(findings_cache.get('key'))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        """Test that exceeding the maximum size evicts the least recently used entries."""
+        findings_cache = FindingsCache(self.directory.name, max_size=1)
+        findings = [{'description': 'x' * 1024}] * 400
+        findings_cache.set('first', findings)
+        findings_cache.set('second', findings)
+        os.utime(Path(self.directory.name, 'first.json'), (time.time() + 10, time.time() + 10))
+        findings_cache.set('third', findings)
+        self.assertIsNotNone(findings_cache.get('first'))
+        self.assertIsNone(findings_cache.get('second'))
+        self.assertIsNotNone(findings_cache.get('third'))
+
+
+class TestIncrementalRetrieval(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.findings = {subscription_id: [get_finding_data(subscription_id, index, resource_group=f'rg-{index % 2}')
+                                           for index in range(10)]
+                         for subscription_id in SUBSCRIPTION_IDS}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _get_tenant_data(self, incremental_state=None):
+        report_data, exporter_arguments = get_tenant_reporting_data(TENANT_ID, None, None, None, True,
+                                                                    ['Microsoft cloud security benchmark'],
+                                                                    'debug', True,
+                                                                    incremental_state=incremental_state)
+        path = Path(self.directory.name, 'incremental' if incremental_state else 'full')
+        DataExporter(**exporter_arguments).export(str(path))
+        return report_data, {export.name: export.read_text(encoding='utf-8') for export in path.iterdir()}
+
+    def test_only_changed_findings_are_retrieved_and_merged(self):
+        """Test that a second run retrieves only the changes and labels the same as retrieving everything."""
+        incremental_state = IncrementalState(Path(self.directory.name, 'state.json'))
+        now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000')
+        with fake_azure(self.findings) as resource_graph:
+            self._get_tenant_data(incremental_state)
+            self.assertEqual((resource_graph.calls, resource_graph.records), (1, 30))
+            changed = get_finding_data(SUBSCRIPTION_IDS[0], 3, severity='Low', resource_group='rg-1')
+            changed['statusChangeDate'] = now
+            self.findings[SUBSCRIPTION_IDS[0]][3] = changed
+            resolved = self.findings[SUBSCRIPTION_IDS[1]].pop(0)
+            resource_graph.resolved.append(dict(resolved, state='healthy', statusChangeDate=now))
+            resource_graph.calls = resource_graph.records = 0
+            incremental_data = self._get_tenant_data(incremental_state)
+            self.assertEqual((resource_graph.calls, resource_graph.records), (2, 3))
+            full_data = self._get_tenant_data()
+        self.assertEqual(incremental_data, full_data)
+        self.assertIn('Low', incremental_data[1]['defender-for-cloud-findings.json'])
+
+    def test_state_of_other_arguments_or_expired_is_not_used(self):
+        """Test that all findings are retrieved for a state of other arguments or past its max age."""
+        incremental_state = IncrementalState(Path(self.directory.name, 'state.json'), max_age=60)
+        with fake_azure(self.findings) as resource_graph:
+            self._get_tenant_data(incremental_state)
+            incremental_state.save('other', datetime.now(timezone.utc), time.time(), [])
+            self._get_tenant_data(incremental_state)
+            self.assertEqual(resource_graph.records, 60)
+            with patch('azureenergylabelercli.incremental.time.time', return_value=time.time() + 61):
+                self._get_tenant_data(incremental_state)
+            self.assertEqual(resource_graph.records, 90)
+
+    def test_state_larger_than_its_max_size_is_not_kept(self):
+        """Test that the state is compressed and removed instead of saved once it grows past its maximum size."""
+        path = Path(self.directory.name, 'state.json.gz')
+        incremental_state = IncrementalState(path)
+        with fake_azure(self.findings) as resource_graph:
+            self._get_tenant_data(incremental_state)
+            self.assertEqual(len(json.loads(gzip.decompress(path.read_bytes()))['findings']), 30)
+            incremental_state.max_size = 100
+            self._get_tenant_data(incremental_state)
+            self.assertFalse(path.exists())
+            resource_graph.records = 0
+            self._get_tenant_data(incremental_state)
+            self.assertEqual(resource_graph.records, 30)
+
+
+class TestOfflineReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.findings = {subscription_id: [get_finding_data(subscription_id, index,
+                                                            severity=['High', 'Medium', 'Low'][index % 3],
+                                                            resource_group=f'rg-{index % 4}')
+                                           for index in range(count)]
+                         for subscription_id, count in zip(SUBSCRIPTION_IDS, [0, 12, 60])}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _export(self, exporter_arguments, name, findings_format='json'):
+        path = Path(self.directory.name, name)
+        DataExporter(findings_format=findings_format, **exporter_arguments).export(str(path))
+        return path
+
+    def test_tenant_labels_are_replayed_from_an_export(self):
+        """Test that replaying a json or ndjson export offline produces the same report and export."""
+        arguments = [TENANT_ID, None, None, None, True, ['Microsoft cloud security benchmark'], 'debug', True]
+        for findings_format in ['json', 'ndjson']:
+            with fake_azure(self.findings):
+                report_data, exporter_arguments = get_tenant_reporting_data(*arguments)
+                online = self._export(exporter_arguments, f'online-{findings_format}', findings_format)
+            snapshot = FindingsSnapshot(online.joinpath(f'defender-for-cloud-findings.{findings_format}'))
+            with no_azure():
+                offline_report_data, offline_exporter_arguments = get_tenant_reporting_data(
+                    *arguments, findings_snapshot=snapshot)
+                offline = self._export(offline_exporter_arguments, f'offline-{findings_format}', findings_format)
+            self.assertEqual(report_data, offline_report_data)
+            for path in online.iterdir():
+                self.assertEqual(path.read_text(encoding='utf-8'),
+                                 offline.joinpath(path.name).read_text(encoding='utf-8'), path.name)
+
+    def test_compressed_exports_decompress_to_the_exports_and_replay(self):
+        """Test that compressed exports hold the uncompressed files and replay offline with their siblings."""
+        arguments = [TENANT_ID, None, None, None, True, ['Microsoft cloud security benchmark'], 'debug', True]
+        with fake_azure(self.findings):
+            report_data, exporter_arguments = get_tenant_reporting_data(*arguments)
+            uncompressed = self._export(exporter_arguments, 'none')
+            for compression, suffix in [('gzip', '.gz'), ('zstd', '.zst')] if zstandard else [('gzip', '.gz')]:
+                path = Path(self.directory.name, compression)
+                DataExporter(compression=compression, **exporter_arguments).export(str(path))
+                for export in uncompressed.iterdir():
+                    with open_decompressed(path.joinpath(f'{export.name}{suffix}')) as compressed_file:
+                        self.assertEqual(compressed_file.read(), export.read_text(encoding='utf-8'), export.name)
+                snapshot = FindingsSnapshot(path.joinpath(f'defender-for-cloud-findings.json{suffix}'))
+                with no_azure():
+                    offline_report_data, _ = get_tenant_reporting_data(*arguments, findings_snapshot=snapshot)
+                self.assertEqual(report_data, offline_report_data)
+        with patch('azureenergylabelercli.compression.zstandard', None), self.assertRaises(CompressionUnavailable):
+            DataExporter(compression='zstd', **exporter_arguments).export(str(Path(self.directory.name, 'missing')))
+
+    def test_single_subscription_is_replayed_from_raw_findings(self):
+        """Test that a file of findings as retrieved from Azure can be labeled offline for a subscription."""
+        path = Path(self.directory.name, 'findings.json')
+        path.write_text(json.dumps([finding for findings in self.findings.values() for finding in findings]),
+                        encoding='utf-8')
+        with no_azure():
+            report_data, _ = get_subscription_reporting_data(TENANT_ID, SUBSCRIPTION_IDS[1], True,
+                                                             ['Microsoft cloud security benchmark'], 'debug', True,
+                                                             findings_snapshot=FindingsSnapshot(path))
+        self.assertEqual(dict(report_data)['Number Of High Findings:'], 4)
+        self.assertEqual(dict(report_data)['Number Of Medium Findings:'], 4)
+
+
+class TestColumnarExport(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.findings = {subscription_id: [dict(get_synthetic_finding_data(index), subscriptionId=subscription_id)
+                                           for index in range(count)]
+                         for subscription_id, count in zip(SUBSCRIPTION_IDS, [0, 300, 1200])}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    @unittest.skipUnless(pyarrow, 'pyarrow is not installed')
+    def test_parquet_exports_hold_the_json_rows_and_replay(self):
+        """Test that the parquet exports are typed, hold the rows of the json exports and replay offline."""
+        arguments = [TENANT_ID, None, None, None, True, ['Microsoft cloud security benchmark'], 'debug', True]
+        exports = {}
+        with fake_azure(self.findings):
+            report_data, exporter_arguments = get_tenant_reporting_data(*arguments)
+            for export_format in ['json', 'parquet']:
+                exports[export_format] = Path(self.directory.name, export_format)
+                DataExporter(export_format=export_format, compression='gzip',
+                             **exporter_arguments).export(str(exports[export_format]))
+        findings = pyarrow.parquet.read_table(exports['parquet'].joinpath('defender-for-cloud-findings.parquet'))
+        self.assertTrue(pyarrow.types.is_dictionary(findings.schema.field('Severity').type))
+        self.assertTrue(pyarrow.types.is_integer(findings.schema.field('Days Open').type))
+        for name in ['defender-for-cloud-findings', 'subscription-energy-label']:
+            with open_decompressed(exports['json'].joinpath(f'{name}.json.gz')) as json_file:
+                rows = json.load(json_file)
+            parquet_path = exports['parquet'].joinpath(f'{name}.parquet')
+            self.assertEqual(pyarrow.parquet.read_table(parquet_path).to_pylist(), rows, name)
+        self.assertTrue(exports['parquet'].joinpath('tenant-energy-label.json.gz').is_file())
+        snapshot = FindingsSnapshot(exports['parquet'].joinpath('defender-for-cloud-findings.parquet'))
+        with no_azure():
+            offline_report_data, _ = get_tenant_reporting_data(*arguments, findings_snapshot=snapshot)
+        self.assertEqual(report_data, offline_report_data)
+
+    @unittest.skipUnless(pyarrow, 'pyarrow is not installed')
+    def test_parquet_findings_are_smaller_than_json(self):
+        """Test that the findings export as parquet is less than half the size of json, uncompressed and compressed."""
+        findings = [CompactFinding(get_synthetic_finding_data(index)) for index in range(10000)]
+        for compression in ['none', 'gzip']:
+            json_file, parquet_file = io.BytesIO(), io.BytesIO()
+            with compressed_writer(json_file, compression) as output_file:
+                write_findings_json(findings, output_file)
+            write_findings_parquet(findings, parquet_file, compression)
+            sizes = len(json_file.getvalue()), len(parquet_file.getvalue())
+            self.assertLess(sizes[1], sizes[0] / 2)
+
+    def test_missing_pyarrow_is_reported(self):
+        """Test that exporting parquet without pyarrow raises a clear error."""
+        findings = IndexedFindings(CompactFinding(data) for data in self.findings[SUBSCRIPTION_IDS[1]])
+        exporter = DataExporter(['findings'], TENANT_ID, 'A', findings, [], export_format='parquet')
+        with patch('azureenergylabelercli.columnar.pyarrow', None), self.assertRaises(ParquetExportUnavailable):
+            exporter.export(str(Path(self.directory.name, 'missing')))
+
+
+class TestBlobUpload(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.findings = {subscription_id: [dict(get_synthetic_finding_data(index), subscriptionId=subscription_id)
+                                           for index in range(count)]
+                         for subscription_id, count in zip(SUBSCRIPTION_IDS, [0, 300, 1200])}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_exports_are_uploaded_in_parallel_blocks_over_reused_connections(self):
+        """Test that large exports are uploaded in parallel blocks and all files reuse a few pooled connections."""
+        local = Path(self.directory.name, 'local')
+        blob_service_clients = BlobServiceClients(block_size=64 * 1024, max_connections=4)
+        with fake_azure(self.findings), fake_blob_storage() as container_url:
+            _, exporter_arguments = get_tenant_reporting_data(TENANT_ID, None, None, None, True,
+                                                              ['Microsoft cloud security benchmark'], 'debug', True)
+            DataExporter(**exporter_arguments).export(str(local))
+            for name in ['first', 'second']:
+                DataExporter(upload_concurrency=4, blob_service_clients=blob_service_clients,
+                             **exporter_arguments).export(get_export_sub_path(f'{container_url}?sv=1&sig=x', name))
+            blob_service_clients.close()
+        for name in ['first', 'second']:
+            for path in local.iterdir():
+                self.assertEqual(FakeBlobStorageHandler.blobs[f'/devstoreaccount1/container/{name}/{path.name}'],
+                                 path.read_bytes(), path.name)
+        findings_size = local.joinpath('defender-for-cloud-findings.json').stat().st_size
+        self.assertGreater(len(FakeBlobStorageHandler.blocks), 2 * findings_size // (64 * 1024))
+        self.assertGreater(FakeBlobStorageHandler.max_in_flight, 1)
+        self.assertLessEqual(len(FakeBlobStorageHandler.connections), 4)
+
+    @unittest.skipUnless(os.environ.get('AZURE_LABELER_TEST_AZURITE_URL'),
+                         'AZURE_LABELER_TEST_AZURITE_URL is not set to an Azurite container url with a SAS token')
+    def test_exports_are_uploaded_to_azurite(self):
+        """Test exporting to an Azurite container, which has to exist, in small blocks."""
+        with fake_azure(self.findings), self.assertNoLogs('entities.DataExporter', level='ERROR'):
+            _, exporter_arguments = get_tenant_reporting_data(TENANT_ID, None, None, None, True,
+                                                              ['Microsoft cloud security benchmark'], 'debug', True)
+            DataExporter(blob_service_clients=BlobServiceClients(block_size=64 * 1024),
+                         **exporter_arguments).export(os.environ['AZURE_LABELER_TEST_AZURITE_URL'])
+
+
+class TestUnchangedExports(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.findings = {subscription_id: [dict(get_synthetic_finding_data(index), subscriptionId=subscription_id)
+                                           for index in range(count)]
+                         for subscription_id, count in zip(SUBSCRIPTION_IDS, [0, 30, 120])}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    @staticmethod
+    def _get_exporter_arguments():
+        _, exporter_arguments = get_tenant_reporting_data(TENANT_ID, None, None, None, True,
+                                                          ['Microsoft cloud security benchmark'], 'debug', True)
+        return exporter_arguments
+
+    def test_unchanged_local_files_are_not_replaced(self):
+        """Test that only files whose content changed since the last export are replaced."""
+        path = Path(self.directory.name, 'export')
+        changed_findings = dict(self.findings)
+        changed_findings[SUBSCRIPTION_IDS[2]] = [dict(finding, description='Changed')
+                                                 for finding in self.findings[SUBSCRIPTION_IDS[2]]]
+        with fake_azure(self.findings):
+            exporter_arguments = self._get_exporter_arguments()
+            DataExporter(skip_unchanged=True, **exporter_arguments).export(str(path))
+            exported = {file.name: file.stat().st_ino for file in path.iterdir()}
+            contents = {file.name: file.read_bytes() for file in path.iterdir()}
+            self.assertIn(MANIFEST_FILENAME, exported)
+            DataExporter(skip_unchanged=True, max_workers=4, **exporter_arguments).export(str(path))
+            self.assertEqual({file.name: file.stat().st_ino for file in path.iterdir()}, exported)
+        path.joinpath('exempted-policies.json').unlink()
+        reference = Path(self.directory.name, 'reference')
+        with fake_azure(changed_findings):
+            exporter_arguments = self._get_exporter_arguments()
+            DataExporter(skip_unchanged=True, **exporter_arguments).export(str(path))
+            DataExporter(**exporter_arguments).export(str(reference))
+        replaced = {file.name for file in path.iterdir() if file.stat().st_ino != exported.get(file.name)}
+        changed = {file.name for file in reference.iterdir() if file.read_bytes() != contents[file.name]}
+        self.assertEqual(changed, {'defender-for-cloud-findings.json'})
+        self.assertEqual(replaced, {MANIFEST_FILENAME, 'exempted-policies.json', 'defender-for-cloud-findings.json'})
+        for file in reference.iterdir():
+            self.assertEqual(path.joinpath(file.name).read_bytes(), file.read_bytes(), file.name)
+        self.assertEqual(list(Path(self.directory.name).glob('*/*.tmp')), [])
+
+    def test_unchanged_blobs_are_not_uploaded(self):
+        """Test that blobs holding the content hash of the export in their metadata are not uploaded again."""
+        with fake_azure(self.findings), fake_blob_storage() as container_url:
+            exporter_arguments = self._get_exporter_arguments()
+            url = f'{container_url}?sv=1&sig=x'
+            DataExporter(skip_unchanged=True, **exporter_arguments).export(url)
+            uploads = FakeBlobStorageHandler.puts
+            blobs = dict(FakeBlobStorageHandler.blobs)
+            self.assertTrue(all(CONTENT_HASH_METADATA_KEY in ''.join(metadata).lower()
+                                for metadata in FakeBlobStorageHandler.metadata.values()))
+            DataExporter(skip_unchanged=True, **exporter_arguments).export(url)
+            self.assertEqual(FakeBlobStorageHandler.puts, uploads)
+            DataExporter(**exporter_arguments).export(url)
+            self.assertEqual(FakeBlobStorageHandler.puts, 2 * uploads)
+        self.assertEqual(FakeBlobStorageHandler.blobs, blobs)
+
+
+class TestHistoryStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.history = HistoryStore(str(Path(self.directory.name, 'history.sqlite')))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _record(self, counts, started_at):
+        findings = {subscription_id: [get_finding_data(subscription_id, index) for index in range(count)]
+                    for subscription_id, count in zip(SUBSCRIPTION_IDS, counts)}
+        with fake_azure(findings):
+            _, exporter_arguments = get_tenant_reporting_data(TENANT_ID, None, None, None, True,
+                                                              ['Microsoft cloud security benchmark'], 'debug', True)
+            return self.history.record(TENANT_ID, [exporter_arguments], started_at)
+
+    def test_runs_are_appended_and_dropped_labels_are_found(self):
+        """Test that every run appends its labels and that subscriptions that dropped a label are found."""
+        self._record([0, 5, 30], datetime(2024, 4, 20, tzinfo=timezone.utc))
+        self._record([0, 5, 5], datetime(2024, 5, 1, tzinfo=timezone.utc))
+        self._record([30, 5, 5], datetime(2024, 5, 15, tzinfo=timezone.utc))
+        with closing(sqlite3.connect(self.history.path)) as connection:
+            runs = connection.execute('SELECT tenant_id, energy_label, number_of_findings FROM runs').fetchall()
+            labels = connection.execute('SELECT run_id, subscription_id, energy_label FROM subscription_labels '
+                                        'ORDER BY run_id, subscription_id').fetchall()
+            resource_groups = connection.execute('SELECT COUNT(*) FROM resource_group_labels').fetchone()[0]
+            plan = connection.execute('EXPLAIN QUERY PLAN SELECT energy_label FROM subscription_labels '
+                                      'WHERE subscription_id = ?', (SUBSCRIPTION_IDS[0],)).fetchall()
+        self.assertEqual([(tenant_id, number_of_findings) for tenant_id, _, number_of_findings in runs],
+                         [(TENANT_ID, 35), (TENANT_ID, 10), (TENANT_ID, 40)])
+        self.assertTrue(all(energy_label for _, energy_label, _ in runs))
+        self.assertEqual([label for _, _, label in labels], ['A', 'B', 'F', 'A', 'B', 'B', 'F', 'B', 'B'])
+        self.assertGreater(resource_groups, 0)
+        self.assertIn('subscription_labels_by_subscription', ' '.join(str(row) for row in plan))
+        dropped = self.history.get_dropped_subscription_labels(TENANT_ID, datetime(2024, 5, 1, tzinfo=timezone.utc))
+        self.assertEqual([(subscription_id, first, last) for subscription_id, _, first, last in dropped],
+                         [(SUBSCRIPTION_IDS[0], 'A', 'F')])
+
+
+class TestBackgroundExport(unittest.TestCase):
+
+    def _run_main(self, arguments, export_error=None):
+        events = []
+
+        def export(exporter, path):
+            time.sleep(0.2)
+            if export_error:
+                raise export_error
+            events.append(f'exported {path}')
+
+        reports = [(f'/tmp/{name}', [['Subscription ID:', name]], {}) for name in ['first', 'second']]
+        test_args = ['prog', '--tenant-id', TENANT_ID, '--disable-banner'] + arguments
+        with patch.object(sys, 'argv', test_args), \
+                patch('azure_energy_labeler_cli._get_reports', return_value=reports), \
+                patch('azure_energy_labeler_cli.report_many', side_effect=lambda *args: events.append('reported')), \
+                patch('azureenergylabelercli.entities.DataExporter.__init__', return_value=None), \
+                patch('azureenergylabelercli.entities.DataExporter.export', export):
+            with self.assertRaises(SystemExit) as exit_context:
+                azure_energy_labeler_cli.main()
+        return events, exit_context.exception.code
+
+    def test_report_is_printed_before_the_background_export_finishes(self):
+        """Test that the report is printed first and the process waits for all exports to finish."""
+        self.assertEqual(self._run_main([]), (['exported /tmp/first', 'exported /tmp/second', 'reported'], 0))
+        self.assertEqual(self._run_main(['--background-export']),
+                         (['reported', 'exported /tmp/first', 'exported /tmp/second'], 0))
+
+    def test_failed_background_export_fails_the_process(self):
+        """Test that a failing background export still exits with an error after the report is printed."""
+        self.assertEqual(self._run_main(['--background-export'], export_error=OSError('disk full')), (['reported'], 1))
+
+    def test_failed_blob_upload_fails_the_process(self):
+        """Test that a blob upload answered with a server error fails the export and the process."""
+        findings = {subscription_id: [get_finding_data(subscription_id, 0)] for subscription_id in SUBSCRIPTION_IDS}
+        output = io.StringIO()
+        with fake_azure(findings), fake_blob_storage() as container_url:
+            FakeBlobStorageHandler.status = 500
+            test_args = ['prog', '--tenant-id', TENANT_ID, '--disable-banner', '--disable-spinner',
+                         '--background-export', '--export-path', f'{container_url}?sv=1&sig=x']
+            without_retries = partial(BlobServiceClient, retry_total=0)
+            with patch.object(sys, 'argv', test_args), \
+                    patch('azureenergylabelercli.entities.BlobServiceClient', without_retries), \
+                    patch('azure_energy_labeler_cli.setup_logging'), redirect_stdout(output), \
+                    self.assertLogs(level='ERROR') as logs:
+                with self.assertRaises(SystemExit) as exit_context:
+                    azure_energy_labeler_cli.main()
+        self.assertEqual(exit_context.exception.code, 1)
+        self.assertIn('Energy label report', output.getvalue())
+        self.assertIn('tenant-energy-label.json to blob', '\n'.join(logs.output))
+        self.assertEqual(FakeBlobStorageHandler.blobs, {})
+
+
+class TestStartup(unittest.TestCase):
+
+    heavy_modules = ['azureenergylabelerlib', 'azure.identity', 'azure.storage.blob', 'requests', 'pyarrow', 'art',
+                     'yaspin', 'coloredlogs', 'terminaltables', 'azureenergylabelercli._version',
+                     'azureenergylabelercli.entities', 'azureenergylabelercli.snapshot']
+
+    @staticmethod
+    def _get_imported_modules(code):
+        """Runs code in a new interpreter, returning the names of the modules it imported."""
+        root = Path(__file__).parent.parent
+        process = subprocess.run([sys.executable, '-c', f'{code}\nprint(json.dumps(sorted(sys.modules)))'],
+                                 cwd=root, capture_output=True, text=True, check=True)
+        return set(json.loads(process.stdout.splitlines()[-1]))
+
+    def test_help_does_not_import_the_azure_sdks(self):
+        """Test that --help does not import the library, the Azure SDKs or the banner."""
+        modules = self._get_imported_modules('import json, sys, azure_energy_labeler_cli\n'
+                                             'sys.argv[1:] = ["--help"]\n'
+                                             'try:\n'
+                                             '    azure_energy_labeler_cli.main()\n'
+                                             'except SystemExit:\n'
+                                             '    pass')
+        self.assertIn('azure_energy_labeler_cli', modules)
+        self.assertEqual(modules.intersection(self.heavy_modules), set())
+
+    def test_arguments_do_not_import_the_azure_sdks(self):
+        """Test that parsing the arguments of a run with an export path and without a findings file stays light."""
+        modules = self._get_imported_modules('import json, sys, azure_energy_labeler_cli\n'
+                                             f'sys.argv[1:] = ["--tenant-id", "{TENANT_ID}", '
+                                             '"--export-path", "https://sa.blob.core.windows.net/container/"]\n'
+                                             'args = azure_energy_labeler_cli.get_arguments()\n'
+                                             'azure_energy_labeler_cli._get_findings_snapshot(args)')
+        self.assertEqual(modules.intersection(self.heavy_modules), set())
+
+    def test_version_is_read_on_first_access(self):
+        """Test that the version is read from the version file when accessed."""
+        root = Path(__file__).parent.parent
+        self.assertEqual(azureenergylabelercli.__version__, root.joinpath('.VERSION').read_text(encoding='utf-8'))
+
+
+class TestTokenCache(unittest.TestCase):
+
+    scope = 'https://management.azure.com/.default'
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = Path(self.directory.name, 'tokens.bin')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _get_token(self, passphrase=None, tenant_id=TENANT_ID, identity=None):
+        """Gets a token the way a new run does, with a new credential and token cache."""
+        with CachedTokenCredential(ManagedIdentityCredential(),
+                                   EncryptedTokenCache(self.path, passphrase),
+                                   tenant_id,
+                                   identity=identity) as credential:
+            return credential.get_token(self.scope).token
+
+    def test_runs_reuse_the_encrypted_token(self):
+        """Test that later runs reuse the token of the first run, which is only stored encrypted."""
+        with fake_token_endpoint() as endpoint:
+            tokens = [self._get_token() for _ in range(3)]
+            self.assertEqual(endpoint.issued, 1)
+            self._get_token(tenant_id='00000000-0000-0000-0000-000000000009')
+            self._get_token(identity='another-client-id')
+            self.assertEqual(endpoint.issued, 3)
+        self.assertEqual(tokens, ['token-1'] * 3)
+        self.assertNotIn(b'token-1', self.path.read_bytes())
+        self.assertEqual(self.path.with_name('tokens.bin.key').stat().st_mode & 0o777, 0o600)
+
+    def test_tokens_are_refreshed_ahead_of_expiry(self):
+        """Test that a cached token expiring within the refresh ahead window is replaced."""
+        with fake_token_endpoint(lifetime=DEFAULT_TOKEN_REFRESH_AHEAD - 60) as endpoint:
+            self.assertEqual([self._get_token() for _ in range(2)], ['token-1', 'token-2'])
+            self.assertEqual(endpoint.issued, 2)
+
+    def test_cache_of_another_passphrase_is_ignored(self):
+        """Test that a cache encrypted with another passphrase is treated as empty."""
+        with fake_token_endpoint() as endpoint:
+            self.assertEqual(self._get_token(passphrase='first'), 'token-1')
+            self.assertEqual(self._get_token(passphrase='first'), 'token-1')
+            self.assertEqual(self._get_token(passphrase='second'), 'token-2')
+            self.assertEqual(endpoint.issued, 2)
+        self.assertFalse(self.path.with_name('tokens.bin.key').exists())
+
+    def test_labeler_authenticates_with_the_cached_credential(self):
+        """Test that the credential provided to the labeler is the one it authenticates with."""
+        credential = CachedTokenCredential(None, EncryptedTokenCache(self.path), TENANT_ID)
+        with fake_azure({SUBSCRIPTION_IDS[0]: []}):
+            labeler = get_labeler(TENANT_ID, ['Microsoft cloud security benchmark'], credentials=credential)
+            self.assertIs(labeler.tenant_credentials, credential)
+
+    def test_missing_cryptography_is_reported(self):
+        """Test that the token cache fails with a clear error when cryptography is not installed."""
+        with patch('azureenergylabelercli.tokencache.Fernet', None), self.assertRaises(TokenCacheUnavailable):
+            EncryptedTokenCache(self.path)
+
+
+class TestLabelService(unittest.TestCase):
+
+    @staticmethod
+    def _request(address, path):
+        try:
+            with urlopen(f'http://{address[0]}:{address[1]}{path}', timeout=5) as response:
+                return response.status, json.loads(response.read())
+        except HTTPError as error:
+            return error.code, json.loads(error.read())
+
+    @staticmethod
+    def _wait_for(condition, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                raise AssertionError('condition not met in time')
+            time.sleep(0.02)
+
+    def test_labels_are_served_warm_and_refreshed_on_schedule(self):
+        """Test that the labels are served from memory and recalculated every interval."""
+        findings = {subscription_id: [get_finding_data(subscription_id, index) for index in range(count)]
+                    for subscription_id, count in zip(SUBSCRIPTION_IDS, [0, 5, 30])}
+
+        def get_reports():
+            report_data, exporter_arguments = get_tenant_reporting_data(TENANT_ID, None, None, None, True,
+                                                                        ['Microsoft cloud security benchmark'],
+                                                                        'debug', True)
+            return [(None, report_data, exporter_arguments)]
+
+        service = LabelService(get_reports, interval=0.3)
+        with fake_azure(findings) as resource_graph:
+            address = service.start('127.0.0.1', 0)
+            try:
+                self._wait_for(lambda: self._request(address, '/health')[0] == 200)
+                status, labels = self._request(address, '/labels')
+                self.assertEqual(status, 200)
+                self.assertEqual(labels['reports'][0]['tenant_id'], TENANT_ID)
+                status, subscriptions = self._request(address, '/subscriptions')
+                self.assertEqual([subscription['Energy Label'] for subscription in subscriptions['subscriptions']],
+                                 ['A', 'B', 'F'])
+                status, subscription = self._request(address, f'/subscriptions/{SUBSCRIPTION_IDS[2].upper()}')
+                self.assertEqual((status, subscription['Energy Label']), (200, 'F'))
+                self.assertEqual(self._request(address, '/subscriptions/unknown')[0], 404)
+                resource_graph.findings = dict(findings, **{SUBSCRIPTION_IDS[2]: []})
+                self._wait_for(lambda: self._request(address, f'/subscriptions/{SUBSCRIPTION_IDS[2]}')[1].get(
+                    'Energy Label') == 'A')
+            finally:
+                service.stop()
+
+    def test_previous_labels_are_served_while_labeling_fails(self):
+        """Test that the service answers 503 until labeled and keeps the previous labels if labeling fails."""
+        labeled = threading.Event()
+        runs = []
+
+        def get_reports():
+            labeled.wait()
+            runs.append(len(runs))
+            if len(runs) > 1:
+                raise SystemExit(1)
+            return [(None, [['Tenant ID:', TENANT_ID], ['Tenant Security Score:', 'B']],
+                     {'labeled_subscriptions': [], 'defender_for_cloud_findings': []})]
+
+        service = LabelService(get_reports, interval=0.1)
+        address = service.start('127.0.0.1', 0)
+        try:
+            self.assertEqual(self._request(address, '/labels')[0], 503)
+            self.assertEqual(self._request(address, '/health'), (503, {'status': 'starting',
+                                                                       'refreshed_at': None,
+                                                                       'last_error': None}))
+            labeled.set()
+            self._wait_for(lambda: len(runs) > 2)
+            status, labels = self._request(address, '/labels')
+            self.assertEqual((status, labels['reports'][0]['tenant_security_score']), (200, 'B'))
+            status, health = self._request(address, '/health')
+            self.assertEqual((status, health['status'], health['last_error']), (200, 'ok', 'SystemExit: 1'))
+        finally:
+            service.stop()
+
+    def test_serve_mode_is_parsed(self):
+        """Test that serve is an optional mode in front of the arguments, report being the default."""
+        with patch.object(sys, 'argv', ['prog', 'serve', '--tenant-id', TENANT_ID, '--serve-port', '9000']):
+            args = get_arguments()
+        self.assertEqual((args.mode, args.serve_port), ('serve', 9000))
+        with patch.object(sys, 'argv', ['prog', '--tenant-id', TENANT_ID]):
+            self.assertEqual(get_arguments().mode, 'report')
+
+
+class TestWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.findings = [{subscription_id: [get_finding_data(subscription_id, index) for index in range(count)]
+                          for subscription_id, count in zip(SUBSCRIPTION_IDS, counts)}
+                         for counts in [(0, 5, 30), (0, 5, 30), (0, 5, 4)]]
+
+    def test_only_changed_entities_are_reported(self):
+        """Test that runs after the first one report only the entities whose label or counts changed."""
+        runs = iter(self.findings)
+
+        def get_reports():
+            resource_graph.findings = next(runs)
+            report_data, exporter_arguments = get_tenant_reporting_data(TENANT_ID, None, None, None, True,
+                                                                        ['Microsoft cloud security benchmark'],
+                                                                        'debug', True)
+            return [(None, report_data, exporter_arguments)]
+
+        watcher = LabelWatcher(get_reports, TENANT_ID, 60)
+        with fake_azure(self.findings[0]) as resource_graph:
+            self.assertIsNone(watcher.run_once()[1])
+            self.assertEqual(watcher.run_once()[1], [])
+            changes = watcher.run_once()[1]
+        changed = {(change['entity'], change['name']) for change in changes}
+        self.assertIn(('subscription', SUBSCRIPTION_IDS[2]), changed)
+        self.assertIn(('tenant', TENANT_ID), changed)
+        self.assertNotIn(('subscription', SUBSCRIPTION_IDS[1]), changed)
+        subscription = next(change for change in changes if change['name'] == SUBSCRIPTION_IDS[2])
+        self.assertEqual((subscription['previous']['Energy Label'], subscription['current']['Energy Label']),
+                         ('F', 'B'))
+
+    def test_failed_run_does_not_stop_watching(self):
+        """Test that a run failing to retrieve the findings is logged and the next run compares to the last good one."""
+        runs = iter([None] + self.findings[1:])
+        changes = []
+
+        def get_reports():
+            findings = next(runs)
+            if findings is None:
+                wait_for_findings(deny_access, TENANT_ID, 'debug')
+            resource_graph.findings = findings
+            report_data, exporter_arguments = get_tenant_reporting_data(TENANT_ID, None, None, None, True,
+                                                                        ['Microsoft cloud security benchmark'],
+                                                                        'debug', True)
+            return [(None, report_data, exporter_arguments)]
+
+        def on_run(_, run_changes):
+            changes.append(run_changes)
+            if len(changes) == 2:
+                watcher.stop()
+
+        watcher = LabelWatcher(get_reports, TENANT_ID, 0)
+        with fake_azure(self.findings[0]) as resource_graph, self.assertLogs('watch', level='ERROR') as logs:
+            watcher.run(on_run)
+        self.assertEqual(len(logs.records), 1)
+        self.assertIsNone(changes[0])
+        self.assertIn(SUBSCRIPTION_IDS[2], {change['name'] for change in changes[1]})
+
+    def test_watch_prints_the_report_then_only_changes(self):
+        """Test that the watch mode prints the full report once and then only the changes, with one credential."""
+        runs = iter(self.findings)
+        credentials = []
+
+        def get_reports(args, credential):
+            credentials.append(credential)
+            try:
+                resource_graph.findings = next(runs)
+            except StopIteration:
+                raise KeyboardInterrupt from None
+            report_data, exporter_arguments = get_tenant_reporting_data(TENANT_ID, None, None, None, True,
+                                                                        ['Microsoft cloud security benchmark'],
+                                                                        'debug', True)
+            return [(None, report_data, exporter_arguments)]
+
+        output = io.StringIO()
+        test_args = ['prog', '--tenant-id', TENANT_ID, '--disable-banner', '--watch', '1']
+        with fake_azure(self.findings[0]) as resource_graph, \
+                patch.object(sys, 'argv', test_args), patch('azure.identity.DefaultAzureCredential'), \
+                patch('azure_energy_labeler_cli._get_reports', get_reports), \
+                patch('azure_energy_labeler_cli.setup_logging'), \
+                patch('azure_energy_labeler_cli.LabelWatcher',
+                      lambda get_reports, tenant_id, _: LabelWatcher(get_reports, tenant_id, 0)), \
+                redirect_stdout(output):
+            with self.assertRaises(SystemExit) as exit_context:
+                azure_energy_labeler_cli.main()
+        self.assertEqual(exit_context.exception.code, 0)
+        self.assertEqual(len({id(credential) for credential in credentials}), 1)
+        printed = output.getvalue()
+        self.assertEqual(printed.count('Energy label report'), 1)
+        self.assertEqual(printed.count('Energy label changes'), 1)
+        changed_subscriptions = [line for line in printed[printed.index('Energy label changes'):].splitlines()
+                                 if line.startswith('| subscription')]
+        self.assertEqual(len(changed_subscriptions), 1)
+        self.assertIn(SUBSCRIPTION_IDS[2], changed_subscriptions[0])
+
+
+class TestMultiTenant(unittest.TestCase):
+
+    def test_tenants_are_read_from_the_arguments_and_the_file(self):
+        """Test that the tenants of --tenant-ids and --tenants-file are combined and conflict with --tenant-id."""
+        with tempfile.TemporaryDirectory() as directory:
+            tenants_file = Path(directory, 'tenants.txt')
+            tenants_file.write_text(f'# production\n{SUBSCRIPTION_IDS[1]}\n\n{SUBSCRIPTION_IDS[2]}  # acceptance\n')
+            test_args = ['prog', '--tenant-ids', TENANT_ID, '--tenants-file', str(tenants_file),
+                         '--tenant-workers', '2']
+            with patch.object(sys, 'argv', test_args):
+                args = get_arguments()
+            self.assertEqual(args.tenant_ids, [TENANT_ID] + SUBSCRIPTION_IDS[1:3])
+            self.assertIsNone(args.tenant_id)
+            self.assertEqual(args.tenant_workers, 2)
+            for conflicting_args in [['--tenant-id', TENANT_ID], ['--watch', '10'], ['serve']]:
+                with patch.object(sys, 'argv', test_args + conflicting_args):
+                    with self.assertRaises(MutuallyExclusiveArguments):
+                        get_arguments()
+
+    def test_tenants_are_labeled_one_per_cpu_by_default(self):
+        """Test that by default every distinct tenant is labeled at the same time, up to the number of cpus."""
+        with patch.object(sys, 'argv', ['prog', '--tenant-ids', TENANT_ID]):
+            self.assertIsNone(get_arguments().tenant_workers)
+        with patch('os.cpu_count', return_value=2):
+            self.assertEqual(get_default_tenant_workers([TENANT_ID, TENANT_ID]), 1)
+            self.assertEqual(get_default_tenant_workers(SUBSCRIPTION_IDS), 2)
+
+    def test_tenants_are_labeled_in_parallel_and_failures_are_isolated(self):
+        """Test that tenants are labeled in parallel processes and a failing tenant does not stop the others."""
+        tenant_runs = label_tenants(['first', 'failing', 'third', 'first'], label_tenant_slowly, max_workers=3)
+        self.assertEqual([tenant_run.tenant_id for tenant_run in tenant_runs], ['first', 'failing', 'third'])
+        self.assertEqual([tenant_run.succeeded for tenant_run in tenant_runs], [True, False, True])
+        self.assertEqual(tenant_runs[1].error, 'PermissionError: No access to tenant failing')
+        self.assertEqual(tenant_runs[2].reports[0][:2], [['Tenant ID:', 'third'], ['Tenant Security Score:', 'A']])
+        self.assertGreaterEqual(tenant_runs[0].duration, 0.5)
+        (first_started, first_ended), (third_started, third_ended) = (tenant_runs[index].reports[0][2][1]
+                                                                      for index in (0, 2))
+        self.assertLess(max(first_started, third_started), min(first_ended, third_ended))
+
+    def test_every_tenant_is_exported_to_its_own_directory(self):
+        """Test that the entry point exports every tenant apart, summarizes all and fails if one tenant failed."""
+        failing_tenant_id = SUBSCRIPTION_IDS[1]
+
+        def get_reports(args, credentials=None):
+            if args.tenant_id == failing_tenant_id:
+                wait_for_findings(deny_access, args.tenant_id, 'debug')
+            # The fake Azure holds a single tenant, so every tenant is labeled as that one.
+            report_data, exporter_arguments = get_tenant_reporting_data(TENANT_ID, None, None, None, False,
+                                                                        ['Microsoft cloud security benchmark'],
+                                                                        'debug', True)
+            return [(args.export_path, report_data, exporter_arguments)]
+
+        findings = {subscription_id: [get_finding_data(subscription_id, 0)] for subscription_id in SUBSCRIPTION_IDS}
+        tenant_ids = [TENANT_ID, failing_tenant_id, SUBSCRIPTION_IDS[2], TENANT_ID]
+        output = io.StringIO()
+        with tempfile.TemporaryDirectory() as directory:
+            test_args = ['prog', '--tenant-ids', ','.join(tenant_ids), '--tenant-workers', '2', '--disable-banner',
+                         '--export-path', directory]
+            with fake_azure(findings), patch.object(sys, 'argv', test_args), \
+                    patch('azure_energy_labeler_cli._get_reports', get_reports), \
+                    patch('concurrent.futures.ProcessPoolExecutor', PicklingThreadPoolExecutor), \
+                    patch('azure_energy_labeler_cli.setup_logging'), redirect_stdout(output):
+                with self.assertRaises(SystemExit) as exit_context:
+                    azure_energy_labeler_cli.main()
+            exported = sorted(path.name for path in Path(directory).iterdir())
+        self.assertEqual(exit_context.exception.code, 1)
+        self.assertEqual(exported, sorted([TENANT_ID, SUBSCRIPTION_IDS[2]]))
+        printed = output.getvalue()
+        self.assertEqual(printed.count('Energy label report'), 2)
+        summary = printed[printed.index('Tenants summary'):].splitlines()
+        failed = [line.split('|') for line in summary if failing_tenant_id in line]
+        self.assertEqual([(line[2].strip(), line[5].strip()) for line in failed],
+                         [('failed', f'PermissionError: No access to tenant {failing_tenant_id}')])
+        self.assertEqual(len([line for line in summary if '| labeled' in line]), 2)
+
+
+class TestJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.jobs_file = Path(self.directory.name, 'jobs.yaml')
+        self.jobs_file.write_text(f"""
+jobs:
+  - name: production
+    tenant-id: {TENANT_ID}
+    allowed-subscription-ids: [{SUBSCRIPTION_IDS[0]}]
+    export-path: {self.directory.name}/production
+    export-metrics: true
+  - name: acceptance
+    tenant-id: {TENANT_ID}
+    denied-subscription-ids: {SUBSCRIPTION_IDS[0]},{SUBSCRIPTION_IDS[1]}
+    denied-resource-group-names: [rg-1]
+    export-path: {self.directory.name}/acceptance
+    findings-export-format: ndjson
+  - name: unknown framework
+    tenant-id: {TENANT_ID}
+    frameworks: [Unknown framework]
+""")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_jobs_are_loaded_from_yaml_and_json(self):
+        """Test that jobs files are converted to the cli arguments of every job and invalid jobs are rejected."""
+        jobs = load_jobs(self.jobs_file)
+        self.assertEqual(jobs[0], {'name': 'production',
+                                   'tenant_id': TENANT_ID,
+                                   'allowed_subscription_ids': [SUBSCRIPTION_IDS[0]],
+                                   'export_path': f'{self.directory.name}/production',
+                                   'export_all': False})
+        self.assertEqual(jobs[1]['denied_subscription_ids'], SUBSCRIPTION_IDS[:2])
+        self.assertEqual(jobs[1]['findings_export_format'], 'ndjson')
+        json_file = Path(self.directory.name, 'jobs.json')
+        json_file.write_text(json.dumps([{'tenant-id': TENANT_ID}]))
+        self.assertEqual(load_jobs(json_file), [{'name': 'job-1', 'tenant_id': TENANT_ID}])
+        for invalid_jobs in [[{'tenant-id': TENANT_ID, 'export-paht': '/tmp'}],
+                             [{'name': 'job'}],
+                             [{'tenant-id': TENANT_ID, 'export-format': 'csv'}],
+                             [{'tenant-id': TENANT_ID, 'export-metrics': 'false'}],
+                             [{'tenant-id': TENANT_ID, 'name': 'job'}, {'tenant-id': TENANT_ID, 'name': 'job'}]]:
+            json_file.write_text(json.dumps(invalid_jobs))
+            with self.assertRaises(InvalidJobsFile):
+                load_jobs(json_file)
+        with patch.object(sys, 'argv', ['prog', '--jobs', str(self.jobs_file), '--tenant-id', TENANT_ID]):
+            with self.assertRaises(MutuallyExclusiveArguments):
+                get_arguments()
+
+    def test_jobs_of_a_tenant_share_the_retrieved_findings(self):
+        """Test that jobs run in one process, retrieve the findings of a tenant once and fail on their own."""
+        findings = {subscription_id: [get_finding_data(subscription_id, index, resource_group=f'rg-{index % 2}')
+                                      for index in range(4)]
+                    for subscription_id in SUBSCRIPTION_IDS}
+        output = io.StringIO()
+        test_args = ['prog', '--jobs', str(self.jobs_file), '--disable-banner', '--job-workers', '3']
+        with fake_azure(findings) as resource_graph, patch.object(sys, 'argv', test_args), \
+                patch('azure.identity.DefaultAzureCredential'), \
+                patch('azure_energy_labeler_cli.setup_logging'), redirect_stdout(output):
+            with self.assertRaises(SystemExit) as exit_context:
+                azure_energy_labeler_cli.main()
+            self.assertEqual(resource_graph.calls, 1)
+        self.assertEqual(exit_context.exception.code, 1)
+        self.assertTrue(Path(self.directory.name, 'production', 'tenant-energy-label.json').is_file())
+        self.assertTrue(Path(self.directory.name, 'acceptance', 'defender-for-cloud-findings.ndjson').is_file())
+        self.assertFalse(Path(self.directory.name, 'production', 'defender-for-cloud-findings.json').exists())
+        printed = output.getvalue()
+        self.assertEqual(printed.count('Energy label report'), 2)
+        summary = printed[printed.index('Jobs summary'):].splitlines()
+        self.assertEqual([line.split('|')[3].strip() for line in summary
+                          if line.startswith(('| production', '| acceptance', '| unknown framework'))],
+                         ['succeeded', 'succeeded', 'failed'])
+
+    def test_jobs_authenticate_with_a_credential_per_tenant(self):
+        """Test that jobs of the same tenant share a credential caching the tokens of that tenant only."""
+        other_tenant_id = SUBSCRIPTION_IDS[2]
+        jobs_file = Path(self.directory.name, 'jobs.json')
+        jobs_file.write_text(json.dumps([{'name': 'production', 'tenant-id': TENANT_ID},
+                                         {'name': 'acceptance', 'tenant-id': TENANT_ID},
+                                         {'name': 'other', 'tenant-id': other_tenant_id}]))
+        used_credentials = []
+
+        def get_reports(args, credentials=None, shared_findings=None):  # pylint: disable=unused-argument
+            used_credentials.append((args.tenant_id, credentials))
+            return []
+
+        test_args = ['prog', '--jobs', str(jobs_file), '--disable-banner',
+                     '--token-cache-file', str(Path(self.directory.name, 'tokens.bin'))]
+        with patch.object(sys, 'argv', test_args), patch('azure.identity.DefaultAzureCredential'), \
+                patch('azure_energy_labeler_cli._get_reports', get_reports), patch('azure_energy_labeler_cli._label'), \
+                patch('azure_energy_labeler_cli.setup_logging'), redirect_stdout(io.StringIO()):
+            with self.assertRaises(SystemExit) as exit_context:
+                azure_energy_labeler_cli.main()
+        self.assertEqual(exit_context.exception.code, 0)
+        self.assertEqual(sorted(tenant_id for tenant_id, _ in used_credentials),
+                         sorted([TENANT_ID, TENANT_ID, other_tenant_id]))
+        self.assertTrue(all(credentials.tenant_id == tenant_id for tenant_id, credentials in used_credentials))
+        self.assertEqual(len({id(credentials) for _, credentials in used_credentials}), 2)
+
+
+class TestProfile(unittest.TestCase):
+
+    def test_every_phase_is_profiled(self):
+        """Test that --profile writes a pstats file per phase and collapsed stacks rooted at the phases."""
+        findings = {subscription_id: [get_finding_data(subscription_id, index) for index in range(10)]
+                    for subscription_id in SUBSCRIPTION_IDS}
+        with tempfile.TemporaryDirectory() as directory:
+            test_args = ['prog', '--tenant-id', TENANT_ID, '--disable-banner', '--disable-spinner',
+                         '--export-path', os.path.join(directory, 'export'), '--export-workers', '2',
+                         '--profile', os.path.join(directory, 'profile')]
+            with fake_azure(findings, latency=0.05), patch.object(sys, 'argv', test_args), \
+                    patch('azure_energy_labeler_cli.setup_logging'), redirect_stdout(io.StringIO()):
+                with self.assertRaises(SystemExit) as exit_context:
+                    azure_energy_labeler_cli.main()
+            self.assertEqual(exit_context.exception.code, 0)
+            profile_directory = Path(directory, 'profile')
+            self.assertEqual(sorted(path.name for path in profile_directory.iterdir()),
+                             sorted([f'{phase}.pstats' for phase in ['arguments', 'findings', 'labels', 'export',
+                                                                     'report']] + [COLLAPSED_STACKS_FILENAME]))
+            functions = {phase: {function for _, _, function in pstats.Stats(
+                str(profile_directory.joinpath(f'{phase}.pstats'))).stats}
+                for phase in ['arguments', 'findings', 'report']}
+            stacks = profile_directory.joinpath(COLLAPSED_STACKS_FILENAME).read_text().splitlines()
+        self.assertIn('get_arguments', functions['arguments'])
+        self.assertIn('_get_findings', functions['findings'])
+        self.assertNotIn('_get_findings', functions['report'])
+        self.assertTrue(all(re.fullmatch(r'(arguments|findings|labels|export|report);.+ \d+', stack)
+                            for stack in stacks))
+        self.assertTrue(any(stack.startswith('findings;') for stack in stacks))
+
+
+class TestConcurrentRetrieval(unittest.TestCase):
+
+    def setUp(self):
+        self.subscription_ids = [f'00000000-0000-0000-0000-{index:012d}' for index in range(1, 17)]
+        self.findings = {subscription_id: [get_finding_data(subscription_id, index) for index in range(20)]
+                         for subscription_id in self.subscription_ids}
+
+    def _retrieve(self, max_workers, retrieval_engine='threads'):
+        labeler = get_labeler(TENANT_ID, ['Microsoft cloud security benchmark'],
+                              max_workers=max_workers, retrieval_engine=retrieval_engine)
+        return labeler.filtered_defender_for_cloud_findings
+
+    def test_concurrent_retrieval_matches_serial_retrieval(self):
+        """Test that retrieving per subscription concurrently merges to the same ordered findings."""
+        with fake_azure(self.findings) as resource_graph:
+            serial = [finding.recommendation_id for finding in self._retrieve(1)]
+            self.assertEqual(resource_graph.calls, 1)
+            concurrent = [finding.recommendation_id for finding in self._retrieve(4)]
+            self.assertEqual(resource_graph.calls, 1 + len(self.subscription_ids))
+        self.assertEqual(len(serial), 16 * 20)
+        self.assertEqual(serial, concurrent)
+
+    def test_concurrency_grows_with_workers(self):
+        """Test that the queries in flight against a fake resource graph with latency reach the number of workers."""
+        with fake_azure(self.findings, latency=0.02) as resource_graph:
+            for max_workers in [2, 4, 8]:
+                resource_graph.max_in_flight = 0
+                self._retrieve(max_workers)
+                self.assertEqual(resource_graph.max_in_flight, max_workers)
+
+    def test_asyncio_retrieval_matches_serial_retrieval(self):
+        """Test that the asyncio engine retrieves every page within the concurrency bound."""
+        FakeAsyncResourceGraphClient.max_in_flight = 0
+        with fake_azure(self.findings, latency=0.001) as resource_graph:
+            serial = [finding.recommendation_id for finding in self._retrieve(1)]
+            asynchronous = [finding.recommendation_id for finding in self._retrieve(5, 'asyncio')]
+            self.assertEqual(resource_graph.calls, 1 + len(self.subscription_ids) * 3)
+        self.assertEqual(serial, asynchronous)
+        self.assertEqual(FakeAsyncResourceGraphClient.max_in_flight, 5)
+
+    def test_asyncio_engine_compared_to_threads(self):
+        """Test that both engines overlap their queries up to the same bound on fakes with the same latency."""
+        fakes = {'threads': FakeResourceGraphClient, 'asyncio': FakeAsyncResourceGraphClient}
+        with fake_azure(self.findings, latency=0.02):
+            for retrieval_engine, fake in fakes.items():
+                fake.max_in_flight = 0
+                self._retrieve(8, retrieval_engine)
+                self.assertEqual(fake.max_in_flight, 8, retrieval_engine)
+
+
+class TestStreaming(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    @staticmethod
+    def _get_findings(counts):
+        findings = {}
+        for subscription_id, count in zip(SUBSCRIPTION_IDS, counts):
+            findings[subscription_id] = [get_finding_data(subscription_id, index,
+                                                          severity=['High', 'Medium', 'Low'][index % 3],
+                                                          resource_group=f'rg-{index % 4}')
+                                         for index in range(count)]
+            for index, finding in enumerate(findings[subscription_id]):
+                if index % 5 == 0:
+                    finding['state'] = 'healthy'
+                if index % 7 == 0:
+                    finding['complianceState'] = 'Skipped'
+        return findings
+
+    def test_streamed_labels_and_exports_match_in_memory_labeling(self):
+        """Test that streaming produces the same report and exports as labeling the findings in memory."""
+        arguments = [TENANT_ID, None, None, None, True, ['Microsoft cloud security benchmark'], 'debug', True]
+        exports = {}
+        with fake_azure(self._get_findings([0, 12, 60]), page_size=7):
+            for stream in [False, True]:
+                report_data, exporter_arguments = get_tenant_reporting_data(*arguments, stream=stream)
+                exports[stream] = Path(self.directory.name, str(stream))
+                DataExporter(**exporter_arguments).export(str(exports[stream]))
+                if stream:
+                    self.assertEqual(report_data, in_memory_report_data)
+                in_memory_report_data = report_data
+        for path in exports[False].iterdir():
+            in_memory, streamed = (json.loads(export.joinpath(path.name).read_text(encoding='utf-8'))
+                                   for export in exports.values())
+            if path.name == 'defender-for-cloud-findings.json':
+                self.assertEqual(len(streamed), 49)
+                streamed.sort(key=lambda finding: finding['Recommendation ID'])
+            self.assertEqual(in_memory, streamed, path.name)
+
+    def test_streamed_findings_are_removed_after_exporting(self):
+        """Test that labeling with --stream removes the spooled findings once they are exported."""
+        close = StreamedFindings.close
+        export_path = Path(self.directory.name, 'export')
+        test_args = ['prog', '--tenant-id', TENANT_ID, '--disable-banner', '--disable-spinner', '--stream',
+                     '--export-path', str(export_path)]
+        with fake_azure(self._get_findings([0, 12, 60]), page_size=7), patch.object(sys, 'argv', test_args), \
+                patch('azure.identity.DefaultAzureCredential'), patch('azure_energy_labeler_cli.setup_logging'), \
+                patch.object(StreamedFindings, 'close', autospec=True, side_effect=close) as mock_close, \
+                redirect_stdout(io.StringIO()):
+            with self.assertRaises(SystemExit) as exit_context:
+                azure_energy_labeler_cli.main()
+        self.assertEqual(exit_context.exception.code, 0)
+        self.assertTrue(export_path.joinpath('defender-for-cloud-findings.json').is_file())
+        mock_close.assert_called_once()
+
+    def test_findings_are_written_like_the_library(self):
+        """Test that the incremental findings export is byte identical to the one of the library."""
+        findings = [Finding(data) for data in self._get_findings([30])[SUBSCRIPTION_IDS[0]]]
+        for subset in [findings, findings[:1], []]:
+            output = tempfile.TemporaryFile('w+', encoding='utf-8')  # pylint: disable=consider-using-with
+            with output:
+                write_findings_json(subset, output)
+                output.seek(0)
+                self.assertEqual(output.read(), DefenderForCloudFindingsData('', subset).json)
+
+    def test_buffer_bounds_the_items_produced_ahead(self):
+        """Test that the producer never gets more than the buffer size ahead and its errors reach the consumer."""
+        produced = []
+
+        def produce():
+            for index in range(20):
+                produced.append(index)
+                yield index
+            raise ValueError('page failed')
+
+        consumed = []
+        with self.assertRaises(ValueError):
+            for item in buffered(produce(), size=3):
+                time.sleep(0.005)
+                self.assertLessEqual(len(produced) - len(consumed), 3 + 2)
+                consumed.append(item)
+        self.assertEqual(consumed, list(range(20)))
+
+    def test_memory_stays_flat_with_the_number_of_findings(self):
+        """Test that the peak memory of labeling and exporting streamed findings grows far slower than in memory.
+
+        Streaming only keeps the recommendation ids to drop duplicates, so its peak grows far slower. Both export the
+        findings record by record, so the difference is the findings kept in memory.
+
+        """
+        arguments = [TENANT_ID, None, None, None, True, ['Microsoft cloud security benchmark'], 'debug', True]
+        peaks = {}
+        for count in [1000, 10000]:
+            with fake_azure(self._get_findings([count]), page_size=500):
+                for stream in [False, True]:
+                    tracemalloc.start()
+                    _, exporter_arguments = get_tenant_reporting_data(*arguments, stream=stream)
+                    DataExporter(**exporter_arguments).export(str(Path(self.directory.name, str(stream))))
+                    peaks[(count, stream)] = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    del exporter_arguments
+        self.assertLess(peaks[(10000, True)] - peaks[(1000, True)], (peaks[(10000, False)] - peaks[(1000, False)]) / 3)
+
+    def test_findings_export_is_written_without_the_whole_document(self):
+        """Test that exporting findings held in memory peaks far below serializing the whole document."""
+        findings = IndexedFindings(CompactFinding(data) for data in self._get_findings([5000])[SUBSCRIPTION_IDS[0]])
+        path = Path(self.directory.name, 'findings')
+        exporter = DataExporter(['findings'], TENANT_ID, 'A', findings, [])
+        tracemalloc.start()
+        exporter.export(str(path))
+        streamed_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        document = DefenderForCloudFindingsData('', findings).json
+        document_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertEqual(path.joinpath('defender-for-cloud-findings.json').read_text(encoding='utf-8'), document)
+        self.assertLess(streamed_peak, document_peak / 20)
+
+
+class TestCompactFinding(unittest.TestCase):
+
+    def test_compact_findings_behave_like_library_findings(self):
+        """Test that compact findings expose, label and round trip like the findings of the library."""
+        data = [get_synthetic_finding_data(index) for index in range(600)]
+        data[0]['statusChangeDate'] = ''
+        findings, compact_findings = [Finding(item) for item in data], [CompactFinding(item) for item in data]
+        attributes = ['compliance_standard_id', 'compliance_control_id', 'compliance_state', 'subscription_id',
+                      'resource_group', 'resource_type', 'resource_name', 'resource_id', 'severity', 'state',
+                      'recommendation_id', 'recommendation_name', 'recommendation_display_name', 'description',
+                      'remediation_steps', 'azure_portal_recommendation_link', 'control_name', 'status_change_date',
+                      'days_open', 'is_skipped']
+        for finding, compact_finding in zip(findings, compact_findings):
+            for attribute in attributes:
+                self.assertEqual(getattr(finding, attribute), getattr(compact_finding, attribute), attribute)
+            self.assertEqual(CompactFinding(compact_finding.to_data()).days_open, finding.days_open)
+        subscription = Subscription(None, SimpleNamespace(subscription_id=data[1]['subscriptionId']), [])
+        self.assertEqual(subscription.get_energy_label(findings), subscription.get_energy_label(compact_findings))
+        self.assertEqual(len(set(compact_findings)), len(set(findings)))
+
+    def test_compact_findings_memory(self):
+        """Test that compact findings hold less than a third of the memory of library findings.
+
+        Runs on 20000 synthetic findings to keep the suite fast, set AZURE_LABELER_BENCHMARK_FINDINGS to measure
+        another number of findings, like a million.
+
+        """
+        count = int(os.environ.get('AZURE_LABELER_BENCHMARK_FINDINGS', 20000))
+        sizes = {}
+        for finding_class in [Finding, CompactFinding]:
+            tracemalloc.start()
+            findings = [finding_class(get_synthetic_finding_data(index)) for index in range(count)]
+            sizes[finding_class.__name__] = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del findings
+        self.assertLess(sizes['CompactFinding'], sizes['Finding'] / 3)
+
+
+class TestIndexedFindings(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.subscription_ids = [f'00000000-0000-0000-0000-{index:012d}' for index in range(1, 41)]
+        self.findings = {subscription_id: [get_finding_data(subscription_id, index,
+                                                            severity=['High', 'Medium', 'Low'][index % 3],
+                                                            resource_group=f'rg-{index % 10}')
+                                           for index in range(150)]
+                         for subscription_id in self.subscription_ids}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_findings_are_looked_up_by_subscription_and_resource_group(self):
+        """Test that the index matches ids and names case insensitively and resource groups per subscription."""
+        findings = IndexedFindings(CompactFinding(finding) for subscription_id in self.subscription_ids[:2]
+                                   for finding in self.findings[subscription_id])
+        self.assertEqual(len(findings.get_subscription_findings(self.subscription_ids[0].upper())), 150)
+        self.assertEqual(len(findings.get_resource_group_findings('RG-1', self.subscription_ids[1])), 15)
+        self.assertEqual(len(findings.get_resource_group_findings('rg-1')), 30)
+        self.assertIs(findings.get_resource_group_findings('RG-1'), findings.get_resource_group_findings('rg-1'))
+        self.assertEqual(findings.get_subscription_findings(self.subscription_ids[3]), [])
+
+    def test_indexed_exports_match_scanning_exports(self):
+        """Test that exporting out of the index iterates the findings once instead of once per labeled entity."""
+        iterations = Counter()
+
+        def counting(findings_type):
+            class CountingFindings(findings_type):  # pylint: disable=too-few-public-methods
+
+                def __iter__(self):
+                    iterations[findings_type] += 1
+                    return super().__iter__()
+
+            return CountingFindings
+
+        arguments = [TENANT_ID, None, None, None, True, ['Microsoft cloud security benchmark'], 'debug', True]
+        with fake_azure(self.findings):
+            _, exporter_arguments = get_tenant_reporting_data(*arguments)
+            findings = list(exporter_arguments['defender_for_cloud_findings'])
+            for findings_type in [IndexedFindings, list]:
+                exporter_arguments['defender_for_cloud_findings'] = counting(findings_type)(findings)
+                DataExporter(**exporter_arguments).export(str(Path(self.directory.name, findings_type.__name__)))
+        self.assertGreaterEqual(iterations[list], len(self.subscription_ids))
+        self.assertLess(iterations[IndexedFindings], len(self.subscription_ids))
+        for path in Path(self.directory.name, 'IndexedFindings').iterdir():
+            self.assertEqual(path.read_text(encoding='utf-8'),
+                             Path(self.directory.name, 'list', path.name).read_text(encoding='utf-8'), path.name)
+
+
+class TestParallelExport(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.findings = {subscription_id: [get_finding_data(subscription_id, index,
+                                                            severity=['High', 'Medium', 'Low'][index % 3],
+                                                            resource_group=f'rg-{index % 5}')
+                                           for index in range(50)]
+                         for subscription_id in SUBSCRIPTION_IDS}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_parallel_export_matches_sequential_export(self):
+        """Test that exporting with workers writes the same files, overlapping up to the number of workers."""
+        export_to_fs = DataExporter._export_to_fs  # pylint: disable=protected-access
+        lock = threading.Lock()
+        in_flight = Counter()
+
+        def slow_export_to_fs(exporter, directory, filename, data=None, manifest=None, write=None):
+            with lock:
+                in_flight['current'] += 1
+                in_flight[exporter.max_workers] = max(in_flight[exporter.max_workers], in_flight['current'])
+            time.sleep(0.05)
+            export_to_fs(exporter, directory, filename, data, manifest, write)
+            with lock:
+                in_flight['current'] -= 1
+
+        with fake_azure(self.findings), patch.object(DataExporter, '_export_to_fs', slow_export_to_fs):
+            _, exporter_arguments = get_tenant_reporting_data(TENANT_ID, None, None, None, True,
+                                                              ['Microsoft cloud security benchmark'], 'debug', True)
+            for max_workers in [1, 4]:
+                timings = DataExporter(max_workers=max_workers,
+                                       **exporter_arguments).export(str(Path(self.directory.name, str(max_workers))))
+                self.assertEqual(sorted(timings), sorted(path.name for path in
+                                                         Path(self.directory.name, str(max_workers)).iterdir()))
+        for path in Path(self.directory.name, '1').iterdir():
+            self.assertEqual(path.read_bytes(), Path(self.directory.name, '4', path.name).read_bytes(), path.name)
+        self.assertEqual(in_flight[1], 1)
+        self.assertGreater(in_flight[4], 1)
+        self.assertLessEqual(in_flight[4], 4)